@@ -2,7 +2,11 @@ __author__ = 'mateusz'
 
 from math import log, lgamma
 from collections import OrderedDict, namedtuple
-from utils import log_sum_exp
+from utils import log_sum_exp, log_sum_exp_array
+
+import numpy as np
+
+PyCloneBinomialData = namedtuple('PyCloneBinomialData', ['b', 'd', 'cn_n', 'cn_r', 'cn_v', 'mu_n', 'mu_r', 'mu_v', 'log_pi'])
 
 def log_beta_pdf(x, a, b):
     if x == 0 or x == 1:
@@ -17,6 +21,26 @@ def log_beta(a, b):
 
     return lgamma(a) + lgamma(b) - lgamma(a + b)
 
+
+def log_binomial_coefficient(n, x):
+    return lgamma(n + 1) - lgamma(x + 1) - lgamma(n - x + 1)
+
+
+def log_binomial_pdf(x, n, p):
+    if p == 0:
+        if x == 0:
+            return 0
+        else:
+            return float('-inf')
+
+    if p == 1:
+        if x == n:
+            return 0
+        else:
+            return float('-inf')
+
+    return log_binomial_coefficient(n, x) + x * log(p) + (n - x) * log(1 - p)
+
 class Density(object):
     def __init__(self, params=None):
         self.params = params
@@ -25,6 +49,18 @@ class Density(object):
 
         self.max_cache_size = 10000
 
+        # Running totals read by SamplerProfiler. They are only updated between start_counting and stop_counting, so
+        # log_p costs nothing extra otherwise
+        self.counting = False
+
+        self.counters = {
+                         'log_p_calls' : 0,
+                         'cache_hits' : 0,
+                         'cache_misses' : 0,
+                         'cache_evictions' : 0,
+                         'log_p_matrix_evaluations' : 0
+                         }
+
     def log_p(self, data, params):
         '''
         Args:
@@ -46,9 +82,81 @@ class Density(object):
 
         return self.cache[key]
 
+    def start_counting(self):
+        '''
+        Update counters from now on. log_p is replaced on this instance by a version which counts, so the plain
+        version has no per call cost when counting is off.
+        '''
+        self.counting = True
+
+        self.log_p = self._counting_log_p
+
+    def stop_counting(self):
+        self.counting = False
+
+        self.__dict__.pop('log_p', None)
+
+    def _counting_log_p(self, data, params):
+        key = (data, params, self.params)
+
+        counters = self.counters
+
+        counters['log_p_calls'] += 1
+
+        if key not in self.cache:
+            counters['cache_misses'] += 1
+
+            self.cache[key] = self._log_p(data, params)
+
+            if len(self.cache) > self.max_cache_size:
+                counters['cache_evictions'] += 1
+
+                self.cache.popitem(last=False)
+
+        else:
+            counters['cache_hits'] += 1
+
+        return self.cache[key]
+
     def _log_p(self, data, params):
         raise NotImplemented
 
+    def pack(self, data):
+        '''
+        Convert a list of data points into the form expected by log_p_matrix. The default is a plain list. PackedData
+        is already in packed form and is returned as is.
+        '''
+        if isinstance(data, PackedData):
+            return data.packed
+
+        return list(data)
+
+    def log_p_matrix(self, data, params, items=None):
+        '''
+        Evaluate the density for every pair of data point and parameter.
+
+        Args:
+            data : Data points as returned by self.pack().
+
+            params : (list) Parameters to evaluate each data point against.
+
+        Kwargs:
+            items : (list) Indices of the data points to evaluate. If None all data points are used.
+
+        Returns:
+            log_p : (numpy.ndarray) Array of shape len(items) x len(params).
+        '''
+        if items is None:
+            items = range(len(data))
+
+        log_p = np.empty((len(items), len(params)))
+
+        for i, item in enumerate(items):
+            for j, param in enumerate(params):
+                log_p[i, j] = self.log_p(data[item], param)
+
+        return log_p
+
 class PyCloneBinomialDensity(Density):
     def _log_p(self, data, params):
         ll = []
@@ -68,6 +176,330 @@ class PyCloneBinomialDensity(Density):
 
         return log_sum_exp(ll)
 
+    def _log_binomial_likelihood(self, b, d, cn_n, cn_r, cn_v, mu_n, mu_r, mu_v, cellular_frequency):
+        t = self.params.tumour_content
+
+        f = cellular_frequency
+
+        p_n = (1 - t) * cn_n
+        p_r = t * (1 - f) * cn_r
+        p_v = t * f * cn_v
+
+        norm_const = p_n + p_r + p_v
+
+        mu = (p_n * mu_n + p_r * mu_r + p_v * mu_v) / norm_const
+
+        return log_binomial_pdf(b, d, mu)
+
+    def pack(self, data):
+        if isinstance(data, PackedData):
+            return data.packed
+
+        return PyCloneBinomialDataArray.from_data(data)
+
+    def log_p_matrix(self, data, params, items=None, chunk_size=2 ** 20):
+        '''
+        Batched version of log_p. See Density.log_p_matrix.
+
+        Kwargs:
+            chunk_size : (int) Rough upper bound on the number of (item, state, param) terms held in memory at once.
+        '''
+        if items is not None:
+            data = data.take(items)
+
+        x = np.array([param.x for param in params], dtype=float)
+
+        log_p = np.empty((len(data), len(x)))
+
+        if self.counting:
+            self.counters['log_p_matrix_evaluations'] += log_p.size
+
+        step = max(1, chunk_size // max(1, data.num_states * len(x)))
+
+        for start in range(0, len(data), step):
+            stop = start + step
+
+            log_p[start:stop] = log_pyclone_binomial_matrix(data.take(slice(start, stop)), x, self.params.tumour_content)
+
+        return log_p
+
+class PyCloneBinomialDataArray(namedtuple('PyCloneBinomialDataArray', ['b', 'd', 'log_c', 'group'] +
+                                                                     list(PyCloneBinomialData._fields[2:]))):
+    '''
+    Array form of a list of PyCloneBinomialData with the states interned in groups.
+
+    b, d, log_c (the log binomial coefficient) and group are vectors with one entry per data point. Data points with
+    the same states share a group, and the state fields are G x s matrices with one row per group, where s is the
+    largest number of states of any group. Rows with fewer states are padded with copies of their first state with
+    log_pi set to -inf, so the padding drops out of the sum over states.
+    '''
+    __slots__ = ()
+
+    point_fields = ('b', 'd', 'log_c', 'group')
+
+    @classmethod
+    def from_data(cls, data):
+        group_ids = {}
+
+        states = []
+
+        group = np.empty(len(data), dtype=np.int32)
+
+        for i, x in enumerate(data):
+            key = x[2:]
+
+            if key not in group_ids:
+                group_ids[key] = len(states)
+
+                states.append((np.array([x.cn_n, x.cn_r, x.cn_v]).T, np.array([x.mu_n, x.mu_r, x.mu_v]).T, x.log_pi))
+
+            group[i] = group_ids[key]
+
+        return cls.from_groups([x.b for x in data], [x.d for x in data], group, states)
+
+    @classmethod
+    def from_groups(cls, b, d, group, states):
+        '''
+        Build the arrays straight from read counts, group ids and compiled states, without creating
+        PyCloneBinomialData objects.
+
+        Args:
+            b, d : (array_like) Variant and total read counts of each data point.
+
+            group : (array_like) Group id of each data point, indexing states.
+
+            states : (list) The (cn, mu, log_pi) states of each group, as compiled by priors.compileStates.
+        '''
+        b = np.asarray(b, dtype=float)
+        d = np.asarray(d, dtype=float)
+
+        log_c = np.array([log_binomial_coefficient(d_i, b_i) for b_i, d_i in zip(b.tolist(), d.tolist())], dtype=float)
+
+        s = max([len(x[2]) for x in states] + [1])
+
+        cn = np.empty((len(states), s, 3))
+
+        mu = np.empty((len(states), s, 3))
+
+        log_pi = np.empty((len(states), s))
+
+        for g, (cn_g, mu_g, log_pi_g) in enumerate(states):
+            k = len(log_pi_g)
+
+            cn[g, :k] = cn_g
+            cn[g, k:] = cn_g[0]
+
+            mu[g, :k] = mu_g
+            mu[g, k:] = mu_g[0]
+
+            log_pi[g, :k] = log_pi_g
+            log_pi[g, k:] = float('-inf')
+
+        return cls(b=b,
+                   d=d,
+                   log_c=log_c,
+                   group=np.asarray(group, dtype=np.int32),
+                   cn_n=cn[:, :, 0],
+                   cn_r=cn[:, :, 1],
+                   cn_v=cn[:, :, 2],
+                   mu_n=mu[:, :, 0],
+                   mu_r=mu[:, :, 1],
+                   mu_v=mu[:, :, 2],
+                   log_pi=log_pi)
+
+    @property
+    def num_states(self):
+        return self.log_pi.shape[1]
+
+    def __len__(self):
+        return self.b.shape[0]
+
+    def take(self, items):
+        '''
+        Return the data points given by items, which may be a slice or a list of indices. The group states are shared.
+        '''
+        if not isinstance(items, slice):
+            items = np.asarray(items, dtype=int)
+
+        return PyCloneBinomialDataArray(*[value[items] if field in self.point_fields else value
+                                          for field, value in zip(self._fields, self)])
+
+    def data_point(self, i, cache=None):
+        '''
+        Return data point i as a PyCloneBinomialData without the padding states.
+
+        Kwargs:
+            cache : (dict) If given the state tuples of each group are kept in it and reused by later calls.
+        '''
+        g = int(self.group[i])
+
+        if cache is not None and g in cache:
+            states = cache[g]
+
+        else:
+            keep = np.isfinite(self.log_pi[g])
+
+            states = [tuple(getattr(self, field)[g][keep].tolist()) for field in PyCloneBinomialData._fields[2:]]
+
+            if cache is not None:
+                cache[g] = states
+
+        return PyCloneBinomialData(int(self.b[i]), int(self.d[i]), *states)
+
+    @property
+    def nbytes(self):
+        return sum(field.nbytes for field in self)
+
+class PackedData(object):
+    '''
+    Read-only sequence of data points which is stored in the packed form of a density. Density.pack returns the packed
+    form as is, so the batched kernels read the arrays directly. Indexing builds one data point on demand for the code
+    paths which evaluate points one at a time.
+
+    keys() and values() give the IDs and the data points, so PackedData can stand in for the OrderedDict of data points
+    taken by run_pyclone_binomial_analysis.
+
+    Args:
+        packed : (PyCloneBinomialDataArray) Packed data points, or an OrderedDict of sample ID to
+                 PyCloneBinomialDataArray as used by MultiSampleDensity.
+
+    Kwargs:
+        ids : (list) IDs of the data points, such as the mutation IDs.
+    '''
+    __slots__ = ('packed', 'ids', '_states')
+
+    def __init__(self, packed, ids=None):
+        self.packed = packed
+
+        self.ids = ids
+
+        # State tuples of each group, shared by the data points built by __getitem__
+        self._states = {}
+
+    def __getstate__(self):
+        return (self.packed, self.ids)
+
+    def __setstate__(self, state):
+        self.packed, self.ids = state
+
+        self._states = {}
+
+    def __len__(self):
+        if isinstance(self.packed, dict):
+            return len(next(iter(self.packed.values())))
+
+        return len(self.packed)
+
+    def __getitem__(self, i):
+        if isinstance(self.packed, dict):
+            return OrderedDict((sample_id, x.data_point(i, self._states.setdefault(sample_id, {})))
+                               for sample_id, x in self.packed.items())
+
+        return self.packed.data_point(i, self._states)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def keys(self):
+        return list(self.ids)
+
+    def values(self):
+        return self
+
+    def sample(self, sample_id):
+        '''
+        Return the data points of one sample as PackedData.
+        '''
+        return PackedData(self.packed[sample_id], self.ids)
+
+    def take(self, items):
+        '''
+        Return the data points given by the list of indices items as PackedData.
+        '''
+        if isinstance(self.packed, dict):
+            packed = OrderedDict((sample_id, x.take(items)) for sample_id, x in self.packed.items())
+
+        else:
+            packed = self.packed.take(items)
+
+        ids = None if self.ids is None else [self.ids[i] for i in items]
+
+        return PackedData(packed, ids)
+
+    @property
+    def nbytes(self):
+        if isinstance(self.packed, dict):
+            return sum(x.nbytes for x in self.packed.values())
+
+        return self.packed.nbytes
+
+
+def log_pyclone_binomial_matrix(data, x, tumour_content):
+    '''
+    Compute the PyClone binomial log likelihood of every data point at every cellular frequency in x.
+
+    The variant allele probability of each state at each frequency only depends on the group, so it is computed once
+    per group and shared by the data points of the group.
+
+    Args:
+        data : (PyCloneBinomialDataArray) Packed data points.
+
+        x : (numpy.ndarray) Vector of cellular frequencies.
+
+        tumour_content : (float) Tumour content of the sample.
+
+    Returns:
+        log_p : (numpy.ndarray) Array of shape len(data) x len(x).
+    '''
+    t = tumour_content
+
+    # Build the tables once per group and share them, unless there are fewer data points than groups, in which case
+    # it is cheaper to build them for each data point
+    if data.log_pi.shape[0] <= len(data):
+        groups, group_index = slice(None), data.group
+
+    else:
+        groups, group_index = data.group, slice(None)
+
+    f = np.asarray(x, dtype=float)[np.newaxis, np.newaxis, :]
+
+    cn_n = data.cn_n[groups][:, :, np.newaxis]
+    cn_r = data.cn_r[groups][:, :, np.newaxis]
+    cn_v = data.cn_v[groups][:, :, np.newaxis]
+
+    p_n = (1 - t) * cn_n
+    p_r = t * (1 - f) * cn_r
+    p_v = t * f * cn_v
+
+    norm_const = p_n + p_r + p_v
+
+    mu = (p_n * data.mu_n[groups][:, :, np.newaxis] +
+          p_r * data.mu_r[groups][:, :, np.newaxis] +
+          p_v * data.mu_v[groups][:, :, np.newaxis])
+
+    mu = mu / norm_const
+
+    b = data.b[:, np.newaxis, np.newaxis]
+    d = data.d[:, np.newaxis, np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_mu = np.log(mu)
+
+        log_one_minus_mu = np.log(1 - mu)
+
+        # Zero counts only need masking when a state has mu equal to 0 or 1, which the tables tell cheaply
+        if np.isfinite(log_mu).all() and np.isfinite(log_one_minus_mu).all():
+            ll = b * log_mu[group_index] + (d - b) * log_one_minus_mu[group_index]
+
+        else:
+            ll = np.where(b > 0, b * log_mu[group_index], 0) + \
+                 np.where(d - b > 0, (d - b) * log_one_minus_mu[group_index], 0)
+
+    ll = ll + data.log_pi[groups][group_index][:, :, np.newaxis]
+
+    return log_sum_exp_array(ll, axis=1) + data.log_c[:, np.newaxis]
+
 class MultiSampleDensity(Density):
     '''
     Wraps a collection of univariate densities.
@@ -117,4 +549,30 @@ class MultiSampleDensity(Density):
 
             log_p += density.log_p(data[sample_id], params[sample_id])
 
-        return log_p
\ No newline at end of file
+        return log_p
+
+    def pack(self, data):
+        if isinstance(data, PackedData):
+            return data.packed
+
+        packed_data = OrderedDict()
+
+        for sample_id in self.cluster_densities:
+            packed_data[sample_id] = self.cluster_densities[sample_id].pack([x[sample_id] for x in data])
+
+        return packed_data
+
+    def log_p_matrix(self, data, params, items=None):
+        '''
+        Sum of the batched log densities of each sample. data should come from self.pack().
+        '''
+        log_p = 0
+
+        for sample_id in self.cluster_densities:
+            density = self.cluster_densities[sample_id]
+
+            sample_params = [param[sample_id] for param in params]
+
+            log_p = log_p + density.log_p_matrix(data[sample_id], sample_params, items=items)
+
+        return log_p
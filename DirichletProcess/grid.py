@@ -0,0 +1,59 @@
+__author__ = 'mateusz'
+
+from math import log
+
+import numpy as np
+
+from measures import BetaData
+from rng import get_stream
+
+class PrevalenceGrid(object):
+    '''
+    Fixed discretisation of the unit interval for scalar cluster parameters such as the cellular prevalence.
+
+    The grid points are the midpoints of size equal width bins, so the end points 0 and 1, where the Beta base measure
+    has no mass, are never used.
+    '''
+    def __init__(self, size=1001):
+        self.size = size
+
+        self.points = (np.arange(size) + 0.5) / size
+
+        self.log_width = -log(size)
+
+    @property
+    def params(self):
+        return [BetaData(x) for x in self.points]
+
+    def log_prior(self, base_measure):
+        '''
+        Log density of the base measure at each grid point.
+        '''
+        return np.array([base_measure.log_p(param) for param in self.params])
+
+    def log_likelihood_table(self, cluster_density, data):
+        '''
+        Log density of every data point at every grid point as a len(data) x size array.
+
+        Args:
+            cluster_density : (Density) Density to evaluate.
+
+            data : Data points as returned by cluster_density.pack().
+        '''
+        return cluster_density.log_p_matrix(data, self.params)
+
+    def random_index(self, log_p, rng=None):
+        '''
+        Sample a grid index with probability proportional to exp(log_p).
+
+        Kwargs:
+            rng : (RandomStream) Stream to draw from. Defaults to the shared default stream.
+        '''
+        return get_stream(rng).log_categorical(log_p)
+
+    def random_indices(self, log_p, rng=None):
+        '''
+        Sample one grid index for each row of the 2-D array log_p, with probability proportional to exp(log_p). The
+        uniforms for all rows are drawn in one batch.
+        '''
+        return get_stream(rng).log_categorical(log_p)
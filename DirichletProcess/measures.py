@@ -2,7 +2,7 @@ __author__ = 'mateusz'
 
 from collections import namedtuple, OrderedDict
 from densities import log_beta_pdf
-from random import betavariate
+from rng import get_stream
 
 BetaData = namedtuple('BetaData', 'x')
 BetaParameter = namedtuple('BetaPriorData', ['a', 'b'])
@@ -26,18 +26,36 @@ class BaseMeasure(object):
         '''
         raise NotImplemented
 
+    def random_batch(self, size):
+        '''
+        Return a list of size random samples from the base measure.
+        '''
+        return [self.random() for _ in range(size)]
+
 class BetaBaseMeasure:
-    def __init__(self, a, b):
+    def __init__(self, a, b, rng=None):
+        '''
+        Args:
+            a, b : (float) Parameters of the Beta distribution.
+
+        Kwargs:
+            rng : (RandomStream) Stream to draw from. Defaults to the shared default stream.
+        '''
         self.params = BetaParameter(a, b)
 
+        self.rng = get_stream(rng)
+
     def log_p(self, data):
         return log_beta_pdf(data.x, self.params.a, self.params.b)
 
     def random(self):
-        x = betavariate(self.params.a, self.params.b)
+        x = self.rng.beta(self.params.a, self.params.b)
 
         return BetaData(x)
 
+    def random_batch(self, size):
+        return [BetaData(x) for x in self.rng.beta(self.params.a, self.params.b, size).tolist()]
+
 class MultiSampleBaseMeasure(BaseMeasure):
     def __init__(self, base_measures):
         '''
@@ -60,4 +78,9 @@ class MultiSampleBaseMeasure(BaseMeasure):
         for sample_id in self.base_measures:
             random_sample[sample_id] = self.base_measures[sample_id].random()
 
-        return random_sample
\ No newline at end of file
+        return random_sample
+
+    def random_batch(self, size):
+        sample_batches = [self.base_measures[sample_id].random_batch(size) for sample_id in self.base_measures]
+
+        return [OrderedDict(zip(self.base_measures, x)) for x in zip(*sample_batches)]
\ No newline at end of file
@@ -14,6 +14,8 @@ Created on 2012-09-20
 
 @author: Andrew Roth
 '''
+import numpy as np
+
 class Partition(object):
     def __init__(self):
         self.cells = []
@@ -117,3 +119,485 @@ class PartitionCell(object):
             return True
         else:
             return False
+
+class ArrayPartition(object):
+    '''
+    Drop in replacement for Partition where adding, removing and looking up the label of an item are O(1).
+    
+    Cells live in slots of fixed index. Each item stores the slot of its cell in a label vector and each slot stores its
+    count, so labels and counts never have to be rebuilt by walking the items. Slots of removed cells go on a free list
+    and are reused by add_cell. The index of a cell in self.cells, which is what labels refer to, is kept in a small
+    slot -> position map which only changes when cells are removed.
+    
+    After track_log_likelihoods(function) each cell can cache the total log likelihood of its members under its value,
+    which is stored with cell.set_value and read through cell.log_likelihood. Adding and removing items only records
+    them, and the next read scores just the recorded items and adds or subtracts them from the total. Setting the value
+    of a cell drops its total.
+    '''
+    def __init__(self):
+        self._slot_labels = np.empty(0, dtype=np.int64)
+        
+        self._member_index = np.empty(0, dtype=np.int64)
+        
+        self._counts = np.empty(0, dtype=np.int64)
+        
+        self._positions = np.empty(0, dtype=np.int64)
+        
+        self._members = []
+        
+        self._slot_cells = []
+        
+        self._free_slots = []
+        
+        self._order = []
+        
+        self._number_of_items = 0
+        
+        self._number_of_labels = 0
+        
+        self._cells = None
+        
+        self._log_likelihoods = []
+        
+        self._pending = []
+        
+        self.log_likelihood_function = None
+    
+    @property
+    def cells(self):
+        if self._cells is None:
+            self._cells = [self._slot_cells[slot] for slot in self._order]
+        
+        return self._cells
+    
+    @cells.setter
+    def cells(self, cells):
+        '''
+        Replace the contents of the partition with copies of cells, which may belong to another partition.
+        '''
+        cells = [(cell.value, cell.items) for cell in cells]
+        
+        log_likelihood_function = self.log_likelihood_function
+        
+        self.__init__()
+        
+        self.log_likelihood_function = log_likelihood_function
+        
+        for cell_index, (value, items) in enumerate(cells):
+            self.add_cell(value)
+            
+            for item in items:
+                self.add_item(item, cell_index)
+    
+    @property
+    def cell_values(self):
+        return [cell.value for cell in self.cells]
+    
+    @property
+    def counts(self):
+        return self._counts[self._order].tolist()
+    
+    @property
+    def item_values(self):
+        return ItemValueView(self)
+    
+    @property
+    def labels(self):
+        return LabelView(self)
+    
+    @property
+    def label_array(self):
+        '''
+        Labels of all items as a numpy array. Unassigned items are labelled -1.
+        '''
+        slots = self._slot_labels[:self._number_of_labels]
+        
+        labels = np.full(slots.shape, -1, dtype=np.int64)
+        
+        assigned = slots >= 0
+        
+        labels[assigned] = self._positions[slots[assigned]]
+        
+        return labels
+    
+    @property
+    def number_of_cells(self):
+        return len(self._order)
+    
+    @property
+    def number_of_items(self):
+        return self._number_of_items
+    
+    def add_cell(self, value):
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        
+        else:
+            slot = len(self._slot_cells)
+            
+            self._slot_cells.append(None)
+            
+            self._members.append([])
+            
+            self._log_likelihoods.append(None)
+            
+            self._pending.append({})
+            
+            if slot >= self._counts.shape[0]:
+                size = max(2 * self._counts.shape[0], 16)
+                
+                self._counts = _resize(self._counts, size, 0)
+                
+                self._positions = _resize(self._positions, size, -1)
+        
+        cell = ArrayPartitionCell(self, slot, value)
+        
+        self._slot_cells[slot] = cell
+        
+        self._clear_log_likelihood(slot)
+        
+        self._counts[slot] = 0
+        
+        self._positions[slot] = len(self._order)
+        
+        self._order.append(slot)
+        
+        self._cells = None
+        
+        return cell
+    
+    def add_item(self, item, cell_index):
+        self._add_item_to_slot(item, self._order[cell_index])
+    
+    def get_cell_by_value(self, value):
+        for cell in self.cells:
+            if cell.value == value:
+                return cell
+    
+    def remove_item(self, item, cell_index):
+        slot = self._order[cell_index]
+        
+        if item >= self._number_of_labels or self._slot_labels[item] != slot:
+            raise ValueError('Item {0} is not in cell {1}'.format(item, cell_index))
+        
+        self._remove_item_from_slot(item, slot)
+    
+    def remove_empty_cells(self):
+        if self._counts[self._order].all():
+            return
+        
+        order = []
+        
+        for slot in self._order:
+            if self._counts[slot] == 0:
+                self._positions[slot] = -1
+                
+                self._slot_cells[slot] = None
+                
+                self._free_slots.append(slot)
+            
+            else:
+                self._positions[slot] = len(order)
+                
+                order.append(slot)
+        
+        self._order = order
+        
+        self._cells = None
+    
+    def track_log_likelihoods(self, function):
+        '''
+        Keep the cached total log likelihood of each cell up to date, scoring moved items with function(items, value).
+        Passing the function which is already tracked keeps the cached totals, any other function drops them.
+        '''
+        if function is not self.log_likelihood_function:
+            self.log_likelihood_function = function
+            
+            self.reset_log_likelihoods()
+    
+    def reset_log_likelihoods(self):
+        '''
+        Drop all cached totals, for when the likelihood changes in a way the partition does not see, such as an update
+        of the global parameters of the density.
+        '''
+        for slot in range(len(self._log_likelihoods)):
+            self._clear_log_likelihood(slot)
+    
+    def copy(self):
+        partition = ArrayPartition()
+        
+        partition._slot_labels = self._slot_labels.copy()
+        
+        partition._member_index = self._member_index.copy()
+        
+        partition._counts = self._counts.copy()
+        
+        partition._positions = self._positions.copy()
+        
+        partition._members = [list(members) for members in self._members]
+        
+        partition._free_slots = list(self._free_slots)
+        
+        partition._order = list(self._order)
+        
+        partition._number_of_items = self._number_of_items
+        
+        partition._number_of_labels = self._number_of_labels
+        
+        partition._log_likelihoods = list(self._log_likelihoods)
+        
+        partition._pending = [dict(x) for x in self._pending]
+        
+        partition.log_likelihood_function = self.log_likelihood_function
+        
+        partition._slot_cells = [None] * len(self._slot_cells)
+        
+        for slot in self._order:
+            partition._slot_cells[slot] = ArrayPartitionCell(partition, slot, self._slot_cells[slot].value)
+        
+        return partition
+    
+    def _add_item_to_slot(self, item, slot):
+        if item >= self._slot_labels.shape[0]:
+            size = max(2 * self._slot_labels.shape[0], item + 1, 16)
+            
+            self._slot_labels = _resize(self._slot_labels, size, -1)
+            
+            self._member_index = _resize(self._member_index, size, -1)
+        
+        self._number_of_labels = max(self._number_of_labels, item + 1)
+        
+        if self._slot_labels[item] != -1:
+            raise ValueError('Item {0} is already in the partition'.format(item))
+        
+        members = self._members[slot]
+        
+        self._slot_labels[item] = slot
+        
+        self._member_index[item] = len(members)
+        
+        members.append(item)
+        
+        self._counts[slot] += 1
+        
+        self._number_of_items += 1
+        
+        if self._log_likelihoods[slot] is not None:
+            self._record_change(slot, item, 1)
+    
+    def _remove_item_from_slot(self, item, slot):
+        members = self._members[slot]
+        
+        index = self._member_index[item]
+        
+        # Swap the last member into the hole so the removal is O(1)
+        last_item = members.pop()
+        
+        if last_item != item:
+            members[index] = last_item
+            
+            self._member_index[last_item] = index
+        
+        self._slot_labels[item] = -1
+        
+        self._member_index[item] = -1
+        
+        self._counts[slot] -= 1
+        
+        self._number_of_items -= 1
+        
+        if self._log_likelihoods[slot] is not None:
+            self._record_change(slot, item, -1)
+    
+    def _record_change(self, slot, item, change):
+        pending = self._pending[slot]
+        
+        change += pending.get(item, 0)
+        
+        if change == 0:
+            del pending[item]
+        
+        else:
+            pending[item] = change
+    
+    def _clear_log_likelihood(self, slot):
+        self._log_likelihoods[slot] = None
+        
+        self._pending[slot] = {}
+    
+    def _set_log_likelihood(self, slot, log_likelihood):
+        self._log_likelihoods[slot] = log_likelihood
+        
+        self._pending[slot] = {}
+    
+    def _get_log_likelihood(self, slot):
+        total = self._log_likelihoods[slot]
+        
+        pending = self._pending[slot]
+        
+        if total is None or not pending:
+            return total
+        
+        # Subtracting from a total which is not finite gives nan, and once as many items have moved as the cell has
+        # members rescoring the cell is cheaper, so in both cases the total is dropped
+        if len(pending) >= self._counts[slot] or not np.all(np.isfinite(total)):
+            self._clear_log_likelihood(slot)
+            
+            return None
+        
+        function = self.log_likelihood_function
+        
+        value = self._slot_cells[slot].value
+        
+        added = [item for item, change in pending.items() if change > 0]
+        
+        removed = [item for item, change in pending.items() if change < 0]
+        
+        if added:
+            total = total + function(added, value)
+        
+        if removed:
+            total = total - function(removed, value)
+        
+        self._set_log_likelihood(slot, total)
+        
+        return total
+
+class ArrayPartitionCell(object):
+    '''
+    Cell of an ArrayPartition. Adding and removing items through the cell updates the partition.
+    '''
+    def __init__(self, partition, slot, value):
+        self._partition = partition
+        
+        self._slot = slot
+        
+        self._value = value
+    
+    @property
+    def value(self):
+        return self._value
+    
+    @value.setter
+    def value(self, value):
+        self._value = value
+        
+        self._partition._clear_log_likelihood(self._slot)
+    
+    @property
+    def log_likelihood(self):
+        '''
+        Cached total log likelihood of the members under the value, see ArrayPartition.track_log_likelihoods. None if no
+        total is cached.
+        '''
+        return self._partition._get_log_likelihood(self._slot)
+    
+    def set_value(self, value, log_likelihood=None):
+        '''
+        Set the value together with the total log likelihood of the members under it, if it is known.
+        '''
+        self._value = value
+        
+        if log_likelihood is None:
+            self._partition._clear_log_likelihood(self._slot)
+        
+        else:
+            self._partition._set_log_likelihood(self._slot, log_likelihood)
+    
+    @property
+    def empty(self):
+        if self.size == 0:
+            return True
+        else:
+            return False
+    
+    @property
+    def items(self):
+        return self._partition._members[self._slot][:]
+    
+    @property
+    def size(self):
+        return int(self._partition._counts[self._slot])
+    
+    def add_item(self, item):
+        self._partition._add_item_to_slot(item, self._slot)
+    
+    def remove_item(self, item):
+        if item not in self:
+            raise ValueError('Item {0} is not in cell'.format(item))
+        
+        self._partition._remove_item_from_slot(item, self._slot)
+    
+    def __contains__(self, x):
+        partition = self._partition
+        
+        if x < partition._number_of_labels and partition._slot_labels[x] == self._slot:
+            return True
+        else:
+            return False
+
+class LabelView(object):
+    '''
+    Read only sequence view of the labels of an ArrayPartition. Indexing is O(1).
+    '''
+    def __init__(self, partition):
+        self._partition = partition
+    
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.tolist()[item]
+        
+        slot = self._partition._slot_labels[item]
+        
+        if slot == -1:
+            return None
+        
+        return int(self._partition._positions[slot])
+    
+    def __iter__(self):
+        return iter(self.tolist())
+    
+    def __len__(self):
+        return self._partition._number_of_labels
+    
+    def tolist(self):
+        return [None if x == -1 else x for x in self._partition.label_array.tolist()]
+
+class ItemValueView(object):
+    '''
+    Read only sequence view of the cell value of each item in an ArrayPartition. Indexing is O(1). Unassigned items
+    have the value None.
+    '''
+    def __init__(self, partition):
+        self._partition = partition
+    
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.tolist()[item]
+        
+        slot = self._partition._slot_labels[item]
+        
+        if slot == -1:
+            return None
+        
+        return self._partition._slot_cells[slot].value
+    
+    def __iter__(self):
+        return iter(self.tolist())
+    
+    def __len__(self):
+        return self._partition._number_of_labels
+    
+    def tolist(self):
+        partition = self._partition
+        
+        slots = partition._slot_labels[:partition._number_of_labels].tolist()
+        
+        return [None if slot == -1 else partition._slot_cells[slot].value for slot in slots]
+
+def _resize(array, size, fill_value):
+    new_array = np.full(size, fill_value, dtype=array.dtype)
+    
+    new_array[:array.shape[0]] = array
+    
+    return new_array
@@ -0,0 +1,289 @@
+__author__ = 'mateusz'
+
+import cProfile
+import json
+import timeit
+
+try:
+    import tracemalloc
+
+except ImportError:
+    tracemalloc = None
+
+class SamplerProfiler(object):
+    '''
+    Opt-in instrumentation for DirichletProcessSampler.sample and BlockedGibbsSampler.sample.
+
+    For every iteration one JSON object is appended to log_file with the wall time of each phase of the iteration
+    (concentration, partition, atom, global_params, trace and checkpoint), the Density.log_p calls, cache hits, misses
+    and evictions and batched log_p_matrix evaluations made during the iteration, the acceptance rate of every
+    Metropolis-Hastings atom sampler, the likelihood evaluations per update of every slice atom sampler and the
+    acceptance of split-merge proposals. The densities only count while the profiler is open, so runs without it pay
+    nothing for the counters. Counters kept in worker processes, as in the 'processes' mode of MultiSampleAtomSampler,
+    are not seen.
+
+    Kwargs:
+        capture_iters : (tuple) (start, stop) range of iterations to run cProfile over. The statistics are written to
+                                capture_file and a summary is added to the log.
+
+        capture_file : (str) File for the cProfile statistics, which can be read with pstats.
+
+        trace_memory : (bool) Also trace memory allocations with tracemalloc during the capture window, and log the
+                              peak and the top allocation sites. Needs Python 3.4 or later.
+
+        memory_top : (int) Number of allocation sites to log.
+    '''
+    def __init__(self, log_file, capture_iters=None, capture_file=None, trace_memory=False, memory_top=20):
+        if trace_memory and tracemalloc is None:
+            raise ImportError('trace_memory needs the tracemalloc module, which is only available in Python 3.4+.')
+
+        if capture_iters is not None and capture_file is None:
+            raise ValueError('A capture_file is needed to write the cProfile statistics of capture_iters.')
+
+        self.log_file = log_file
+
+        self.capture_iters = capture_iters
+
+        self.capture_file = capture_file
+
+        self.trace_memory = trace_memory
+
+        self.memory_top = memory_top
+
+        self._profile = None
+
+    def open(self, sampler):
+        self.sampler = sampler
+
+        self.log = open(self.log_file, 'a')
+
+        for density in self._densities():
+            density.start_counting()
+
+        self._counters = self._read_counters()
+
+    def close(self):
+        if self._profile is not None:
+            self._stop_capture()
+
+        for density in self._densities():
+            density.stop_counting()
+
+        self.log.close()
+
+    def start_iteration(self, iteration):
+        self.iteration = iteration
+
+        self._phase_times = {}
+
+        if self.capture_iters is not None and iteration == self.capture_iters[0]:
+            self._start_capture()
+
+        self._start = timeit.default_timer()
+
+    def phase(self, name):
+        '''
+        Context manager which adds the time spent in its body to the phase name of the current iteration.
+        '''
+        return _Phase(self._phase_times, name)
+
+    def end_iteration(self):
+        total = timeit.default_timer() - self._start
+
+        counters = self._read_counters()
+
+        record = {
+                  'iteration' : self.iteration,
+                  'num_cells' : self.sampler.number_of_cells,
+                  'alpha' : self.sampler.alpha,
+                  'time' : total,
+                  'phases' : self._phase_times,
+                  'density' : _difference(counters['density'], self._counters['density']),
+                  'atom_acceptance' : _acceptance(counters['atom'], self._counters['atom']),
+                  'atom_evaluations' : _evaluations(counters['atom_evaluations'], self._counters['atom_evaluations']),
+                  'split_merge_acceptance' : _acceptance(counters['split_merge'], self._counters['split_merge'])
+                  }
+
+        self._counters = counters
+
+        self._write(record)
+
+        if self._profile is not None and self.iteration + 1 >= self.capture_iters[1]:
+            self._stop_capture()
+
+    def _densities(self):
+        densities = {}
+
+        for sampler in (self.sampler.atom_sampler, getattr(self.sampler, 'partition_sampler', None)):
+            if sampler is None:
+                continue
+
+            for density in _leaf_densities(sampler.cluster_density):
+                densities[id(density)] = density
+
+        return list(densities.values())
+
+    def _read_counters(self):
+        density_counters = {}
+
+        for density in self._densities():
+            for key, value in getattr(density, 'counters', {}).items():
+                density_counters[key] = density_counters.get(key, 0) + value
+
+        atom_sampler = self.sampler.atom_sampler
+
+        atom_samplers = getattr(atom_sampler, 'atom_samplers', {'atom_sampler' : atom_sampler})
+
+        atom_counters = {}
+
+        atom_evaluations = {}
+
+        for name, sampler in atom_samplers.items():
+            if hasattr(sampler, 'num_proposed'):
+                atom_counters[name] = (sampler.num_proposed, sampler.num_accepted)
+
+            if hasattr(sampler, 'num_evaluations'):
+                atom_evaluations[name] = (sampler.num_updates, sampler.num_evaluations)
+
+        split_merge_counters = {}
+
+        partition_sampler = getattr(self.sampler, 'partition_sampler', None)
+
+        partition_sampler = getattr(partition_sampler, 'split_merge_sampler', partition_sampler)
+
+        if hasattr(partition_sampler, 'num_proposed'):
+            split_merge_counters['split_merge'] = (partition_sampler.num_proposed, partition_sampler.num_accepted)
+
+        return {
+                'density' : density_counters,
+                'atom' : atom_counters,
+                'atom_evaluations' : atom_evaluations,
+                'split_merge' : split_merge_counters
+                }
+
+    def _start_capture(self):
+        self._profile = cProfile.Profile()
+
+        if self.trace_memory:
+            tracemalloc.start()
+
+        self._profile.enable()
+
+    def _stop_capture(self):
+        self._profile.disable()
+
+        self._profile.dump_stats(self.capture_file)
+
+        self._profile = None
+
+        record = {
+                  'capture' : {
+                               'start' : self.capture_iters[0],
+                               'stop' : self.iteration + 1,
+                               'profile_file' : self.capture_file
+                               }
+                  }
+
+        if self.trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+
+            record['capture']['memory_peak'] = tracemalloc.get_traced_memory()[1]
+
+            record['capture']['memory_top'] = [{'location' : str(x.traceback), 'size' : x.size, 'count' : x.count}
+                                               for x in snapshot.statistics('lineno')[:self.memory_top]]
+
+            tracemalloc.stop()
+
+        self._write(record)
+
+    def _write(self, record):
+        self.log.write(json.dumps(record, sort_keys=True))
+
+        self.log.write('\n')
+
+        self.log.flush()
+
+class NullProfiler(object):
+    '''
+    Profiler which records nothing, used when profiling is off.
+    '''
+    def open(self, sampler):
+        pass
+
+    def close(self):
+        pass
+
+    def start_iteration(self, iteration):
+        pass
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def end_iteration(self):
+        pass
+
+class _Phase(object):
+    def __init__(self, phase_times, name):
+        self.phase_times = phase_times
+
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.phase_times[self.name] = self.phase_times.get(self.name, 0) + timeit.default_timer() - self.start
+
+class _NullPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NULL_PHASE = _NullPhase()
+
+def _leaf_densities(density):
+    if hasattr(density, 'cluster_densities'):
+        return [x for sub_density in density.cluster_densities.values() for x in _leaf_densities(sub_density)]
+
+    return [density, ]
+
+def _difference(new, old):
+    return dict((key, value - old.get(key, 0)) for key, value in new.items())
+
+def _acceptance(new, old):
+    acceptance = {}
+
+    for name, (num_proposed, num_accepted) in new.items():
+        old_proposed, old_accepted = old.get(name, (0, 0))
+
+        proposed = num_proposed - old_proposed
+
+        accepted = num_accepted - old_accepted
+
+        acceptance[name] = {
+                            'proposed' : proposed,
+                            'accepted' : accepted,
+                            'rate' : accepted / float(proposed) if proposed > 0 else None
+                            }
+
+    return acceptance
+
+def _evaluations(new, old):
+    evaluations = {}
+
+    for name, (num_updates, num_evaluations) in new.items():
+        old_updates, old_evaluations = old.get(name, (0, 0))
+
+        updates = num_updates - old_updates
+
+        total = num_evaluations - old_evaluations
+
+        evaluations[name] = {
+                             'updates' : updates,
+                             'evaluations' : total,
+                             'per_update' : total / float(updates) if updates > 0 else None
+                             }
+
+    return evaluations
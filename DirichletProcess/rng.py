@@ -0,0 +1,126 @@
+__author__ = 'mateusz'
+
+import numpy as np
+
+class RandomStream(object):
+    '''
+    Source of random variates for the base measures and samplers.
+
+    Every object which draws random numbers takes a stream, so a run is reproducible from one seed and independent
+    streams can be spawned for chains and worker processes. Variates can be drawn one at a time or in batches with
+    the size argument, so hot loops can draw everything a sweep needs in one call.
+
+    Kwargs:
+        seed : (int or array of ints) Seed of the underlying numpy RandomState. If None it is seeded from the OS.
+    '''
+    def __init__(self, seed=None):
+        self.random_state = np.random.RandomState(seed)
+
+    def spawn(self, n):
+        '''
+        Return n new streams seeded from this one. Spawning advances this stream, so spawning twice gives different
+        streams.
+        '''
+        seeds = self.random_state.randint(0, 2 ** 31 - 1, size=(n, 4))
+
+        return [RandomStream(x) for x in seeds]
+
+    def get_state(self):
+        return self.random_state.get_state()
+
+    def set_state(self, state):
+        self.random_state.set_state(state)
+
+    def random(self, size=None):
+        '''
+        Uniform variates on [0, 1).
+        '''
+        return self.random_state.random_sample(size)
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        return self.random_state.uniform(low, high, size)
+
+    def beta(self, a, b, size=None):
+        return self.random_state.beta(a, b, size)
+
+    def gamma(self, shape, scale=1.0, size=None):
+        return self.random_state.gamma(shape, scale, size)
+
+    def binomial(self, n, p, size=None):
+        return self.random_state.binomial(n, p, size)
+
+    def randint(self, low, high, size=None):
+        '''
+        Integers in [low, high).
+        '''
+        return self.random_state.randint(low, high, size)
+
+    def shuffle(self, x):
+        '''
+        Shuffle the list x in place.
+        '''
+        self.random_state.shuffle(x)
+
+    def sample(self, population, k):
+        '''
+        List of k distinct elements chosen from population.
+        '''
+        return [population[i] for i in self.random_state.choice(len(population), k, replace=False)]
+
+    def categorical(self, p, size=None):
+        '''
+        Draw indices with probability proportional to the non-negative weights p, which need not be normalised.
+
+        If p is 2-D one index is drawn for each row and size is ignored.
+        '''
+        p = np.asarray(p, dtype=float)
+
+        if p.ndim == 2:
+            cdf = np.cumsum(p, axis=1)
+
+            u = self.random_state.uniform(0, cdf[:, -1])
+
+            return np.minimum((cdf <= u[:, np.newaxis]).sum(axis=1), p.shape[1] - 1)
+
+        if size is None:
+            return categorical_from_uniform(p, self.random_state.random_sample())
+
+        cdf = np.cumsum(p)
+
+        u = self.random_state.uniform(0, cdf[-1], size)
+
+        return np.minimum(np.searchsorted(cdf, u, side='right'), len(p) - 1)
+
+    def log_categorical(self, log_p, size=None):
+        '''
+        As categorical with the weights given on the log scale.
+        '''
+        log_p = np.asarray(log_p, dtype=float)
+
+        return self.categorical(np.exp(log_p - np.max(log_p, axis=-1)[..., np.newaxis]), size)
+
+def categorical_from_uniform(p, u):
+    '''
+    Index selected from the non-negative weights p by the uniform [0, 1) variate u. This lets a loop draw all its
+    uniforms in one batch up front.
+    '''
+    cdf = np.cumsum(p)
+
+    return min(int(np.searchsorted(cdf, u * cdf[-1], side='right')), len(cdf) - 1)
+
+_default_stream = RandomStream()
+
+def get_stream(rng=None):
+    '''
+    Return rng, or the stream shared by all objects created without one if rng is None.
+    '''
+    if rng is None:
+        return _default_stream
+
+    return rng
+
+def seed(seed):
+    '''
+    Reseed the default stream.
+    '''
+    _default_stream.random_state.seed(seed)
@@ -1,25 +1,48 @@
 __author__ = 'mateusz'
 
-from math import log
-from random import uniform
+from math import exp, log
 from collections import OrderedDict
+from multiprocessing import Pipe, Process
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from ..densities import PackedData
+from ..grid import PrevalenceGrid
+from ..measures import BetaData
 from ..partition import PartitionCell
+from ..rng import get_stream
 
 class AtomSampler(object):
     '''
     Base class for samplers to update the cell values in the partition (atoms of DP).
+
+    Samplers which can use the total log likelihood of each cell under its current value set caches_log_likelihoods and
+    implement sample_values_incremental. sample() then has the partition cache the totals, so they are only rescored
+    for the items which moved since the last update.
     '''
-    def __init__(self, base_measure, cluster_density):
+    caches_log_likelihoods = False
+
+    def __init__(self, base_measure, cluster_density, rng=None):
         '''
         Args:
             base_measure : (BaseMeasure) Base measure for DP process.
 
             cluster_density : (Density) Cluster density for DP process.
+
+        Kwargs:
+            rng : (RandomStream) Stream to draw from. Defaults to the shared default stream.
         '''
         self.base_measure = base_measure
 
         self.cluster_density = cluster_density
 
+        self.rng = get_stream(rng)
+
+        self._data = None
+
+        self._log_likelihood_data = None
+
     def sample(self, data, partition):
         '''
         Sample a new value for atoms in the partition. The partition passed in will be updated in place.
@@ -29,8 +52,29 @@ class AtomSampler(object):
 
             partition : (Partition) Partition of dp.
         '''
-        for cell in partition.cells:
-            cell.value = self.sample_atom(data, cell)
+        cells = partition.cells
+
+        values = [cell.value for cell in cells]
+
+        items = [cell.items for cell in cells]
+
+        if self.caches_log_likelihoods and hasattr(partition, 'track_log_likelihoods'):
+            partition.track_log_likelihoods(self._log_likelihood_function(data))
+
+            new_values, log_likelihoods = self.sample_values_incremental(data,
+                                                                         values,
+                                                                         items,
+                                                                         [cell.log_likelihood for cell in cells])
+
+            for cell, value, log_likelihood in zip(cells, new_values, log_likelihoods):
+                cell.set_value(value, log_likelihood)
+
+            return
+
+        new_values = self.sample_values(data, values, items)
+
+        for cell, value in zip(cells, new_values):
+            cell.value = value
 
     def sample_atom(self, data, cell):
         '''
@@ -38,48 +82,153 @@ class AtomSampler(object):
         '''
         raise NotImplemented
 
+    def sample_values(self, data, values, items):
+        '''
+        Sample new values for several cells which are given by their current values and lists of items, without
+        needing Partition objects. Returns a list of new values.
+        '''
+        new_values = []
+
+        for value, cell_items in zip(values, items):
+            cell = PartitionCell(value)
+
+            cell._items = cell_items
+
+            new_values.append(self.sample_atom(data, cell))
+
+        return new_values
+
+    def sample_values_incremental(self, data, values, items, log_likelihoods):
+        '''
+        As sample_values, given the total log likelihood of each cell under its current value. Returns the new values
+        and their totals, with None for totals which are not known.
+        '''
+        return self.sample_values(data, values, items), [None] * len(values)
+
+    def _log_likelihood_function(self, data):
+        '''
+        Return a function of (items, value) giving the total log likelihood of the items under value, for
+        Partition.track_log_likelihoods. The same function is returned until data changes.
+        '''
+        if data is not self._log_likelihood_data:
+            self._log_likelihood_data = data
+
+            def log_likelihood(items, value):
+                if not items:
+                    return 0.0
+
+                return float(self.cluster_density.log_p_matrix(self._pack(data), [value], items=items).sum())
+
+            self._log_likelihood_function_cache = log_likelihood
+
+        return self._log_likelihood_function_cache
+
+    def _pack(self, data):
+        '''
+        Return the packed form of data for cluster_density.log_p_matrix. The result is cached until data changes.
+        '''
+        if data is not self._data:
+            self._data = data
+
+            self._packed_data = self.cluster_density.pack(data)
+
+        return self._packed_data
+
 
 class MetropolisHastingsAtomSampler(AtomSampler):
     '''
     Update the atom values using a Metropolis-Hastings steps with a user specified proposal function which takes
     the previous cell value as an argument.
+
+    sample_values draws the proposals and acceptance uniforms of all cells in one batch before scoring them. When the
+    total log likelihood of a cell under its current value is known only the proposal is scored.
     '''
-    def __init__(self, base_measure, cluster_density, proposal_func):
-        AtomSampler.__init__(self, base_measure, cluster_density)
+    caches_log_likelihoods = True
+
+    def __init__(self, base_measure, cluster_density, proposal_func, rng=None):
+        AtomSampler.__init__(self, base_measure, cluster_density, rng=rng)
 
         self.proposal_func = proposal_func
 
+        self.num_proposed = 0
+
+        self.num_accepted = 0
+
     def sample_atom(self, data, cell):
         old_param = cell.value
         new_param = self.proposal_func.random(old_param)
 
-        old_ll = self.base_measure.log_p(old_param)
-        new_ll = self.base_measure.log_p(new_param)
+        return self._metropolis_step(data, old_param, new_param, cell.items, self.rng.random())[0]
+
+    def sample_values(self, data, values, items):
+        return self.sample_values_incremental(data, values, items, [None] * len(values))[0]
+
+    def sample_values_incremental(self, data, values, items, log_likelihoods):
+        proposals = self._propose(values)
+
+        uniforms = self.rng.random(len(values))
+
+        steps = [self._metropolis_step(data, old_param, new_param, cell_items, u, old_cluster_log_p)
+                 for old_param, new_param, cell_items, u, old_cluster_log_p in
+                 zip(values, proposals, items, uniforms, log_likelihoods)]
+
+        return [x[0] for x in steps], [x[1] for x in steps]
+
+    def _propose(self, values):
+        return [self.proposal_func.random(x) for x in values]
+
+    def _metropolis_step(self, data, old_param, new_param, items, u, old_cluster_log_p=None):
+        '''
+        Accept or reject new_param using the uniform variate u.
+
+        Kwargs:
+            old_cluster_log_p : (float) Total log likelihood of the items under old_param. Computed if None.
+
+        Returns:
+            param : The accepted parameter.
+
+            cluster_log_p : (float) Total log likelihood of the items under param.
+        '''
+        if old_cluster_log_p is None:
+            cluster_log_p = self.cluster_density.log_p_matrix(self._pack(data), [old_param, new_param], items=items)
+
+            old_cluster_log_p = float(cluster_log_p[:, 0].sum())
+
+            new_cluster_log_p = float(cluster_log_p[:, 1].sum())
+
+        else:
+            cluster_log_p = self.cluster_density.log_p_matrix(self._pack(data), [new_param], items=items)
+
+            new_cluster_log_p = float(cluster_log_p.sum())
 
-        for j in cell.items:
-            old_ll += self.cluster_density.log_p(data[j], old_param)
-            new_ll += self.cluster_density.log_p(data[j], new_param)
+        old_ll = self.base_measure.log_p(old_param) + old_cluster_log_p
+        new_ll = self.base_measure.log_p(new_param) + new_cluster_log_p
 
         forward_log_ratio = new_ll - self.proposal_func.log_p(new_param, old_param)
         reverse_log_ratio = old_ll - self.proposal_func.log_p(old_param, new_param)
 
         log_ratio = forward_log_ratio - reverse_log_ratio
 
-        u = uniform(0, 1)
+        self.num_proposed += 1
 
         if log_ratio >= log(u):
-            return new_param
+            self.num_accepted += 1
+
+            return new_param, new_cluster_log_p
         else:
-            return old_param
+            return old_param, old_cluster_log_p
 
 class BaseMeasureAtomSampler(MetropolisHastingsAtomSampler):
     '''
     Update the atom values using a Metropolis-Hastings steps with the base measure as a proposal density.
     '''
-    def __init__(self, base_measure, cluster_density):
+    def __init__(self, base_measure, cluster_density, rng=None):
         proposal_func = BaseMeasureProposalFunction(base_measure)
 
-        MetropolisHastingsAtomSampler.__init__(self, base_measure, cluster_density, proposal_func)
+        MetropolisHastingsAtomSampler.__init__(self, base_measure, cluster_density, proposal_func, rng=rng)
+
+    def _propose(self, values):
+        return self.base_measure.random_batch(len(values))
 
 class BaseMeasureProposalFunction(object):
     def __init__(self, base_measure):
@@ -91,23 +240,575 @@ class BaseMeasureProposalFunction(object):
     def random(self, params):
         return self.base_measure.random()
 
+class SliceAtomSampler(AtomSampler):
+    '''
+    Slice sampling update for scalar atoms in (0, 1), such as the cellular prevalences drawn from a BetaBaseMeasure.
+
+    The atom is moved on the logit scale with the stepping out and shrinkage procedures of Neal (2003), so every update
+    moves and no proposal is wasted on tightly constrained cells. Each evaluation of the conditional is one pass over
+    the items of the cell.
+
+    During the first adapt_iters calls of sample_values the bracket width of each cell is adapted from the number of
+    step outs and shrinks of its update, growing when the bracket had to be stepped out and shrinking when it had to be
+    shrunk. Widths are kept per cell, keyed by the current atom value, and new cells start from the geometric mean of
+    the adapted widths. After adaptation the widths are fixed, so the chain is a valid slice sampler.
+
+    num_updates and num_evaluations count the updates and the likelihood evaluations made so far, and evaluations holds
+    the number of likelihood evaluations of each cell in the last call of sample_values.
+
+    Kwargs:
+        width : (float) Initial bracket width on the logit scale.
+
+        max_steps : (int) Largest number of step outs of the bracket in one update.
+
+        adapt_iters : (int) Number of calls of sample_values during which the widths are adapted, typically the burnin.
+
+        adapt_rate : (float) Step size of the adaptation on the log scale.
+    '''
+    def __init__(self, base_measure, cluster_density, width=1.0, max_steps=32, adapt_iters=0, adapt_rate=0.5,
+                 rng=None):
+        AtomSampler.__init__(self, base_measure, cluster_density, rng=rng)
+
+        self.width = width
+
+        self.max_steps = max_steps
+
+        self.adapt_iters = adapt_iters
+
+        self.adapt_rate = adapt_rate
+
+        self.num_iters = 0
+
+        self.num_updates = 0
+
+        self.num_evaluations = 0
+
+        self.evaluations = []
+
+        self._widths = {}
+
+    def get_state(self):
+        return {'width' : self.width, 'num_iters' : self.num_iters, 'widths' : dict(self._widths)}
+
+    def set_state(self, state):
+        self.width = state['width']
+
+        self.num_iters = state['num_iters']
+
+        self._widths = dict(state['widths'])
+
+    def sample_atom(self, data, cell):
+        new_value, _ = self._slice_step(data, cell.value, cell.items, self._widths.get(cell.value, self.width))
+
+        return new_value
+
+    def sample_values(self, data, values, items):
+        adapt = self.num_iters < self.adapt_iters
+
+        new_values = []
+
+        widths = {}
+
+        self.evaluations = []
+
+        for value, cell_items in zip(values, items):
+            width = self._widths.get(value, self.width)
+
+            num_evaluations = self.num_evaluations
+
+            new_value, (num_expansions, num_shrinks) = self._slice_step(data, value, cell_items, width)
+
+            if adapt and num_expansions + num_shrinks > 0:
+                width *= np.exp(self.adapt_rate * (num_expansions - num_shrinks) / float(num_expansions + num_shrinks))
+
+            widths[new_value] = width
+
+            new_values.append(new_value)
+
+            self.evaluations.append(self.num_evaluations - num_evaluations)
+
+        if adapt and widths:
+            self.width = float(np.exp(np.mean(np.log(list(widths.values())))))
+
+        self._widths = widths
+
+        self.num_iters += 1
+
+        return new_values
+
+    def _slice_step(self, data, value, items, width):
+        '''
+        One slice sampling update of value on the logit scale. Returns the new value and the number of step outs and
+        shrinks made.
+        '''
+        rng = self.rng
+
+        y = _logit(value.x)
+
+        log_level = self._log_target(data, y, items) + log(rng.random())
+
+        left = y - width * rng.random()
+
+        right = left + width
+
+        num_left = int(self.max_steps * rng.random())
+
+        num_right = self.max_steps - 1 - num_left
+
+        num_expansions = 0
+
+        while num_left > 0 and self._log_target(data, left, items) > log_level:
+            left -= width
+
+            num_left -= 1
+
+            num_expansions += 1
+
+        while num_right > 0 and self._log_target(data, right, items) > log_level:
+            right += width
+
+            num_right -= 1
+
+            num_expansions += 1
+
+        num_shrinks = 0
+
+        while True:
+            new_y = left + (right - left) * rng.random()
+
+            if self._log_target(data, new_y, items) > log_level:
+                break
+
+            if new_y < y:
+                left = new_y
+
+            else:
+                right = new_y
+
+            num_shrinks += 1
+
+        self.num_updates += 1
+
+        return BetaData(_logistic(new_y)), (num_expansions, num_shrinks)
+
+    def _log_target(self, data, y, items):
+        '''
+        Log conditional density of the atom at logit(x) = y, including the Jacobian of the logit transform.
+        '''
+        x = _logistic(y)
+
+        if x <= 0 or x >= 1:
+            return float('-inf')
+
+        self.num_evaluations += 1
+
+        param = BetaData(x)
+
+        log_p = self.cluster_density.log_p_matrix(self._pack(data), [param, ], items=items).sum()
+
+        return log_p + self.base_measure.log_p(param) + log(x) + log(1 - x)
+
+def _logit(x):
+    return log(x) - log(1 - x)
+
+def _logistic(y):
+    if y >= 0:
+        return 1 / (1 + exp(-y))
+
+    z = exp(y)
+
+    return z / (1 + z)
+
+
+class GridAtomSampler(AtomSampler):
+    '''
+    Griddy Gibbs update for scalar atoms in [0, 1] with a Beta base measure.
+
+    The log likelihood of every data point at every grid point is computed once and cached. The conditional of a cell's
+    atom on the grid is then the base measure plus the sum of its members' rows of the table, and a new value is drawn
+    from it exactly, so every update is accepted. The table takes len(data) x grid_size floats of memory.
+    '''
+    def __init__(self, base_measure, cluster_density, grid_size=1001, rng=None):
+        AtomSampler.__init__(self, base_measure, cluster_density, rng=rng)
+
+        self.grid = PrevalenceGrid(grid_size)
+
+        self.log_prior = self.grid.log_prior(base_measure)
+
+        self._table_data = None
+
+    def sample_atom(self, data, cell):
+        log_p = self.log_prior + self._log_likelihood_table(data)[cell.items].sum(axis=0)
+
+        return BetaData(self.grid.points[self.grid.random_index(log_p, self.rng)])
+
+    def sample_values(self, data, values, items):
+        if len(items) == 0:
+            return []
+
+        table = self._log_likelihood_table(data)
+
+        log_p = np.array([self.log_prior + table[cell_items].sum(axis=0) for cell_items in items])
+
+        return [BetaData(x) for x in self.grid.points[self.grid.random_indices(log_p, self.rng)].tolist()]
+
+    def _log_likelihood_table(self, data):
+        if data is not self._table_data:
+            self._table_data = data
+
+            self._table = self.grid.log_likelihood_table(self.cluster_density, self._pack(data))
+
+        return self._table
 
 class MultiSampleAtomSampler(AtomSampler):
-    def __init__(self, base_measure, cluster_density, atom_samplers):
-        AtomSampler.__init__(self, base_measure, cluster_density)
+    '''
+    Update the atoms of a model with one atom per sample using a separate atom sampler for each sample.
+
+    The atoms of different samples are conditionally independent given the partition, so each sample's sampler is run
+    over all cells in one go, against a sample major view of the data which is built once.
+
+    Kwargs:
+        mode : (str) How to run the per sample updates.
+                     - 'serial' runs the samples one after another.
+                     - 'vectorised' updates all samples with one array operation per cell. Every sampler must be a
+                       GridAtomSampler and all grids must have the same size.
+                     - 'threads' runs the samples in a thread pool. This helps when the samplers spend their time in
+                       numpy, but the order of the random draws and so the results are not reproducible.
+                     - 'processes' splits the samples between worker processes which keep their own copy of the
+                       samplers and data. Call close() to shut the workers down.
+
+        num_workers : (int) Size of the pool for 'threads' and 'processes'. Defaults to the number of samples.
+
+        rng : (RandomStream) Stream to draw from. In 'processes' mode each worker reseeds this stream with one spawned
+                             from it, so the per sample samplers should share it.
+    '''
+    def __init__(self, base_measure, cluster_density, atom_samplers, mode='serial', num_workers=None, rng=None):
+        AtomSampler.__init__(self, base_measure, cluster_density, rng=rng)
 
         self.atom_samplers = atom_samplers
 
+        if mode not in ('serial', 'vectorised', 'threads', 'processes'):
+            raise ValueError('{0} is not a valid mode. Use serial, vectorised, threads or processes.'.format(mode))
+
+        if mode == 'vectorised':
+            if not all(isinstance(x, GridAtomSampler) for x in atom_samplers.values()) or \
+               len(set(x.grid.size for x in atom_samplers.values())) > 1:
+                raise ValueError('Vectorised mode needs a GridAtomSampler with the same grid size for every sample.')
+
+        self.mode = mode
+
+        if num_workers is None:
+            num_workers = len(atom_samplers)
+
+        self.num_workers = num_workers
+
+        self._sample_data_source = None
+
+        self._pool = None
+
+    def close(self):
+        '''
+        Shut down the thread or process pool, if one was started.
+        '''
+        if self._pool is not None:
+            self._pool.close()
+
+            self._pool = None
+
+    def get_state(self):
+        '''
+        State of the per sample samplers which define get_state(). In 'processes' mode the workers hold their own copies
+        of the samplers, so their state is not seen.
+        '''
+        return dict((sample_id, x.get_state()) for sample_id, x in self.atom_samplers.items() if hasattr(x, 'get_state'))
+
+    def set_state(self, state):
+        for sample_id, sample_state in state.items():
+            self.atom_samplers[sample_id].set_state(sample_state)
+
+    @property
+    def caches_log_likelihoods(self):
+        '''
+        Per sample totals are only passed on in the serial and threads modes, where the per sample samplers run in this
+        process.
+        '''
+        return self.mode in ('serial', 'threads') and all(x.caches_log_likelihoods for x in self.atom_samplers.values())
+
+    def sample_values(self, data, values, items):
+        if self.mode in ('serial', 'threads'):
+            return self._sample_values_per_sample(data, values, items, [None] * len(values))[0]
+
+        sample_values = OrderedDict()
+
+        for sample_id in self.atom_samplers:
+            sample_values[sample_id] = [value[sample_id] for value in values]
+
+        sample_data = self._get_sample_data(data)
+
+        if self.mode == 'vectorised':
+            new_values = self._sample_values_vectorised(sample_data, items)
+
+        else:
+            new_values = self._get_pool(sample_data).sample_values(sample_values, items)
+
+        return self._join_atoms(new_values, len(values))
+
+    def sample_values_incremental(self, data, values, items, log_likelihoods):
+        '''
+        The totals are arrays with one entry per sample, as returned by the function of _log_likelihood_function.
+        '''
+        if self.mode in ('serial', 'threads'):
+            return self._sample_values_per_sample(data, values, items, log_likelihoods)
+
+        return AtomSampler.sample_values_incremental(self, data, values, items, log_likelihoods)
+
     def sample_atom(self, data, cell):
+        sample_data = self._get_sample_data(data)
+
         new_atom = OrderedDict()
 
         for sample_id in self.atom_samplers:
-            sample_data = [x[sample_id] for x in data]
-
             sample_cell = PartitionCell(cell.value[sample_id])
 
-            sample_cell._items = cell._items
+            sample_cell._items = cell.items
+
+            new_atom[sample_id] = self.atom_samplers[sample_id].sample_atom(sample_data[sample_id], sample_cell)
+
+        return new_atom
+
+    def _sample_values_per_sample(self, data, values, items, log_likelihoods):
+        sample_values = OrderedDict()
+
+        sample_log_likelihoods = OrderedDict()
+
+        for s, sample_id in enumerate(self.atom_samplers):
+            sample_values[sample_id] = [value[sample_id] for value in values]
+
+            sample_log_likelihoods[sample_id] = [None if x is None else x[s] for x in log_likelihoods]
+
+        sample_data = self._get_sample_data(data)
+
+        if self.mode == 'serial':
+            results = OrderedDict()
+
+            for sample_id, sampler in self.atom_samplers.items():
+                results[sample_id] = sampler.sample_values_incremental(sample_data[sample_id],
+                                                                       sample_values[sample_id],
+                                                                       items,
+                                                                       sample_log_likelihoods[sample_id])
+
+        else:
+            results = self._get_pool(sample_data).sample_values_incremental(sample_values,
+                                                                            items,
+                                                                            sample_log_likelihoods)
+
+        new_log_likelihoods = []
+
+        for k in range(len(values)):
+            totals = [results[sample_id][1][k] for sample_id in results]
+
+            if any(x is None for x in totals):
+                new_log_likelihoods.append(None)
+
+            else:
+                new_log_likelihoods.append(np.array(totals))
+
+        new_values = OrderedDict((sample_id, result[0]) for sample_id, result in results.items())
+
+        return self._join_atoms(new_values, len(values)), new_log_likelihoods
+
+    def _join_atoms(self, new_values, num_atoms):
+        new_atoms = []
+
+        for k in range(num_atoms):
+            new_atom = OrderedDict()
+
+            for sample_id in self.atom_samplers:
+                new_atom[sample_id] = new_values[sample_id][k]
+
+            new_atoms.append(new_atom)
+
+        return new_atoms
+
+    def _log_likelihood_function(self, data):
+        '''
+        Per sample version of AtomSampler._log_likelihood_function, which returns an array of the total of each sample.
+        '''
+        if data is not self._log_likelihood_data:
+            self._log_likelihood_data = data
+
+            sample_data = self._get_sample_data(data)
+
+            functions = [(sample_id, x._log_likelihood_function(sample_data[sample_id]))
+                         for sample_id, x in self.atom_samplers.items()]
+
+            def log_likelihood(items, value):
+                return np.array([function(items, value[sample_id]) for sample_id, function in functions])
+
+            self._log_likelihood_function_cache = log_likelihood
+
+        return self._log_likelihood_function_cache
+
+    def _get_pool(self, sample_data):
+        if self._pool is None:
+            if self.mode == 'threads':
+                self._pool = _SampleThreadPool(self.atom_samplers, sample_data, self.num_workers)
+
+            else:
+                self._pool = _SampleProcessPool(self.atom_samplers, sample_data, self.num_workers, self.rng)
+
+        return self._pool
+
+    def _get_sample_data(self, data):
+        '''
+        Return a dict of per sample data lists. The same lists are reused until data changes, so the per sample
+        samplers can cache anything they compute from them.
+        '''
+        if data is not self._sample_data_source:
+            self._sample_data_source = data
+
+            self._sample_data = OrderedDict()
+
+            for sample_id in self.atom_samplers:
+                if isinstance(data, PackedData):
+                    self._sample_data[sample_id] = data.sample(sample_id)
+
+                else:
+                    self._sample_data[sample_id] = [x[sample_id] for x in data]
+
+            self._tables = None
+
+            self.close()
+
+        return self._sample_data
+
+    def _sample_values_vectorised(self, sample_data, items):
+        samplers = list(self.atom_samplers.values())
+
+        if self._tables is None:
+            # Stack the tables once and hand each sampler a view so they are not stored twice
+            tables = [x._log_likelihood_table(sample_data[sample_id]) for sample_id, x in self.atom_samplers.items()]
+
+            self._tables = np.array(tables)
+
+            for sampler, table in zip(samplers, self._tables):
+                sampler._table = table
+
+            self._log_prior = np.array([x.log_prior for x in samplers])
+
+        grid = samplers[0].grid
+
+        new_values = OrderedDict((sample_id, []) for sample_id in self.atom_samplers)
+
+        for cell_items in items:
+            log_p = self._log_prior + self._tables[:, cell_items, :].sum(axis=1)
+
+            for sample_id, index in zip(new_values, grid.random_indices(log_p, self.rng)):
+                new_values[sample_id].append(BetaData(grid.points[index]))
+
+        return new_values
+
+class _SampleThreadPool(object):
+    def __init__(self, atom_samplers, sample_data, num_workers):
+        self.atom_samplers = atom_samplers
+
+        self.sample_data = sample_data
+
+        self.pool = ThreadPool(num_workers)
+
+    def close(self):
+        self.pool.close()
+
+        self.pool.join()
+
+    def sample_values_incremental(self, values, items, log_likelihoods):
+        def sample_values(sample_id):
+            return self.atom_samplers[sample_id].sample_values_incremental(self.sample_data[sample_id],
+                                                                           values[sample_id],
+                                                                           items,
+                                                                           log_likelihoods[sample_id])
+
+        sample_ids = list(self.atom_samplers.keys())
+
+        return OrderedDict(zip(sample_ids, self.pool.map(sample_values, sample_ids)))
+
+class _SampleProcessPool(object):
+    '''
+    Fixed assignment of samples to worker processes. Each worker keeps the samplers and data of its samples for the
+    lifetime of the pool, so caches such as likelihood tables are built once per sample. Each worker sets the state of
+    its copy of rng from a stream spawned from rng in the parent, so the workers draw independent variates.
+    '''
+    def __init__(self, atom_samplers, sample_data, num_workers, rng):
+        sample_ids = list(atom_samplers.keys())
+
+        num_workers = max(1, min(num_workers, len(sample_ids)))
+
+        self.connections = []
+
+        self.processes = []
+
+        worker_streams = rng.spawn(num_workers)
+
+        for w in range(num_workers):
+            worker_sample_ids = sample_ids[w::num_workers]
+
+            worker_samplers = OrderedDict((x, atom_samplers[x]) for x in worker_sample_ids)
+
+            worker_data = OrderedDict((x, sample_data[x]) for x in worker_sample_ids)
+
+            parent_connection, child_connection = Pipe()
+
+            process = Process(target=_sample_values_worker,
+                              args=(child_connection, worker_samplers, worker_data, rng, worker_streams[w].get_state()))
+
+            process.daemon = True
+
+            process.start()
+
+            self.connections.append((worker_sample_ids, parent_connection))
+
+            self.processes.append(process)
+
+        self.sample_ids = sample_ids
+
+    def close(self):
+        for _, connection in self.connections:
+            connection.send(None)
+
+            connection.close()
+
+        for process in self.processes:
+            process.join()
+
+    def sample_values(self, values, items):
+        for worker_sample_ids, connection in self.connections:
+            connection.send((OrderedDict((x, values[x]) for x in worker_sample_ids), items))
+
+        new_values = {}
+
+        for _, connection in self.connections:
+            new_values.update(connection.recv())
+
+        return OrderedDict((x, new_values[x]) for x in self.sample_ids)
+
+def _sample_values_worker(connection, atom_samplers, sample_data, rng, rng_state):
+    rng.set_state(rng_state)
+
+    while True:
+        message = connection.recv()
+
+        if message is None:
+            break
+
+        values, items = message
+
+        new_values = {}
+
+        for sample_id in values:
+            new_values[sample_id] = atom_samplers[sample_id].sample_values(sample_data[sample_id],
+                                                                           values[sample_id],
+                                                                           items)
 
-            new_atom[sample_id] = self.atom_samplers[sample_id].sample_atom(sample_data, sample_cell)
+        connection.send(new_values)
 
-        return new_atom
\ No newline at end of file
+    connection.close()
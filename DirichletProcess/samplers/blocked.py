@@ -0,0 +1,241 @@
+__author__ = 'mateusz'
+
+import numpy as np
+
+from ..profiling import NullProfiler
+from ..rng import get_stream
+from .dp import MarkovChainSampler, read_checkpoint, write_checkpoint
+
+class BlockedGibbsSampler(MarkovChainSampler):
+    '''
+    Blocked Gibbs sampler for a DP mixture under the truncated stick-breaking representation of Ishwaran and James
+    (2001), used in place of DirichletProcessSampler.
+
+    The DP is truncated to a fixed number of components with weights w_k = v_k * prod_{j < k} (1 - v_j) and atoms drawn
+    from the base measure. Given the weights and atoms the assignments of all data points are independent, so a sweep
+    is one len(data) x truncation matrix from cluster_density.log_p_matrix and a batched categorical draw, with no
+    Python loop over the data points. The atoms of occupied components are then updated with atom_sampler, the atoms of
+    empty components are drawn from the base measure, the sticks are drawn from their Beta conditionals, and alpha,
+    if it has a Gamma prior, from its Gamma conditional.
+
+    The state passed to the trace has the same form as that of DirichletProcessSampler, with the occupied components
+    numbered in order of their index, so the traces and their post-processing are the same. The chain is run with the
+    sample() method shared with DirichletProcessSampler, which takes the same arguments.
+
+    Args:
+        atom_sampler : (AtomSampler) Sampler for the atoms of the occupied components. Its sample_values is called with
+                                     the members of each component.
+
+        base_measure : (BaseMeasure) Base measure of the DP. Must define random_batch.
+
+        cluster_density : (Density) Cluster density of the DP.
+
+    Kwargs:
+        alpha : (float) Initial value of the concentration parameter.
+
+        alpha_priors : (dict) Shape and rate of the Gamma prior on alpha. If None alpha is fixed.
+
+        truncation : (int) Number of components. It should be well above the expected number of clusters, since the
+                           last component takes all the remaining weight.
+
+        rng : (RandomStream) Stream used for the assignments, sticks, empty atoms and alpha. Its state is saved in
+                             checkpoints, so atom_sampler and base_measure should be built with the same stream.
+    '''
+    def __init__(self, atom_sampler, base_measure, cluster_density, alpha=1.0, alpha_priors=None, truncation=50,
+                 rng=None):
+        self.atom_sampler = atom_sampler
+
+        self.base_measure = base_measure
+
+        self.cluster_density = cluster_density
+
+        self.alpha = alpha
+
+        self.alpha_priors = alpha_priors
+
+        self.update_alpha = alpha_priors is not None
+
+        self.truncation = truncation
+
+        self.rng = get_stream(rng)
+
+        self.num_iters = 0
+
+        self._data = None
+
+    @property
+    def state(self):
+        _, labels = np.unique(self.labels, return_inverse=True)
+
+        return {
+                'alpha' : self.alpha,
+                'labels' : labels.tolist(),
+                'params' : [self.atoms[k] for k in self.labels.tolist()],
+                'global_params' : self.cluster_density.params
+                }
+
+    @property
+    def number_of_cells(self):
+        return len(np.unique(self.labels))
+
+    def close(self):
+        '''
+        Shut down any worker pools started by the atom sampler.
+        '''
+        if hasattr(self.atom_sampler, 'close'):
+            self.atom_sampler.close()
+
+    @property
+    def weights(self):
+        '''
+        Component weights implied by the sticks.
+        '''
+        return np.exp(self._log_weights())
+
+    def save_checkpoint(self, file_name, trace_state=None):
+        '''
+        Write everything needed to continue the run to file_name, see DirichletProcessSampler.save_checkpoint.
+        '''
+        checkpoint = {
+                      'alpha' : self.alpha,
+                      'num_iters' : self.num_iters,
+                      'labels' : self.labels,
+                      'atoms' : self.atoms,
+                      'sticks' : self.sticks,
+                      'sampler_states' : {},
+                      'rng_state' : self.rng.get_state(),
+                      'trace_state' : trace_state
+                      }
+
+        if hasattr(self.atom_sampler, 'get_state'):
+            checkpoint['sampler_states']['atom_sampler'] = self.atom_sampler.get_state()
+
+        write_checkpoint(file_name, checkpoint)
+
+    def load_checkpoint(self, file_name):
+        '''
+        Restore the state written by save_checkpoint. Call sample() with resume=True afterwards to continue the run.
+
+        Returns:
+            trace_state : The trace_state passed to save_checkpoint, to reopen the trace with.
+        '''
+        checkpoint = read_checkpoint(file_name)
+
+        self.alpha = checkpoint['alpha']
+
+        self.num_iters = checkpoint['num_iters']
+
+        self.labels = checkpoint['labels']
+
+        self.atoms = checkpoint['atoms']
+
+        self.sticks = checkpoint['sticks']
+
+        if 'atom_sampler' in checkpoint['sampler_states']:
+            self.atom_sampler.set_state(checkpoint['sampler_states']['atom_sampler'])
+
+        self.rng.set_state(checkpoint['rng_state'])
+
+        return checkpoint['trace_state']
+
+    def initialise_partition(self, data, init_method):
+        '''
+        Draw the atoms from the base measure and the sticks from their prior.
+
+        Args:
+            data : (list) Data points.
+
+            init_method : (str) 'together' puts all data points in the first component. Any other value, such as
+                                'separate', draws the assignments of the data points from the prior weights, which is
+                                the closest a truncated model gets to a separate cluster for each point.
+        '''
+        self.atoms = self.base_measure.random_batch(self.truncation)
+
+        self.sticks = self.rng.beta(1, self.alpha, size=self.truncation)
+
+        self.sticks[-1] = 1
+
+        if init_method == 'together':
+            self.labels = np.zeros(len(data), dtype=np.int64)
+
+        else:
+            self.labels = np.asarray(self.rng.categorical(self.weights, size=len(data)), dtype=np.int64)
+
+    def interactive_sample(self, data, profiler=None):
+        if profiler is None:
+            profiler = NullProfiler()
+
+        with profiler.phase('partition'):
+            self._sample_labels(data)
+
+        with profiler.phase('atom'):
+            self._sample_atoms(data)
+
+        with profiler.phase('partition'):
+            self._sample_sticks()
+
+        if self.update_alpha:
+            with profiler.phase('concentration'):
+                self._sample_alpha()
+
+    def _sample_labels(self, data):
+        log_p = self.cluster_density.log_p_matrix(self._pack(data), self.atoms) + self._log_weights()
+
+        self.labels = np.asarray(self.rng.log_categorical(log_p), dtype=np.int64)
+
+    def _sample_atoms(self, data):
+        order = np.argsort(self.labels, kind='mergesort')
+
+        counts = np.bincount(self.labels, minlength=self.truncation)
+
+        members = np.split(order, np.cumsum(counts)[:-1])
+
+        occupied = np.flatnonzero(counts).tolist()
+
+        new_values = self.atom_sampler.sample_values(data,
+                                                     [self.atoms[k] for k in occupied],
+                                                     [members[k].tolist() for k in occupied])
+
+        atoms = self.base_measure.random_batch(self.truncation)
+
+        for k, value in zip(occupied, new_values):
+            atoms[k] = value
+
+        self.atoms = atoms
+
+    def _sample_sticks(self):
+        counts = np.bincount(self.labels, minlength=self.truncation).astype(float)
+
+        # Number of data points in the components after each one
+        tail_counts = counts[::-1].cumsum()[::-1] - counts
+
+        self.sticks = self.rng.beta(1 + counts, self.alpha + tail_counts)
+
+        self.sticks[-1] = 1
+
+    def _sample_alpha(self):
+        # Given the sticks alpha has a Gamma(a + K - 1, b - sum_k log(1 - v_k)) conditional, with the sum over all but
+        # the last stick
+        log_one_minus_v = np.log1p(-np.minimum(self.sticks[:-1], 1 - 1e-12))
+
+        shape = self.alpha_priors['shape'] + self.truncation - 1
+
+        rate = self.alpha_priors['rate'] - log_one_minus_v.sum()
+
+        self.alpha = float(self.rng.gamma(shape, 1 / rate))
+
+    def _log_weights(self):
+        with np.errstate(divide='ignore'):
+            log_v = np.log(self.sticks)
+
+            log_one_minus_v = np.log1p(-self.sticks)
+
+        return log_v + np.concatenate(([0], np.cumsum(log_one_minus_v[:-1])))
+
+    def _pack(self, data):
+        if data is not self._data:
+            self._data = data
+
+            self._packed_data = self.cluster_density.pack(data)
+
+        return self._packed_data
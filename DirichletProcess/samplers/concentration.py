@@ -18,7 +18,7 @@ from __future__ import division
 
 from math import log
 
-from random import betavariate, gammavariate, uniform
+from ..rng import get_stream
 
 class ConcentrationSampler(object):
     '''
@@ -37,14 +37,19 @@ class GammaPriorConcentrationSampler(ConcentrationSampler):
     '''
     Gibbs update assuming a gamma prior on the concentration parameter.
     '''
-    def __init__(self, a, b):
+    def __init__(self, a, b, rng=None):
         '''
         Args :
             a : (float) Shape parameter of the gamma prior.
             b : (float) Rate parameter of the gamma prior.
+        
+        Kwargs :
+            rng : (RandomStream) Stream to draw from. Defaults to the shared default stream.
         '''
         self.a = a
         self.b = b
+        
+        self.rng = get_stream(rng)
     
     def sample(self, old_value, num_clusters, num_data_points):
         a = self.a
@@ -53,37 +58,40 @@ class GammaPriorConcentrationSampler(ConcentrationSampler):
         k = num_clusters
         n = num_data_points
         
-        eta = betavariate(old_value + 1, n)
+        eta = self.rng.beta(old_value + 1, n)
     
         x = (a + k - 1) / (n * (b - log(eta)))
         
         pi = x / (1 + x)
     
-        label = discrete([pi, 1 - pi])
+        label = discrete([pi, 1 - pi], self.rng)
         
-        scale = b - log(eta)
+        rate = b - log(eta)
                 
         if label == 0:
-            new_value = gammavariate(a + k, scale)
+            new_value = self.rng.gamma(a + k, 1 / rate)
         else:
-            new_value = gammavariate(a + k - 1, scale)
+            new_value = self.rng.gamma(a + k - 1, 1 / rate)
         
         return new_value
 
 
-def discrete(p):
+def discrete(p, rng=None):
     '''
     Sample a discrete (Categorical) random variable.
 
     Args:
         p : (list) Probabilities for each class from 0 to len(p) - 1
 
+    Kwargs:
+        rng : (RandomStream) Stream to draw from. Defaults to the shared default stream.
+
     Returns:
         i : (int) Id of class sampled.
     '''
     total = 0
 
-    u = uniform(0, 1)
+    u = get_stream(rng).random()
 
     for i, p_i in enumerate(p):
         total += p_i
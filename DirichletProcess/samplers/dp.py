@@ -18,11 +18,106 @@ from __future__ import division
 
 from collections import OrderedDict
 
-from pydp.partition import Partition
-from pydp.samplers.concentration import GammaPriorConcentrationSampler
+import os
+import pickle
 
-class DirichletProcessSampler(object):
-    def __init__(self, atom_sampler, partition_sampler, alpha=1.0, alpha_priors=None, global_params_sampler=None):
+from ..partition import ArrayPartition
+from ..profiling import NullProfiler
+from ..rng import get_stream
+from .concentration import GammaPriorConcentrationSampler
+
+class MarkovChainSampler(object):
+    '''
+    Base class for samplers of a whole DP mixture, which runs the chain with sample(). Subclasses define num_iters,
+    state, number_of_cells, alpha, initialise_partition, interactive_sample and save_checkpoint.
+    '''
+    def sample(self, data, trace, num_iters, init_method='separate', print_freq=100, burnin=0, thin=1,
+               checkpoint_file=None, checkpoint_freq=100, resume=False, profiler=None):
+        '''
+        Args:
+            data : (list) Data points.
+            
+            trace : Object with an update(state) method which records the state of the sampler.
+            
+            num_iters : (int) Number of iterations of the whole run. Iterations are counted from the start of the run,
+                              so after resuming only the remaining iterations are done.
+            
+        Kwargs:
+            init_method : (str) See initialise_partition.
+            
+            print_freq : (int) How often to print progress.
+            
+            burnin : (int) Number of initial iterations which are not recorded.
+            
+            thin : (int) Record only every thin-th iteration after the burnin. The state is not built for iterations
+                         which are not recorded.
+            
+            checkpoint_file : (str) If given, save_checkpoint is called every checkpoint_freq iterations with the state 
+                                    returned by trace.checkpoint().
+            
+            checkpoint_freq : (int) Number of iterations between checkpoints.
+            
+            resume : (bool) Continue from the state restored by load_checkpoint instead of initialising the partition.
+                            Otherwise the partition is initialised and the iterations are counted from zero, also when
+                            the sampler has been run before.
+            
+            profiler : (SamplerProfiler) If given, phase timings and counters are logged for every iteration.
+        '''
+        if burnin < 0:
+            raise ValueError('burnin must be at least 0, got {0}.'.format(burnin))
+        
+        if thin < 1:
+            raise ValueError('thin must be at least 1, got {0}.'.format(thin))
+        
+        if not resume:
+            self.initialise_partition(data, init_method)
+            
+            self.num_iters = 0
+        
+        if profiler is None:
+            profiler = NullProfiler()
+        
+        profiler.open(self)
+        
+        try:
+            self._sample(data, trace, num_iters, print_freq, burnin, thin, checkpoint_file, checkpoint_freq, profiler)
+        
+        finally:
+            profiler.close()
+    
+    def _sample(self, data, trace, num_iters, print_freq, burnin, thin, checkpoint_file, checkpoint_freq, profiler):
+        while self.num_iters < num_iters:
+            if self.num_iters % print_freq == 0:
+                self._print_progress()
+            
+            profiler.start_iteration(self.num_iters)
+            
+            self.interactive_sample(data, profiler)
+            
+            if self.num_iters >= burnin and (self.num_iters - burnin) % thin == 0:
+                with profiler.phase('trace'):
+                    trace.update(self.state)
+            
+            self.num_iters += 1
+            
+            if checkpoint_file is not None and self.num_iters % checkpoint_freq == 0:
+                with profiler.phase('checkpoint'):
+                    self.save_checkpoint(checkpoint_file, trace.checkpoint())
+            
+            profiler.end_iteration()
+    
+    def _print_progress(self):
+        print self.num_iters, self.number_of_cells, self.alpha
+
+class DirichletProcessSampler(MarkovChainSampler):
+    def __init__(self, atom_sampler, partition_sampler, alpha=1.0, alpha_priors=None, global_params_sampler=None,
+                 rng=None):
+        '''
+        Kwargs:
+            rng : (RandomStream) Stream used to update alpha. Its state is saved in checkpoints, so the atom and 
+                                 partition samplers should be built with the same stream. Defaults to the shared 
+                                 default stream.
+        '''
         self.atom_sampler = atom_sampler
         
         self.partition_sampler = partition_sampler
@@ -36,7 +131,8 @@ class DirichletProcessSampler(object):
             self.update_alpha = True
             
             self.concentration_sampler = GammaPriorConcentrationSampler(alpha_priors['shape'], 
-                                                                        alpha_priors['rate']) 
+                                                                        alpha_priors['rate'],
+                                                                        rng=rng) 
         
         if global_params_sampler is None:
             self.update_global_params = False
@@ -46,17 +142,105 @@ class DirichletProcessSampler(object):
             
             self.global_params_sampler = global_params_sampler
         
+        self.rng = get_stream(rng)
+        
         self.num_iters = 0
     
     @property
     def state(self):
         return {
                 'alpha' : self.alpha,
-                'labels' : self.partition.labels,
+                'labels' : list(self.partition.labels),
                 'params' : [param for param in self.partition.item_values],
                 'global_params' : self.atom_sampler.cluster_density.params
                 }
     
+    def save_checkpoint(self, file_name, trace_state=None):
+        '''
+        Write everything needed to continue the run to file_name: the partition (labels and cell values), alpha, the 
+        number of iterations, the state of samplers which define get_state() and the state of the random stream. 
+        The file is written under a temporary name and then renamed, so a crash never leaves 
+        a partial checkpoint behind.
+        
+        Kwargs:
+            trace_state : Value returned by trace.checkpoint(), which is given back by load_checkpoint().
+        '''
+        checkpoint = {
+                      'alpha' : self.alpha,
+                      'num_iters' : self.num_iters,
+                      'cells' : [(cell.value, cell.items) for cell in self.partition.cells],
+                      'global_params' : self.atom_sampler.cluster_density.params if self.update_global_params else None,
+                      'sampler_states' : {},
+                      'rng_state' : self.rng.get_state(),
+                      'trace_state' : trace_state
+                      }
+        
+        for name, sampler in self._samplers.items():
+            if hasattr(sampler, 'get_state'):
+                checkpoint['sampler_states'][name] = sampler.get_state()
+        
+        write_checkpoint(file_name, checkpoint)
+    
+    def load_checkpoint(self, file_name):
+        '''
+        Restore the state written by save_checkpoint. Call sample() with resume=True afterwards to continue the run.
+        
+        Returns:
+            trace_state : The trace_state passed to save_checkpoint, to reopen the trace with.
+        '''
+        checkpoint = read_checkpoint(file_name)
+        
+        self.alpha = checkpoint['alpha']
+        
+        self.num_iters = checkpoint['num_iters']
+        
+        self.partition = ArrayPartition()
+        
+        # Items are added in their saved order so every cell lists its items exactly as before
+        for cell_index, (value, items) in enumerate(checkpoint['cells']):
+            self.partition.add_cell(value)
+            
+            for item in items:
+                self.partition.add_item(item, cell_index)
+        
+        if self.update_global_params:
+            self.atom_sampler.cluster_density.params = checkpoint['global_params']
+        
+        for name, sampler in self._samplers.items():
+            if name in checkpoint['sampler_states']:
+                sampler.set_state(checkpoint['sampler_states'][name])
+        
+        self.rng.set_state(checkpoint['rng_state'])
+        
+        return checkpoint['trace_state']
+    
+    @property
+    def number_of_cells(self):
+        return self.partition.number_of_cells
+    
+    def close(self):
+        '''
+        Shut down any worker pools started by the atom and partition samplers.
+        '''
+        for sampler in (self.atom_sampler, self.partition_sampler):
+            if hasattr(sampler, 'close'):
+                sampler.close()
+    
+    @property
+    def _samplers(self):
+        samplers = {
+                    'atom_sampler' : self.atom_sampler,
+                    'partition_sampler' : self.partition_sampler
+                    }
+        
+        if self.update_alpha:
+            samplers['concentration_sampler'] = self.concentration_sampler
+        
+        if self.update_global_params:
+            samplers['global_params_sampler'] = self.global_params_sampler
+        
+        return samplers
+    
     def initialise_partition(self, data, init_method):
         '''
         Args:
@@ -68,7 +252,7 @@ class DirichletProcessSampler(object):
                            - 'together' will allocate all data points to the same partition.
         '''
         
-        self.partition = Partition()
+        self.partition = ArrayPartition()
         
         if init_method == 'separate':
             for item, _ in enumerate(data):
@@ -83,40 +267,60 @@ class DirichletProcessSampler(object):
                 self.partition.add_item(item, 0)
                  
     
-    def sample(self, data, trace, num_iters, init_method='separate', print_freq=100):
-        self.initialise_partition(data, init_method)
+    def _print_progress(self):
+        MarkovChainSampler._print_progress(self)
         
-        for i in range(num_iters):
-            if i % print_freq == 0:
-                print self.num_iters, self.partition.number_of_cells, self.alpha 
-                
-                if self.update_global_params:
-                    params = self.atom_sampler.cluster_density.params
-                    
-                    if isinstance(params, OrderedDict):
-                        print ','.join([str(x[0]) for x in self.atom_sampler.cluster_density.params.values()])
-                    
-                    elif isinstance(params, tuple):
-                        print params[0]
-                    
-                    else:
-                        raise Exception('Object type {0} is not a valid cluster parameter'.format(type(params)))
-            
-            self.interactive_sample(data)
-            
-            trace.update(self.state)
+        if self.update_global_params:
+            params = self.atom_sampler.cluster_density.params
             
-            self.num_iters += 1
+            if isinstance(params, OrderedDict):
+                print ','.join([str(x[0]) for x in self.atom_sampler.cluster_density.params.values()])
+            
+            elif isinstance(params, tuple):
+                print params[0]
+            
+            else:
+                raise Exception('Object type {0} is not a valid cluster parameter'.format(type(params)))
     
-    def interactive_sample(self, data):
+    def interactive_sample(self, data, profiler=None):
+        if profiler is None:
+            profiler = NullProfiler()
+        
         if self.update_alpha:
-            self.alpha = self.concentration_sampler.sample(self.alpha,
-                                                           self.partition.number_of_cells,
-                                                           self.partition.number_of_items)
+            with profiler.phase('concentration'):
+                self.alpha = self.concentration_sampler.sample(self.alpha,
+                                                               self.partition.number_of_cells,
+                                                               self.partition.number_of_items)
         
-        self.partition_sampler.sample(data, self.partition, self.alpha)
+        with profiler.phase('partition'):
+            self.partition_sampler.sample(data, self.partition, self.alpha)
         
-        self.atom_sampler.sample(data, self.partition)
+        with profiler.phase('atom'):
+            self.atom_sampler.sample(data, self.partition)
         
         if self.update_global_params:
-            self.global_params_sampler.sample(data, self.partition)
+            with profiler.phase('global_params'):
+                self.global_params_sampler.sample(data, self.partition)
+                
+                # The cached cell log likelihoods were computed with the old global parameters
+                self.partition.reset_log_likelihoods()
+
+def write_checkpoint(file_name, checkpoint):
+    '''
+    Pickle checkpoint to file_name. The file is written under a temporary name and then renamed, so a crash never 
+    leaves a partial checkpoint behind.
+    '''
+    temp_file_name = file_name + '.tmp'
+    
+    with open(temp_file_name, 'wb') as fh:
+        pickle.dump(checkpoint, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        
+        fh.flush()
+        
+        os.fsync(fh.fileno())
+    
+    os.rename(temp_file_name, file_name)
+
+def read_checkpoint(file_name):
+    with open(file_name, 'rb') as fh:
+        return pickle.load(fh)
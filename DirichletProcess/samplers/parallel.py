@@ -0,0 +1,203 @@
+__author__ = 'mateusz'
+
+from multiprocessing import Pipe, Process
+
+import numpy as np
+
+from ..densities import PackedData
+from ..partition import ArrayPartition
+from .partition import AuxillaryParameterPartitionSampler, PartitionSampler
+
+class ParallelPartitionSampler(PartitionSampler):
+    '''
+    Data-parallel partition sampler using the auxiliary variable representation of the DP of Williamson, Dubey and Xing
+    "Parallel Markov Chain Monte Carlo for Nonparametric Mixture Models" (2013).
+
+    Assigning each cluster of a CRP(alpha) partition to one of P workers uniformly at random gives a joint distribution
+    in which, given which items each worker holds, the partitions of the workers are independent CRP(alpha / P)
+    partitions. So each call to sample:
+
+        1. Reassigns every cell to a worker uniformly at random, which is the exact conditional of the assignments given
+           the partition. This is the only step which moves items between workers.
+        2. Runs num_local_sweeps sweeps of local_sampler with concentration alpha / P on each worker in parallel, over
+           the items and cells the worker holds. Items can only join cells of their own worker or new cells.
+        3. Gathers the cells of the workers back into the partition.
+
+    Both steps leave the DP posterior invariant, so the chain is exact for any number of workers. Atoms and alpha are
+    updated by the coordinating DirichletProcessSampler between calls, and the current values are sent to the workers
+    with the cells.
+
+    The workers are forked when sample is first called with a data set. They share the pages of the data arrays with
+    the coordinator instead of receiving copies, and only cell values and item indices go through the pipes. Each
+    worker reseeds its copy of rng with a stream spawned from rng in the coordinator on every call, so a run is
+    reproducible from the coordinator stream, including after resuming from a checkpoint. base_measure should be built
+    with the same stream so the auxiliary atoms drawn by the workers are reseeded too. Call close() to shut the workers
+    down.
+
+    Kwargs:
+        local_sampler : (PartitionSampler) Sampler run on each worker. Defaults to an
+                                           AuxillaryParameterPartitionSampler sharing rng.
+
+        num_workers : (int) Number of worker processes P.
+
+        num_local_sweeps : (int) Number of sweeps of local_sampler between synchronisations.
+    '''
+    def __init__(self, base_measure, cluster_density, local_sampler=None, num_workers=2, num_local_sweeps=1,
+                 rng=None):
+        PartitionSampler.__init__(self, base_measure, cluster_density, rng=rng)
+
+        if local_sampler is None:
+            local_sampler = AuxillaryParameterPartitionSampler(base_measure, cluster_density, rng=self.rng)
+
+        self.local_sampler = local_sampler
+
+        self.num_workers = num_workers
+
+        self.num_local_sweeps = num_local_sweeps
+
+        self._pool = None
+
+        self._pool_data = None
+
+    def close(self):
+        '''
+        Shut down the worker processes, if they were started.
+        '''
+        if self._pool is not None:
+            self._pool.close()
+
+            self._pool = None
+
+            self._pool_data = None
+
+    def sample(self, data, partition, alpha):
+        pool = self._get_pool(data)
+
+        cells = partition.cells
+
+        labels = partition.label_array
+
+        workers = self.rng.randint(0, self.num_workers, size=len(cells))
+
+        streams = self.rng.spawn(self.num_workers)
+
+        shards = []
+
+        for w in range(self.num_workers):
+            cell_indices = np.flatnonzero(workers == w)
+
+            if len(cell_indices) == 0:
+                shards.append(None)
+
+                continue
+
+            # Items of the shard and their labels among the cells of the shard
+            local_labels = np.full(len(cells), -1, dtype=np.int64)
+
+            local_labels[cell_indices] = np.arange(len(cell_indices))
+
+            items = np.flatnonzero(local_labels[labels] >= 0)
+
+            shards.append(([cells[k].value for k in cell_indices], items, local_labels[labels[items]]))
+
+        results = pool.sample(shards, alpha / self.num_workers, self.num_local_sweeps, streams)
+
+        partition.cells = []
+
+        for shard, result in zip(shards, results):
+            if shard is None:
+                continue
+
+            _, items, _ = shard
+
+            values, local_labels = result
+
+            offset = partition.number_of_cells
+
+            for value in values:
+                partition.add_cell(value)
+
+            for item, label in zip(items.tolist(), local_labels.tolist()):
+                partition.add_item(item, offset + label)
+
+    def _get_pool(self, data):
+        if data is not self._pool_data:
+            self.close()
+
+            self._pool = _PartitionProcessPool(self.local_sampler, data, self.num_workers)
+
+            self._pool_data = data
+
+        return self._pool
+
+class _PartitionProcessPool(object):
+    '''
+    Fixed set of worker processes which each hold a copy of the local sampler and the data, inherited when forked.
+    '''
+    def __init__(self, local_sampler, data, num_workers):
+        self.connections = []
+
+        self.processes = []
+
+        for _ in range(num_workers):
+            parent_connection, child_connection = Pipe()
+
+            process = Process(target=_sample_partition_worker, args=(child_connection, local_sampler, data))
+
+            process.daemon = True
+
+            process.start()
+
+            self.connections.append(parent_connection)
+
+            self.processes.append(process)
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+
+            connection.close()
+
+        for process in self.processes:
+            process.join()
+
+    def sample(self, shards, alpha, num_sweeps, streams):
+        for shard, connection, rng in zip(shards, self.connections, streams):
+            if shard is not None:
+                connection.send((shard, alpha, num_sweeps, rng.get_state()))
+
+        return [None if shard is None else connection.recv() for shard, connection in zip(shards, self.connections)]
+
+def _sample_partition_worker(connection, local_sampler, data):
+    while True:
+        message = connection.recv()
+
+        if message is None:
+            break
+
+        (values, items, labels), alpha, num_sweeps, rng_state = message
+
+        local_sampler.rng.set_state(rng_state)
+
+        local_data = _take(data, items)
+
+        partition = ArrayPartition()
+
+        for value in values:
+            partition.add_cell(value)
+
+        for item, label in enumerate(labels.tolist()):
+            partition.add_item(item, label)
+
+        for _ in range(num_sweeps):
+            local_sampler.sample(local_data, partition, alpha)
+
+        connection.send((partition.cell_values, partition.label_array))
+
+    connection.close()
+
+def _take(data, items):
+    if isinstance(data, PackedData):
+        return data.take(items)
+
+    return [data[i] for i in items]
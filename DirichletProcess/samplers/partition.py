@@ -16,12 +16,20 @@ Created on 2012-09-21
 '''
 from __future__ import division
 
-from math import exp, log, lgamma as log_gamma
-from random import sample, shuffle
+from collections import OrderedDict
+from math import exp, log, log1p, lgamma as log_gamma
+
+import numpy as np
 
-from pydp.rvs import discrete_rvs, uniform_rvs
 from pydp.utils import log_space_normalise
 
+from ..densities import MultiSampleDensity
+from ..grid import PrevalenceGrid
+from ..measures import BetaData
+from ..rng import categorical_from_uniform, get_stream
+from ..utils import log_sum_exp_array
+from .atom import BaseMeasureProposalFunction
+
 class PartitionSampler(object):
     '''
     Base class for samplers which update the partition of the DP.
@@ -31,12 +39,19 @@ class PartitionSampler(object):
         base_measure : (BaseMeasure) Base measure for DP process.
         
         cluster_density : (ClusterDensity) Cluster density for DP process.
+    
+    Kwargs:
+        rng : (RandomStream) Stream to draw from. Defaults to the shared default stream.
     '''
-    def __init__(self, base_measure, cluster_density):
+    def __init__(self, base_measure, cluster_density, rng=None):
         self.base_measure = base_measure
         
         self.cluster_density = cluster_density
         
+        self.rng = get_stream(rng)
+        
+        self._data = None
+        
     def sample(self, data, old_partition, alpha, **kwargs):
         '''
             data : (list) List of data points appropriate for cluster_density.
@@ -46,22 +61,54 @@ class PartitionSampler(object):
             alpha : (float) Concentration parameter for the DP.
         '''
         pass
+    
+    def _pack(self, data):
+        '''
+        Return the packed form of data for cluster_density.log_p_matrix. The result is cached until data changes.
+        '''
+        if data is not self._data:
+            self._data = data
+            
+            self._packed_data = self.cluster_density.pack(data)
+        
+        return self._packed_data
 
 #=======================================================================================================================
 # Non-conjugate samplers
 #=======================================================================================================================
 class AuxillaryParameterPartitionSampler(PartitionSampler):
+    # Largest number of (item, cell) log likelihoods to precompute at the start of a sweep
+    max_matrix_size = 2 ** 24
+    
     def sample(self, data, partition, alpha, m=2):
         '''
         Sample a new partition according to algorithm 8 of Neal "Sampling Methods For Dirichlet Process Mixture Models"
+        
+        The log likelihood of every item under the cells present at the start of the sweep is computed in one batched 
+        call. Cells created during the sweep and the auxiliary atoms are scored together in one call per item. The 
+        auxiliary atoms and the uniforms used to pick the new cells are drawn in one batch at the start of the sweep.
         '''
-        items = range(len(data))
+        packed_data = self._pack(data)
         
-        shuffle(items)
+        cells = partition.cells
         
-        for item in items:
-            data_point = data[item]
+        if len(cells) * len(data) <= self.max_matrix_size:
+            log_p_matrix = self.cluster_density.log_p_matrix(packed_data, [cell.value for cell in cells])
             
+            cell_log_p = dict(zip(cells, log_p_matrix.T))
+        
+        else:
+            cell_log_p = {}
+        
+        items = range(len(data))
+        
+        self.rng.shuffle(items)
+        
+        uniforms = self.rng.random(len(items))
+        
+        auxillary_values = self.base_measure.random_batch(len(items) * m)
+        
+        for k, item in enumerate(items):
             old_cell_index = partition.labels[item]
             
             partition.remove_item(item, old_cell_index)
@@ -71,13 +118,26 @@ class AuxillaryParameterPartitionSampler(PartitionSampler):
             else:
                 num_new_tables = m
             
-            for _ in range(num_new_tables):
-                partition.add_cell(self.base_measure.random())
+            for value in auxillary_values[k * m:k * m + num_new_tables]:
+                partition.add_cell(value)
+            
+            cells = partition.cells
+            
+            unscored_cells = [cell for cell in cells if cell not in cell_log_p]
+            
+            unscored_log_p = self.cluster_density.log_p_matrix(packed_data, 
+                                                               [cell.value for cell in unscored_cells],
+                                                               items=[item])
+            
+            unscored_log_p = dict(zip(unscored_cells, unscored_log_p[0]))
             
             log_p = []
             
-            for cell in partition.cells:
-                cluster_log_p = self.cluster_density.log_p(data_point, cell.value)
+            for cell in cells:
+                if cell in cell_log_p:
+                    cluster_log_p = cell_log_p[cell][item]
+                else:
+                    cluster_log_p = unscored_log_p[cell]
                 
                 counts = cell.size
                 
@@ -90,7 +150,7 @@ class AuxillaryParameterPartitionSampler(PartitionSampler):
             
             p = [exp(x) for x in log_p]
             
-            new_cell_index = discrete_rvs(p)
+            new_cell_index = categorical_from_uniform(p, uniforms[k])
             
             partition.add_item(item, new_cell_index)
             
@@ -112,7 +172,7 @@ class MetropolisGibbsPartitionSampler(PartitionSampler):
             if partition.counts[old_cluster_label] == 0:
                 p = [x / (n - 1) for x in partition.counts]
                 
-                new_cluster_label = discrete_rvs(p)
+                new_cluster_label = self.rng.categorical(p)
                 
                 new_value = partition.cell_values[new_cluster_label]
                 
@@ -121,7 +181,7 @@ class MetropolisGibbsPartitionSampler(PartitionSampler):
                 
                 log_ratio = log(n - 1) - log(alpha) + new_ll - old_ll
                 
-                u = uniform_rvs(0, 1)
+                u = self.rng.random()
                 
                 if log_ratio >= log(u):
                     partition.add_item(item, new_cluster_label)
@@ -136,7 +196,7 @@ class MetropolisGibbsPartitionSampler(PartitionSampler):
                 
                 log_ratio = log(alpha) - log(n - 1) + new_ll - old_ll
                 
-                u = uniform_rvs(0, 1)
+                u = self.rng.random()
                 
                 if log_ratio >= log(u):
                     partition.add_cell(new_value)
@@ -170,225 +230,423 @@ class MetropolisGibbsPartitionSampler(PartitionSampler):
             
             p = [exp(x) for x in log_p]
             
-            new_cluster_label = discrete_rvs(p)
+            new_cluster_label = self.rng.categorical(p)
             
             partition.add_item(item, new_cluster_label)
         
         partition.remove_empty_cells()
 
 class SequentiallyAllocatedMergeSplitSampler(PartitionSampler):
-    def __init__(self, base_measure, cluster_density, proposal_func=None):        
-        PartitionSampler.__init__(self, base_measure, cluster_density)
+    '''
+    Sequentially allocated merge-split sampler of Dahl "Sequentially-Allocated Merge-Split Sampler for Conjugate and
+    Nonconjugate Dirichlet Process Mixture Models", adapted to non-conjugate models by keeping the atom of the cell of
+    the first anchor and drawing the atom of the other cell from proposal_func.
+    
+    A proposal only touches the one or two cells of its anchors, so it is built as a delta over those cells and the
+    partition is only changed if the proposal is accepted. The log likelihoods of the members of the affected cells
+    under both atoms are computed in one batched call, which gives the allocation probabilities and the likelihood
+    ratio. The CRP prior ratio only depends on the sizes of the affected cells, and the alpha and normalising terms of
+    the other cells cancel. Each call to sample makes num_proposals proposals, with the anchor pairs drawn in one batch.
+    
+    Kwargs:
+        proposal_func : Proposal for the atom of the new cell of a split. Defaults to drawing it from base_measure.
+        
+        num_proposals : (int) Number of split or merge proposals per call to sample.
+    '''
+    def __init__(self, base_measure, cluster_density, proposal_func=None, num_proposals=20, rng=None):
+        PartitionSampler.__init__(self, base_measure, cluster_density, rng=rng)
         
         if proposal_func is None:
-            self.proposal_func = base_measure
+            self.proposal_func = BaseMeasureProposalFunction(base_measure)
         else:
             self.proposal_func = proposal_func
+        
+        self.num_proposals = num_proposals
+        
+        self.num_proposed = 0
+        
+        self.num_accepted = 0
     
-    def sample(self, data, old_partition, alpha):
-        items = range(len(data))
+    def sample(self, data, partition, alpha):
+        n = len(data)
         
-        i, j = sample(items, 2)
+        if n < 2:
+            return
         
-        labels = old_partition.labels
+        packed_data = self._pack(data)
         
-        c_i = labels[i]
+        # Distinct anchor pairs, the second anchor is drawn from the n - 1 items other than the first
+        anchors_i = self.rng.randint(0, n, size=self.num_proposals)
         
-        c_j = labels[j]
+        anchors_j = self.rng.randint(0, n - 1, size=self.num_proposals)
         
-        new_partition = old_partition.copy()
-
-        if c_i == c_j:
-            c = c_i
+        anchors_j += anchors_j >= anchors_i
+        
+        uniforms = self.rng.random(self.num_proposals)
+        
+        for i, j, u in zip(anchors_i.tolist(), anchors_j.tolist(), uniforms):
+            labels = partition.labels
             
-            old_cell = new_partition.cells[c]
+            c_i = labels[i]
             
-            new_cell_i, new_cell_j, forward_log_q, reverse_log_q = self._split(i, j, old_cell, data, new_partition)
+            c_j = labels[j]
             
-            forward_log_p = self._compute_partition_log_p(new_cell_i, data) + \
-                            self._compute_partition_log_p(new_cell_j, data)
-                            
-            old_cell = old_partition.cells[c]
-                            
-            reverse_log_p = self._compute_partition_log_p(old_cell, data)
-
-        else:
-            cell_i = new_partition.cells[c_i]
-            cell_j = new_partition.cells[c_j]
+            if c_i == c_j:
+                log_ratio, moved, param_j = self._propose_split(i, j, partition.cells[c_i], packed_data, alpha)
             
-            new_cell, forward_log_q, reverse_log_q = self._merge(cell_i, cell_j, data, new_partition)
+            else:
+                log_ratio, moved = self._propose_merge(i, j, partition.cells[c_i], partition.cells[c_j], packed_data,
+                                                       alpha)
             
-            forward_log_p = self._compute_partition_log_p(new_cell, data)
+            self.num_proposed += 1
             
-            old_cell_i = old_partition.cells[c_i]
-            old_cell_j = old_partition.cells[c_j]
+            if log_ratio < log(u):
+                continue
             
-            reverse_log_p = self._compute_partition_log_p(old_cell_i, data) + \
-                            self._compute_partition_log_p(old_cell_j, data)
-        
-        forward_log_prior = self._compute_prior_log_p(alpha, new_partition)        
-        reverse_log_prior = self._compute_prior_log_p(alpha, old_partition)
+            self.num_accepted += 1
+            
+            # A split moves items from the cell of i to a new cell, a merge moves the cell of j into the cell of i
+            if c_i == c_j:
+                source_index = c_i
                 
-        forward_log_ratio = forward_log_p + forward_log_prior - forward_log_q        
-        reverse_log_ratio = reverse_log_p + reverse_log_prior - reverse_log_q
-
-        log_ratio = forward_log_ratio - reverse_log_ratio
-
-        u = uniform_rvs(0, 1)
+                target = partition.add_cell(param_j)
+            
+            else:
+                source_index = c_j
+                
+                target = partition.cells[c_i]
+            
+            for k in moved:
+                partition.remove_item(k, source_index)
+                
+                target.add_item(k)
+            
+            partition.remove_empty_cells()
+    
+    def _propose_split(self, i, j, cell, packed_data, alpha):
+        '''
+        Propose splitting cell into a cell with i and its atom and a cell with j and a new atom.
         
-        if log_ratio >= log(u):
-            print "accepted"
+        Returns:
+            log_ratio : (float) Log Metropolis-Hastings ratio of the split.
             
-            old_partition.cells = new_partition.cells
-        else:
-#             print "rejected"
-#             print forward_log_p - reverse_log_p, forward_log_q - reverse_log_q
-            pass
-
-    def _merge(self, old_cell_i, old_cell_j, data, partition):
-        s_i = old_cell_i.items     
-        s_j = old_cell_j.items
+            moved : (list) Items which go to the new cell.
+            
+            param_j : Atom of the new cell.
+        '''
+        param_i = cell.value
+        param_j = self.proposal_func.random(param_i)
         
-        param_i = old_cell_i.value
-        param_j = old_cell_j.value
+        items = [k for k in cell.items if k != i and k != j]
         
-        param_new = param_i
-
-        forward_log_q = self.proposal_func.log_p(param_new, param_i)
-        reverse_log_q = self.proposal_func.log_p(param_i, param_new) + self.proposal_func.log_p(param_j, param_new)
+        self.rng.shuffle(items)
         
-        new_cell = partition.add_cell(param_new)
+        # Rows are i, j and the items in allocation order, columns are the two atoms
+        log_p = self.cluster_density.log_p_matrix(packed_data, [param_i, param_j], items=[i, j] + items)
         
-        for k in s_i:
-            old_cell_i.remove_item(k)
-            
-            new_cell.add_item(k)
+        in_j, log_q = self._allocate(log_p[2:], self.rng.random(len(items)))
         
-        for k in s_j:
-            old_cell_j.remove_item(k)
-            
-            new_cell.add_item(k)
-
-        temp_s_i = set([s_i.pop(), ])
-        temp_s_j = set([s_j.pop(), ])
+        n_j = 1 + len(in_j)
+        n_i = len(items) + 2 - n_j
+        
+        forward_log_q = self.proposal_func.log_p(param_i, param_i) + self.proposal_func.log_p(param_j, param_i) + log_q
+        reverse_log_q = self.proposal_func.log_p(param_i, param_i)
         
-        items = s_i + s_j
+        moved = [j] + [items[k] for k in in_j]
         
-        shuffle(items)
+        # Only the moved items change atom, from param_i to param_j
+        log_likelihood_ratio = log_p[1, 1] - log_p[1, 0]
         
-        for k in items:
-            n_i = len(temp_s_i)
-            n_j = len(temp_s_j)
-            
-            log_p = [
-                     log(n_i) + self.cluster_density.log_p(data[k], param_i),
-                     log(n_j) + self.cluster_density.log_p(data[k], param_j)
-                     ]
-            
-            log_p = log_space_normalise(log_p)
+        if in_j:
+            rows = np.array(in_j) + 2
             
-            if k in s_i:
-                temp_s_i.add(k)
-                
-                reverse_log_q += log_p[0]
-                
-            else:
-                temp_s_j.add(k)
-                
-                reverse_log_q += log_p[1]
+            log_likelihood_ratio += (log_p[rows, 1] - log_p[rows, 0]).sum()
         
-        partition.remove_empty_cells()
+        log_prior_ratio = log(alpha) + log_gamma(n_i) + log_gamma(n_j) - log_gamma(n_i + n_j)
+        
+        log_ratio = log_likelihood_ratio + log_prior_ratio - forward_log_q + reverse_log_q
         
-        return new_cell, forward_log_q, reverse_log_q
+        return log_ratio, moved, param_j
     
-    def _split(self, i, j, old_cell, data, partition):
-        old_cell.remove_item(i)        
-        old_cell.remove_item(j)
+    def _propose_merge(self, i, j, cell_i, cell_j, packed_data, alpha):
+        '''
+        Propose merging cell_j into cell_i, keeping the atom of cell_i.
         
-        param_i = old_cell.value      
-        param_j = self.proposal_func.random(param_i)
+        Returns:
+            log_ratio : (float) Log Metropolis-Hastings ratio of the merge.
+            
+            moved : (list) Items of cell_j, which go to cell_i.
+        '''
+        param_i = cell_i.value
+        param_j = cell_j.value
         
-        forward_log_q = self.proposal_func.log_p(param_i, param_i) + self.proposal_func.log_p(param_j, param_i)
-        reverse_log_q = self.proposal_func.log_p(param_i, param_i)
+        s_i = cell_i.items
+        s_j = cell_j.items
         
-        new_cell_i = partition.add_cell(param_i)        
-        new_cell_j = partition.add_cell(param_j)
+        items = [k for k in s_i if k != i] + [k for k in s_j if k != j]
         
-        new_cell_i.add_item(i)
-        new_cell_j.add_item(j)
+        self.rng.shuffle(items)
         
-        s = old_cell.items
-        shuffle(s)
+        log_p = self.cluster_density.log_p_matrix(packed_data, [param_i, param_j], items=[i, j] + items)
         
-        for k in s:
-            old_cell.remove_item(k)
-            
-            n_i = new_cell_i.size
-            n_j = new_cell_j.size
+        # Log probability of the reverse split allocating every item to the cell it is in now
+        set_j = set(s_j)
+        
+        in_j = [k for k, item in enumerate(items) if item in set_j]
+        
+        log_q = self._allocation_log_q(log_p[2:], in_j)
+        
+        forward_log_q = self.proposal_func.log_p(param_i, param_i)
+        reverse_log_q = self.proposal_func.log_p(param_i, param_i) + self.proposal_func.log_p(param_j, param_i) + log_q
+        
+        # Only the items of cell_j change atom, from param_j to param_i
+        log_likelihood_ratio = log_p[1, 0] - log_p[1, 1]
+        
+        if in_j:
+            rows = np.array(in_j) + 2
             
-            log_p = [
-                     log(n_i) + self.cluster_density.log_p(data[k], param_i),
-                     log(n_j) + self.cluster_density.log_p(data[k], param_j)
-                     ]
+            log_likelihood_ratio += (log_p[rows, 0] - log_p[rows, 1]).sum()
+        
+        n_i = len(s_i)
+        n_j = len(s_j)
+        
+        log_prior_ratio = log_gamma(n_i + n_j) - log_gamma(n_i) - log_gamma(n_j) - log(alpha)
+        
+        log_ratio = log_likelihood_ratio + log_prior_ratio - forward_log_q + reverse_log_q
+        
+        return log_ratio, s_j
+    
+    def _allocate(self, log_p, uniforms):
+        '''
+        Sequentially allocate items to the cells of the anchors i and j, which start with one item each.
+        
+        Args:
+            log_p : (numpy.ndarray) Log likelihoods of the items, in allocation order, under the atoms of i and j.
             
-            log_p = log_space_normalise(log_p)
+            uniforms : (numpy.ndarray) One uniform per item.
+        
+        Returns:
+            in_j : (list) Rows of log_p allocated to the cell of j.
             
-            p = [exp(x) for x in log_p]
+            log_q : (float) Log probability of the allocation.
+        '''
+        n_i = 1
+        n_j = 1
+        
+        in_j = []
+        
+        log_q = 0
+        
+        for k, (ll_i, ll_j) in enumerate(log_p.tolist()):
+            log_p_i, log_p_j = _log_normalise_pair(log(n_i) + ll_i, log(n_j) + ll_j)
             
-            c_k = discrete_rvs(p)
+            if uniforms[k] < exp(log_p_i):
+                n_i += 1
+                
+                log_q += log_p_i
             
-            if c_k == 0:                
-                new_cell_i.add_item(k)
             else:
-                new_cell_j.add_item(k)
-            
-            forward_log_q += log_p[c_k]
+                n_j += 1
+                
+                in_j.append(k)
+                
+                log_q += log_p_j
         
-        partition.remove_empty_cells()
-
-        return new_cell_i, new_cell_j, forward_log_q, reverse_log_q
+        return in_j, log_q
     
-    def _compute_partition_log_p(self, cell, data):
-        log_p = 0
-        
-        param = cell.value
+    def _allocation_log_q(self, log_p, in_j):
+        '''
+        Log probability of _allocate producing the allocation in which the rows in in_j go to the cell of j.
+        '''
+        is_j = np.zeros(log_p.shape[0], dtype=int)
         
-        for item in cell.items:
-            log_p += self.cluster_density.log_p(data[item], param)
+        is_j[in_j] = 1
         
-        return log_p
-    
-    def _compute_prior_log_p(self, alpha, partition):
-        log_p = partition.number_of_cells * log(alpha)
-
-        for n_c in partition.counts:
-            log_p += log_gamma(n_c)
+        # Cell sizes before each item is allocated
+        n_j = 1 + np.cumsum(is_j) - is_j
+        n_i = 1 + np.arange(log_p.shape[0]) - (n_j - 1)
         
-        n = partition.number_of_items
+        log_p_i = np.log(n_i) + log_p[:, 0]
+        log_p_j = np.log(n_j) + log_p[:, 1]
         
-        for i in range(1, n + 1):
-            log_p -= log_gamma(alpha + i - 1)
+        log_norm = np.logaddexp(log_p_i, log_p_j)
         
-        return log_p
+        return float(np.where(is_j, log_p_j, log_p_i).sum() - log_norm.sum())
     
 class SplitMergeAuxillaryHybridSampler(PartitionSampler):
-    def __init__(self, base_measure, cluster_density, proposal_func=None, ratio=0.1):
-        PartitionSampler.__init__(self, base_measure, cluster_density)
+    def __init__(self, base_measure, cluster_density, proposal_func=None, ratio=0.1, num_proposals=20, rng=None):
+        PartitionSampler.__init__(self, base_measure, cluster_density, rng=rng)
         
         self.ratio = ratio
         
-        self.auxillary_sampler = AuxillaryParameterPartitionSampler(base_measure, cluster_density)
+        self.auxillary_sampler = AuxillaryParameterPartitionSampler(base_measure, cluster_density, rng=self.rng)
         
-        self.split_merge_sampler = SequentiallyAllocatedMergeSplitSampler(base_measure, cluster_density, proposal_func)
+        self.split_merge_sampler = SequentiallyAllocatedMergeSplitSampler(base_measure, 
+                                                                          cluster_density, 
+                                                                          proposal_func, 
+                                                                          num_proposals=num_proposals,
+                                                                          rng=self.rng)
     
     def sample(self, data, partition, alpha):
-        u = uniform_rvs(0, 1)
+        u = self.rng.random()
         
         if u < self.ratio:
             self.auxillary_sampler.sample(data, partition, alpha)
         else:
             self.split_merge_sampler.sample(data, partition, alpha)
         
+class CollapsedGridPartitionSampler(PartitionSampler):
+    '''
+    Update the partition with the atoms integrated out, as in algorithm 3 of Neal "Sampling Methods For Dirichlet 
+    Process Mixture Models", for densities with a scalar atom in [0, 1] in each sample.
+    
+    The integral over each cluster's atom is done numerically on a grid. Each cell keeps the sum of its members' log 
+    likelihoods at every grid point, so moving an item between cells is one vector subtraction and one addition. At 
+    the end of the sweep every cell value is drawn from its conditional on the grid.
+    '''
+    def __init__(self, base_measure, cluster_density, grid_size=101, rng=None):
+        PartitionSampler.__init__(self, base_measure, cluster_density, rng=rng)
+        
+        self.grid = PrevalenceGrid(grid_size)
+        
+        if isinstance(cluster_density, MultiSampleDensity):
+            self.sample_ids = list(cluster_density.cluster_densities.keys())
+            
+            base_measures = [base_measure.base_measures[sample_id] for sample_id in self.sample_ids]
+        
+        else:
+            self.sample_ids = None
+            
+            base_measures = [base_measure, ]
+        
+        # Number of samples x grid points
+        self.log_prior = np.array([self.grid.log_prior(x) for x in base_measures])
+        
+        self._table_data = None
+    
+    def sample(self, data, partition, alpha):
+        table = self._log_likelihood_table(data)
+        
+        cell_ll = {}
+        
+        cell_log_m = {}
+        
+        for cell in partition.cells:
+            cell_ll[cell] = table[cell.items].sum(axis=0)
+            
+            cell_log_m[cell] = self._log_marginal(cell_ll[cell])
+        
+        items = range(len(data))
+        
+        self.rng.shuffle(items)
+        
+        uniforms = self.rng.random(len(items))
+        
+        for k, item in enumerate(items):
+            row = table[item]
+            
+            old_cell_index = partition.labels[item]
+            
+            old_cell = partition.cells[old_cell_index]
+            
+            partition.remove_item(item, old_cell_index)
+            
+            if old_cell.empty:
+                partition.remove_empty_cells()
+                
+                del cell_ll[old_cell]
+                
+                del cell_log_m[old_cell]
+            
+            else:
+                cell_ll[old_cell] = cell_ll[old_cell] - row
+                
+                cell_log_m[old_cell] = self._log_marginal(cell_ll[old_cell])
+            
+            cells = partition.cells
+            
+            log_p = []
+            
+            new_log_m = []
+            
+            if cells:
+                new_log_m = self._log_marginal(np.array([cell_ll[cell] for cell in cells]) + row)
+                
+                for cell, log_m in zip(cells, new_log_m):
+                    log_p.append(log(cell.size) + log_m - cell_log_m[cell])
+            
+            log_p.append(log(alpha) + self._singleton_log_m[item])
+            
+            log_p = log_space_normalise(log_p)
+            
+            p = [exp(x) for x in log_p]
+            
+            new_cell_index = categorical_from_uniform(p, uniforms[k])
+            
+            if new_cell_index == len(cells):
+                new_cell = partition.add_cell(None)
+                
+                cell_ll[new_cell] = row.copy()
+                
+                cell_log_m[new_cell] = self._singleton_log_m[item]
+            
+            else:
+                new_cell = cells[new_cell_index]
+                
+                cell_ll[new_cell] = cell_ll[new_cell] + row
+                
+                cell_log_m[new_cell] = new_log_m[new_cell_index]
+            
+            partition.add_item(item, new_cell_index)
+        
+        for cell in partition.cells:
+            cell.value = self._random_value(cell_ll[cell])
+    
+    def _log_likelihood_table(self, data):
+        '''
+        Return the number of items x number of samples x grid points table of log likelihoods for data.
+        '''
+        if data is not self._table_data:
+            self._table_data = data
+            
+            packed_data = self._pack(data)
+            
+            if self.sample_ids is None:
+                self._table = self.grid.log_likelihood_table(self.cluster_density, packed_data)[:, np.newaxis, :]
+            
+            else:
+                densities = self.cluster_density.cluster_densities
+                
+                self._table = np.empty((len(data), len(self.sample_ids), self.grid.size))
+                
+                for i, sample_id in enumerate(self.sample_ids):
+                    self._table[:, i, :] = self.grid.log_likelihood_table(densities[sample_id], packed_data[sample_id])
+            
+            self._singleton_log_m = self._log_marginal(self._table)
+        
+        return self._table
+    
+    def _log_marginal(self, ll):
+        '''
+        Log marginal likelihood of cells given their summed log likelihoods ll, an array of shape ... x samples x grid.
+        '''
+        log_m = log_sum_exp_array(ll + self.log_prior, axis=-1) + self.grid.log_width
+        
+        return log_m.sum(axis=-1)
+    
+    def _random_value(self, ll):
+        x = self.grid.points[self.grid.random_indices(self.log_prior + ll, self.rng)].tolist()
+        
+        if self.sample_ids is None:
+            return BetaData(x[0])
+        
+        value = OrderedDict()
+        
+        for sample_id, sample_x in zip(self.sample_ids, x):
+            value[sample_id] = BetaData(sample_x)
+        
+        return value
+
 #=======================================================================================================================
 # Conjugate Samplers
 #=======================================================================================================================
@@ -396,7 +654,7 @@ class MarginalGibbsPartitionSampler(PartitionSampler):
     '''
     Update the partition using algorithm 2 of Neal "Sampling Methods For Dirichlet Process Mixture Models".
     '''
-    def __init__(self, base_measure, cluster_density, posterior_predictive_density):
+    def __init__(self, base_measure, cluster_density, posterior_predictive_density, rng=None):
         '''
         Args:
             base_measure : (BaseMeasure) Base measure for DP process.
@@ -405,8 +663,11 @@ class MarginalGibbsPartitionSampler(PartitionSampler):
             
             posterior_predictive_density : (Density) Posterior density obtained by integrating the prior against the likelihood for
             the model.
+        
+        Kwargs:
+            rng : (RandomStream) Stream to draw from. Defaults to the shared default stream.
         '''            
-        PartitionSampler.__init__(self, base_measure, cluster_density)
+        PartitionSampler.__init__(self, base_measure, cluster_density, rng=rng)
         
         self.posterior_density = posterior_predictive_density
     
@@ -437,9 +698,21 @@ class MarginalGibbsPartitionSampler(PartitionSampler):
             
             p = [exp(x) for x in log_p]
             
-            new_cell_index = discrete_rvs(p)
+            new_cell_index = self.rng.categorical(p)
             
             if new_cell_index == partition.number_of_cells:
                 partition.add_cell(self.base_measure.random())
                 
             partition.add_item(item, new_cell_index)
+
+def _log_normalise_pair(log_p_i, log_p_j):
+    '''
+    Normalise two log weights, without the list handling of log_space_normalise.
+    '''
+    if log_p_i > log_p_j:
+        log_norm = log_p_i + log1p(exp(log_p_j - log_p_i))
+    
+    else:
+        log_norm = log_p_j + log1p(exp(log_p_i - log_p_j))
+    
+    return log_p_i - log_norm, log_p_j - log_norm
@@ -1,6 +1,8 @@
 __author__ = 'mateusz'
 
-from math import isinf, exp, log
+from math import isinf, exp, lgamma, log
+
+import numpy as np
 
 def log_sum_exp(log_X):
     '''
@@ -19,3 +21,51 @@ def log_sum_exp(log_X):
         total += exp(x - max_exp)
 
     return log(total) + max_exp
+
+
+def log_sum_exp_array(log_X, axis=-1):
+    '''
+    Vectorised log_sum_exp along one axis of an array. Slices which are entirely -inf give -inf.
+    '''
+    log_X = np.asarray(log_X, dtype=float)
+
+    max_exp = np.max(log_X, axis=axis, keepdims=True)
+
+    max_exp[~np.isfinite(max_exp)] = 0
+
+    with np.errstate(divide='ignore'):
+        total = np.log(np.sum(np.exp(log_X - max_exp), axis=axis))
+
+    return total + np.squeeze(max_exp, axis=axis)
+
+
+def log_gamma_array(x):
+    '''
+    Vectorised math.lgamma.
+    '''
+    return np.vectorize(lgamma, otypes=[float])(x)
+
+
+def digamma_array(x):
+    '''
+    Digamma function of an array of positive values. Small values are shifted up with the recurrence
+    psi(x) = psi(x + 1) - 1 / x until they are at least 6, where the asymptotic series is accurate to double precision.
+    '''
+    x = np.array(x, dtype=float)
+
+    result = np.zeros(x.shape)
+
+    small = x < 6
+
+    while small.any():
+        result[small] -= 1 / x[small]
+
+        x[small] += 1
+
+        small = x < 6
+
+    inv_x2 = 1 / (x * x)
+
+    series = inv_x2 * (1 / 12.0 - inv_x2 * (1 / 120.0 - inv_x2 * (1 / 252.0 - inv_x2 * (1 / 240.0 - inv_x2 / 132.0))))
+
+    return result + np.log(x) - 0.5 / x - series
@@ -0,0 +1,356 @@
+__author__ = 'mateusz'
+
+from collections import OrderedDict
+from math import lgamma, log
+from multiprocessing import Pool
+
+import numpy as np
+
+from grid import PrevalenceGrid
+from rng import get_stream
+from utils import digamma_array, log_gamma_array, log_sum_exp_array
+
+# Floor for log likelihoods, so a -inf entry of a table does not turn the products with the responsibilities into nan
+_LOG_FLOOR = -1e10
+
+class VariationalDPMixture(object):
+    '''
+    Mean-field variational inference for a DP mixture with scalar atoms in [0, 1] per sample, such as the cellular
+    prevalences of the PyClone model, following Blei and Jordan (2006).
+
+    The posterior is approximated by a truncated stick-breaking distribution with truncation components:
+
+        q(v_k) = Beta(gamma_1k, gamma_2k) for the sticks, with the last stick fixed to 1,
+        q(z_i) = Categorical(r_i) for the assignments,
+        q(alpha) = Gamma(shape, rate) for the concentration parameter under its Gamma prior,
+        q(phi_ks) for the atom of component k in sample s, on a PrevalenceGrid of grid_size points.
+
+    The atoms are not conjugate to the likelihood, so each q(phi_ks) is a discrete distribution on the grid, which is
+    the exact coordinate update for the base measure discretised to the grid. The log likelihood of every data point
+    at every grid point is computed once per sample with cluster_density.log_p_matrix. With these len(data) x grid_size
+    tables, a coordinate ascent sweep is a few matrix products. It stops when the relative change of the evidence lower
+    bound (ELBO) falls below tol.
+
+    Coordinate ascent only finds a local optimum, so fit() runs num_restarts fits from random responsibilities, in
+    parallel processes if num_processes > 1, and keeps the one with the highest ELBO.
+
+    Args:
+        base_measure : (BetaBaseMeasure or MultiSampleBaseMeasure) Base measure of the DP.
+
+        cluster_density : (Density or MultiSampleDensity) Cluster density, with log_p_matrix and pack.
+
+        alpha_priors : (dict) Shape and rate of the Gamma prior on alpha.
+
+    Kwargs:
+        truncation : (int) Number of components of the stick-breaking approximation.
+
+        grid_size : (int) Number of grid points for the atoms. Memory use is len(data) x grid_size floats per sample.
+
+        max_iters : (int) Largest number of coordinate ascent sweeps of one fit.
+
+        tol : (float) Relative change of the ELBO at which a fit stops.
+
+        num_restarts : (int) Number of fits from random starting points.
+
+        num_processes : (int) Number of processes the restarts are run in. 1 runs them in this process.
+
+        rng : (RandomStream) Stream the restarts are seeded from. Defaults to the shared default stream.
+    '''
+    def __init__(self, base_measure, cluster_density, alpha_priors, truncation=50, grid_size=201, max_iters=500,
+                 tol=1e-6, num_restarts=4, num_processes=1, rng=None):
+        if hasattr(cluster_density, 'cluster_densities'):
+            self.base_measures = base_measure.base_measures
+
+            self.cluster_densities = cluster_density.cluster_densities
+
+        else:
+            self.base_measures = OrderedDict([(None, base_measure)])
+
+            self.cluster_densities = OrderedDict([(None, cluster_density)])
+
+        self.alpha_priors = alpha_priors
+
+        self.truncation = truncation
+
+        self.grid = PrevalenceGrid(grid_size)
+
+        self.max_iters = max_iters
+
+        self.tol = tol
+
+        self.num_restarts = num_restarts
+
+        self.num_processes = num_processes
+
+        self.rng = get_stream(rng)
+
+    def fit(self, data):
+        '''
+        Fit the approximation to data and return the VariationalFit with the highest ELBO.
+
+        Args:
+            data : (list) Data points for the cluster density, or PackedData.
+        '''
+        problem = self._build_problem(data)
+
+        streams = self.rng.spawn(self.num_restarts)
+
+        if self.num_processes > 1:
+            # The workers are forked with the tables already in memory, so they are not pickled
+            pool = Pool(self.num_processes, initializer=_init_worker, initargs=(problem, ))
+
+            try:
+                fits = pool.map(_fit_worker, streams)
+
+            finally:
+                pool.close()
+
+                pool.join()
+
+        else:
+            fits = [_fit(problem, rng) for rng in streams]
+
+        self.restart_elbos = [fit.elbo for fit in fits]
+
+        best = max(fits, key=lambda x: x.elbo)
+
+        best.sample_ids = list(self.cluster_densities.keys())
+
+        best.grid = self.grid
+
+        return best
+
+    def _build_problem(self, data):
+        tables = []
+
+        log_priors = []
+
+        for sample_id, density in self.cluster_densities.items():
+            packed = density.pack(_sample_data(data, sample_id))
+
+            tables.append(np.maximum(self.grid.log_likelihood_table(density, packed), _LOG_FLOOR))
+
+            log_prior = self.grid.log_prior(self.base_measures[sample_id])
+
+            log_priors.append(log_prior - log_sum_exp_array(log_prior))
+
+        return {
+                'tables' : tables,
+                'log_priors' : log_priors,
+                'alpha_priors' : self.alpha_priors,
+                'truncation' : self.truncation,
+                'max_iters' : self.max_iters,
+                'tol' : self.tol
+                }
+
+class VariationalFit(object):
+    '''
+    Result of one coordinate ascent run of VariationalDPMixture.
+
+    Attributes:
+        responsibilities : (numpy.ndarray) len(data) x truncation array of q(z_i = k).
+
+        atoms : (list) One truncation x grid_size array of the grid probabilities of q(phi_ks) per sample.
+
+        sticks : (numpy.ndarray) (truncation - 1) x 2 array of the Beta parameters of q(v_k).
+
+        alpha_shape, alpha_rate : (float) Parameters of q(alpha).
+
+        elbo : (float) Final ELBO.
+
+        elbo_trace : (list) ELBO after every sweep.
+
+        converged : (bool) Whether the ELBO converged before max_iters sweeps.
+    '''
+    def __init__(self, responsibilities, atoms, sticks, alpha_shape, alpha_rate, elbo_trace, converged):
+        self.responsibilities = responsibilities
+
+        self.atoms = atoms
+
+        self.sticks = sticks
+
+        self.alpha_shape = alpha_shape
+
+        self.alpha_rate = alpha_rate
+
+        self.elbo_trace = elbo_trace
+
+        self.elbo = elbo_trace[-1]
+
+        self.converged = converged
+
+    @property
+    def num_iters(self):
+        return len(self.elbo_trace)
+
+    @property
+    def labels(self):
+        '''
+        Most probable component of each data point, numbered 0, 1, ... in order of the component index.
+        '''
+        return np.unique(np.argmax(self.responsibilities, axis=1), return_inverse=True)[1]
+
+    @property
+    def number_of_cells(self):
+        return len(np.unique(np.argmax(self.responsibilities, axis=1)))
+
+    def prevalence_summary(self, quantiles=(0.025, 0.5, 0.975)):
+        '''
+        Per sample mean, standard deviation and quantiles of the approximate posterior of the atom of each data point,
+        which is the mixture of the component atoms weighted by the responsibilities.
+
+        Returns:
+            summary : (OrderedDict) Sample ID to a list of the mean, std and quantile arrays, as written by
+                                    summary.write_prevalence_summary.
+        '''
+        points = self.grid.points
+
+        summary = OrderedDict()
+
+        for sample_id, atoms in zip(self.sample_ids, self.atoms):
+            p = np.dot(self.responsibilities, atoms)
+
+            mean = np.dot(p, points)
+
+            std = np.sqrt(np.maximum(np.dot(p, points ** 2) - mean ** 2, 0))
+
+            cdf = np.cumsum(p, axis=1)
+
+            columns = [mean, std]
+
+            for q in quantiles:
+                index = np.minimum((cdf < q * cdf[:, -1:]).sum(axis=1), len(points) - 1)
+
+                columns.append(points[index])
+
+            summary[sample_id] = columns
+
+        return summary
+
+    def alpha_summary(self, quantiles=(0.025, 0.5, 0.975), num_draws=100000, rng=None):
+        '''
+        Mean, standard deviation and quantiles of q(alpha). The quantiles are estimated from num_draws draws.
+        '''
+        draws = get_stream(rng).gamma(self.alpha_shape, 1 / self.alpha_rate, size=num_draws)
+
+        summary = OrderedDict([('mean', self.alpha_shape / self.alpha_rate),
+                               ('std', np.sqrt(self.alpha_shape) / self.alpha_rate)])
+
+        for q in quantiles:
+            summary['q{0}'.format(q)] = float(np.percentile(draws, 100 * q))
+
+        return summary
+
+def _fit(problem, rng):
+    '''
+    One coordinate ascent run from random responsibilities.
+    '''
+    tables = problem['tables']
+
+    log_priors = problem['log_priors']
+
+    K = problem['truncation']
+
+    a = float(problem['alpha_priors']['shape'])
+
+    b = float(problem['alpha_priors']['rate'])
+
+    n = tables[0].shape[0]
+
+    r = rng.gamma(1.0, size=(n, K))
+
+    r /= r.sum(axis=1)[:, np.newaxis]
+
+    alpha_shape = a + K - 1
+
+    alpha_rate = b
+
+    elbo_trace = []
+
+    converged = False
+
+    for _ in range(problem['max_iters']):
+        counts = r.sum(axis=0)
+
+        # Atoms
+        log_q_atoms = [log_prior + np.dot(r.T, table) for log_prior, table in zip(log_priors, tables)]
+
+        log_q_atoms = [x - log_sum_exp_array(x)[:, np.newaxis] for x in log_q_atoms]
+
+        q_atoms = [np.exp(x) for x in log_q_atoms]
+
+        # Sticks
+        e_alpha = alpha_shape / alpha_rate
+
+        tail_counts = counts[::-1].cumsum()[::-1] - counts
+
+        gamma_1 = 1 + counts[:-1]
+
+        gamma_2 = e_alpha + tail_counts[:-1]
+
+        digamma_sum = digamma_array(gamma_1 + gamma_2)
+
+        e_log_v = digamma_array(gamma_1) - digamma_sum
+
+        e_log_one_minus_v = digamma_array(gamma_2) - digamma_sum
+
+        # Concentration
+        alpha_rate = b - e_log_one_minus_v.sum()
+
+        e_alpha = alpha_shape / alpha_rate
+
+        e_log_alpha = digamma_array([alpha_shape])[0] - log(alpha_rate)
+
+        # Assignments
+        e_log_w = np.concatenate((e_log_v, [0])) + np.concatenate(([0], np.cumsum(e_log_one_minus_v)))
+
+        e_log_lik = sum(np.dot(table, q.T) for table, q in zip(tables, q_atoms))
+
+        log_r = e_log_w + e_log_lik
+
+        log_r -= log_sum_exp_array(log_r)[:, np.newaxis]
+
+        r = np.exp(log_r)
+
+        # ELBO
+        elbo = (r * (e_log_lik + e_log_w - log_r)).sum()
+
+        elbo += ((K - 1) * e_log_alpha + (e_alpha - 1) * e_log_one_minus_v.sum())
+
+        elbo += (log_gamma_array(gamma_1) + log_gamma_array(gamma_2) - log_gamma_array(gamma_1 + gamma_2) -
+                 (gamma_1 - 1) * e_log_v - (gamma_2 - 1) * e_log_one_minus_v).sum()
+
+        elbo += a * log(b) - lgamma(a) + (a - 1) * e_log_alpha - b * e_alpha
+
+        elbo -= alpha_shape * log(alpha_rate) - lgamma(alpha_shape) + (alpha_shape - 1) * e_log_alpha - alpha_rate * e_alpha
+
+        for log_prior, q, log_q in zip(log_priors, q_atoms, log_q_atoms):
+            elbo += (q * (log_prior - log_q)).sum()
+
+        elbo_trace.append(float(elbo))
+
+        if len(elbo_trace) > 1 and abs(elbo_trace[-1] - elbo_trace[-2]) <= problem['tol'] * abs(elbo_trace[-1]):
+            converged = True
+
+            break
+
+    return VariationalFit(r, q_atoms, np.column_stack((gamma_1, gamma_2)), alpha_shape, alpha_rate, elbo_trace, converged)
+
+def _sample_data(data, sample_id):
+    if sample_id is None:
+        return data
+
+    if hasattr(data, 'sample'):
+        return data.sample(sample_id)
+
+    return [x[sample_id] for x in data]
+
+_worker_problem = None
+
+def _init_worker(problem):
+    global _worker_problem
+
+    _worker_problem = problem
+
+def _fit_worker(rng):
+    return _fit(_worker_problem, rng)
@@ -0,0 +1,442 @@
+'''
+Throughput and scaling benchmarks of the DirichletProcess samplers on synthetic PyClone data with known clones.
+
+Run as a script to benchmark every combination of the requested sizes, copy number profiles, priors and samplers, and
+write the results as JSON, e.g.
+
+    python benchmark.py --num-mutations 1000 10000 --num-samples 1 5 --out benchmark.json
+
+Each sampler first runs num_warmup iterations, by default num_iters // 2, during which the slice atom sampler adapts
+its bracket widths as it does during the burnin of a run. It is then run for at most num_iters iterations or until
+max_time seconds have passed. Iterations per second and the effective number of samples of alpha and of the number of
+clusters per second are reported for these iterations only. Trace writing is benchmarked separately for every data
+size.
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict
+
+import numpy as np
+
+import priors
+
+from diagnostics import effective_sample_size
+from pyclone_binomial import get_pyclone_binomial_data, get_pyclone_binomial_sampler
+from trace import AsyncTrace, BinaryTrace, DiskTrace
+from DirichletProcess.measures import BetaData
+from DirichletProcess.rng import RandomStream
+
+# (minor_cn, major_cn) pairs drawn uniformly for every mutation in every sample
+CN_PROFILES = OrderedDict([
+    ('diploid', [(1, 1)]),
+    ('loh', [(1, 1), (0, 1), (0, 2)]),
+    ('amplified', [(1, 1), (1, 2), (2, 2), (1, 3), (2, 3)]),
+])
+
+PRIORS = ['AB', 'BB', 'NoZygosity', 'TCN', 'PCN']
+
+PARTITION_SAMPLERS = ['auxillary', 'metropolis_gibbs', 'split_merge', 'blocked_gibbs', 'parallel']
+
+ATOM_SAMPLERS = ['metropolis', 'grid', 'slice']
+
+TRACE_FORMATS = ['tsv', 'binary']
+
+
+def simulate_data(num_mutations, num_samples, cn_profile='diploid', prior='TCN', num_clones=4, depth=200,
+                  tumour_content=1.0, error_rate=0.001, rng=None):
+    '''
+    Simulate read counts from the PyClone model for mutations in num_clones clones.
+
+    Every clone has a cellular prevalence in each sample, and every mutation belongs to one clone. The copy number of
+    each mutation in each sample is drawn from CN_PROFILES[cn_profile], its true genotype state from the states given
+    by priors.getPrior, and its variant read count from the binomial likelihood of the model.
+
+    Returns a tuple (data, sample_ids, labels, prevalences) where data maps mutation IDs to an OrderedDict of sample
+    IDs to PyCloneBinomialData, labels is the clone of every mutation and prevalences is a clones x samples array.
+    '''
+    if rng is None:
+        rng = RandomStream()
+
+    sample_ids = ['sample_{0}'.format(i) for i in range(num_samples)]
+
+    mutation_ids = ['mutation_{0}'.format(i) for i in range(num_mutations)]
+
+    prevalences = rng.uniform(0.05, 1.0, size=(num_clones, num_samples))
+
+    labels = rng.randint(0, num_clones, size=num_mutations)
+
+    phi = prevalences[labels]
+
+    cn_states = CN_PROFILES[cn_profile]
+
+    cn_index = rng.randint(0, len(cn_states), size=(num_mutations, num_samples))
+
+    d = rng.randint(depth // 2, depth + depth // 2 + 1, size=(num_mutations, num_samples))
+
+    b = np.zeros((num_mutations, num_samples), dtype=int)
+
+    templates = []
+
+    for k, (minor_cn, major_cn) in enumerate(cn_states):
+        states = priors.getPrior(prior, 2, minor_cn, major_cn)
+
+        template = get_pyclone_binomial_data(0, 0, states, error_rate)
+
+        templates.append(template)
+
+        mask = cn_index == k
+
+        num_points = mask.sum()
+
+        if num_points == 0:
+            continue
+
+        state_index = rng.categorical(np.exp(template.log_pi), size=num_points)
+
+        cn_n, cn_r, cn_v, mu_n, mu_r, mu_v = [np.asarray(x)[state_index] for x in template[2:8]]
+
+        t = tumour_content
+
+        p_n = (1 - t) * cn_n
+        p_r = t * (1 - phi[mask]) * cn_r
+        p_v = t * phi[mask] * cn_v
+
+        mu = (p_n * mu_n + p_r * mu_r + p_v * mu_v) / (p_n + p_r + p_v)
+
+        b[mask] = rng.binomial(d[mask], mu)
+
+    data = OrderedDict()
+
+    for i, mutation_id in enumerate(mutation_ids):
+        data[mutation_id] = OrderedDict((sample_id, templates[cn_index[i, j]]._replace(b=int(b[i, j]), d=int(d[i, j])))
+                                        for j, sample_id in enumerate(sample_ids))
+
+    return data, sample_ids, labels, prevalences
+
+
+def benchmark_sampler(data, sample_ids, partition_sampler, num_iters=20, max_time=60.0, init_method='together',
+                      tumour_content=1.0, num_warmup=None, rng=None, **kwargs):
+    '''
+    Time the iterations of a sampler built by get_pyclone_binomial_sampler on data.
+
+    Kwargs are passed on to get_pyclone_binomial_sampler.
+
+    num_warmup iterations, by default num_iters // 2, are run first and are left out of the timing, the effective sample
+    sizes and the evaluation counts. They are passed on as adapt_iters, so the slice atom sampler is measured with the
+    bracket widths it adapted, as in run_pyclone_binomial_analysis where it adapts during the burnin. The warm-up also
+    stops after max_time seconds.
+
+    Returns a dict of the number of iterations run, the time taken and the throughput. For atom samplers which count
+    their likelihood evaluations, such as the slice sampler, the mean number of evaluations per atom update is also
+    given, so the cost per effective sample can be compared with samplers which use one evaluation per update.
+    '''
+    if num_warmup is None:
+        num_warmup = num_iters // 2
+
+    kwargs.setdefault('adapt_iters', num_warmup)
+
+    sampler = get_pyclone_binomial_sampler(sample_ids,
+                                           dict((sample_id, tumour_content) for sample_id in sample_ids),
+                                           1.0,
+                                           {'shape' : 1.0, 'rate' : 0.001},
+                                           partition_sampler=partition_sampler,
+                                           rng=rng,
+                                           **kwargs)
+
+    values = data.values()
+
+    start = time.time()
+
+    sampler.initialise_partition(values, init_method)
+
+    init_time = time.time() - start
+
+    atom_samplers = [x for x in sampler.atom_sampler.atom_samplers.values() if hasattr(x, 'num_evaluations')]
+
+    alpha = []
+
+    num_clusters = []
+
+    try:
+        start = time.time()
+
+        warmup_iters = 0
+
+        while warmup_iters < num_warmup and time.time() - start < max_time:
+            sampler.interactive_sample(values)
+
+            warmup_iters += 1
+
+        warmup_time = time.time() - start
+
+        warmup_updates = sum(x.num_updates for x in atom_samplers)
+
+        warmup_evaluations = sum(x.num_evaluations for x in atom_samplers)
+
+        start = time.time()
+
+        while len(alpha) < num_iters and time.time() - start < max_time:
+            sampler.interactive_sample(values)
+
+            alpha.append(sampler.alpha)
+
+            num_clusters.append(sampler.number_of_cells)
+
+        elapsed = time.time() - start
+
+    finally:
+        sampler.close()
+
+    num_updates = sum(x.num_updates for x in atom_samplers) - warmup_updates
+
+    num_evaluations = sum(x.num_evaluations for x in atom_samplers) - warmup_evaluations
+
+    ess = OrderedDict([('alpha', _effective_sample_size(alpha)),
+                       ('num_clusters', _effective_sample_size(num_clusters))])
+
+    min_ess = _min(ess.values())
+
+    return OrderedDict([
+        ('iterations', len(alpha)),
+        ('init_seconds', init_time),
+        ('warmup_iterations', warmup_iters),
+        ('warmup_seconds', warmup_time),
+        ('seconds', elapsed),
+        ('iters_per_sec', len(alpha) / elapsed),
+        ('ess', ess),
+        ('ess_per_sec', None if min_ess is None else min_ess / elapsed),
+        ('final_num_clusters', num_clusters[-1] if num_clusters else None),
+        ('atom_evaluations_per_update', num_evaluations / float(num_updates) if num_updates > 0 else None),
+    ])
+
+
+def benchmark_trace(data, sample_ids, labels, prevalences, trace_format='tsv', async_trace=False, num_updates=100):
+    '''
+    Time num_updates writes of a state holding the true clustering to a trace in a temporary directory.
+
+    Returns a dict of the time taken, the updates per second and the size of the trace on disk.
+    '''
+    state = {
+        'alpha' : 1.0,
+        'labels' : [int(x) for x in labels],
+        'params' : [OrderedDict((sample_id, BetaData(float(x))) for sample_id, x in zip(sample_ids, prevalences[label]))
+                    for label in labels],
+        'global_params' : None
+    }
+
+    trace_dir = tempfile.mkdtemp(prefix='pyclone_benchmark_')
+
+    try:
+        if trace_format == 'tsv':
+            trace = DiskTrace(trace_dir, sample_ids, data.keys(), {'cellular_frequencies' : 'x'})
+
+        else:
+            trace = BinaryTrace(trace_dir, sample_ids, data.keys(), {'cellular_frequencies' : 'x'})
+
+        if async_trace:
+            trace = AsyncTrace(trace)
+
+        start = time.time()
+
+        trace.open()
+
+        for _ in range(num_updates):
+            trace.update(state)
+
+        trace.close()
+
+        elapsed = time.time() - start
+
+        size = sum(os.path.getsize(os.path.join(trace_dir, x)) for x in os.listdir(trace_dir))
+
+    finally:
+        shutil.rmtree(trace_dir)
+
+    return OrderedDict([
+        ('updates', num_updates),
+        ('seconds', elapsed),
+        ('updates_per_sec', num_updates / elapsed),
+        ('bytes', size),
+    ])
+
+
+def run_benchmarks(num_mutations=(1000, 10000, 100000), num_samples=(1, 5, 20), cn_profiles=None, prior_names=None,
+                   partition_samplers=None, atom_samplers=('metropolis', ), trace_formats=None, num_iters=20,
+                   max_time=60.0, num_warmup=None, num_trace_updates=100, seed=0, log=sys.stdout):
+    '''
+    Run every combination of the benchmarks and return the results as a JSON serialisable dict.
+
+    Every simulated data set and every sampler run gets its own stream spawned from a stream seeded with seed, so
+    results do not depend on which other benchmarks are run.
+    '''
+    if cn_profiles is None:
+        cn_profiles = list(CN_PROFILES.keys())
+
+    if prior_names is None:
+        prior_names = PRIORS
+
+    if partition_samplers is None:
+        partition_samplers = PARTITION_SAMPLERS
+
+    if trace_formats is None:
+        trace_formats = TRACE_FORMATS
+
+    configs = [(m, s, cn_profile, prior)
+               for m in num_mutations for s in num_samples for cn_profile in cn_profiles for prior in prior_names]
+
+    streams = RandomStream(seed).spawn(len(configs))
+
+    sampler_results = []
+
+    trace_results = []
+
+    for (m, s, cn_profile, prior), rng in zip(configs, streams):
+        data, sample_ids, labels, prevalences = simulate_data(m, s, cn_profile, prior, rng=rng)
+
+        config = OrderedDict([('num_mutations', m), ('num_samples', s), ('cn_profile', cn_profile), ('prior', prior)])
+
+        samplers = [(x, y) for x in partition_samplers for y in atom_samplers]
+
+        for (partition_sampler, atom_sampler), sampler_rng in zip(samplers, rng.spawn(len(samplers))):
+            result = OrderedDict(config)
+
+            result['partition_sampler'] = partition_sampler
+
+            result['atom_sampler'] = atom_sampler
+
+            result.update(benchmark_sampler(data,
+                                            sample_ids,
+                                            partition_sampler,
+                                            num_iters=num_iters,
+                                            max_time=max_time,
+                                            num_warmup=num_warmup,
+                                            rng=sampler_rng,
+                                            atom_sampler=atom_sampler))
+
+            sampler_results.append(result)
+
+            log.write('{0} {1} {2} {3} {4} {5}: {6:.3f} iters/sec\n'.format(m, s, cn_profile, prior, partition_sampler,
+                                                                            atom_sampler, result['iters_per_sec']))
+
+        # Trace size and cost only depend on the numbers of mutations and samples
+        if cn_profile != cn_profiles[0] or prior != prior_names[0]:
+            continue
+
+        for trace_format in trace_formats:
+            for async_trace in (False, True):
+                result = OrderedDict([('num_mutations', m),
+                                      ('num_samples', s),
+                                      ('trace_format', trace_format),
+                                      ('async_trace', async_trace)])
+
+                result.update(benchmark_trace(data,
+                                              sample_ids,
+                                              labels,
+                                              prevalences,
+                                              trace_format=trace_format,
+                                              async_trace=async_trace,
+                                              num_updates=num_trace_updates))
+
+                trace_results.append(result)
+
+                log.write('{0} {1} {2} async={3}: {4:.3f} updates/sec\n'.format(m, s, trace_format, async_trace,
+                                                                                 result['updates_per_sec']))
+
+    return OrderedDict([
+        ('metadata', OrderedDict([
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('python', platform.python_version()),
+            ('numpy', np.__version__),
+            ('platform', platform.platform()),
+            ('seed', seed),
+            ('num_iters', num_iters),
+            ('max_time', max_time),
+            ('num_warmup', num_iters // 2 if num_warmup is None else num_warmup),
+        ])),
+        ('samplers', sampler_results),
+        ('traces', trace_results),
+    ])
+
+
+def _effective_sample_size(x):
+    # The split chain estimator needs at least two draws in each half
+    if len(x) < 4:
+        return None
+
+    ess = float(effective_sample_size(np.array([x], dtype=float)))
+
+    if not np.isfinite(ess):
+        return None
+
+    return ess
+
+
+def _min(values):
+    values = [x for x in values if x is not None]
+
+    if not values:
+        return None
+
+    return min(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the DirichletProcess samplers on synthetic data.')
+
+    parser.add_argument('--num-mutations', type=int, nargs='+', default=[1000, 10000, 100000])
+
+    parser.add_argument('--num-samples', type=int, nargs='+', default=[1, 5, 20])
+
+    parser.add_argument('--cn-profiles', nargs='+', choices=list(CN_PROFILES.keys()), default=None)
+
+    parser.add_argument('--priors', nargs='+', choices=PRIORS, default=None)
+
+    parser.add_argument('--partition-samplers', nargs='+', choices=PARTITION_SAMPLERS, default=None)
+
+    parser.add_argument('--atom-samplers', nargs='+', choices=ATOM_SAMPLERS, default=['metropolis'])
+
+    parser.add_argument('--trace-formats', nargs='+', choices=TRACE_FORMATS, default=None)
+
+    parser.add_argument('--num-iters', type=int, default=20)
+
+    parser.add_argument('--max-time', type=float, default=60.0,
+                        help='Seconds after which a sampler is stopped, even if num-iters is not reached.')
+
+    parser.add_argument('--num-warmup', type=int, default=None,
+                        help='Untimed iterations run first, in which the slice sampler adapts. Default num-iters // 2.')
+
+    parser.add_argument('--num-trace-updates', type=int, default=100)
+
+    parser.add_argument('--seed', type=int, default=0)
+
+    parser.add_argument('--out', default='benchmark.json')
+
+    args = parser.parse_args()
+
+    results = run_benchmarks(num_mutations=args.num_mutations,
+                             num_samples=args.num_samples,
+                             cn_profiles=args.cn_profiles,
+                             prior_names=args.priors,
+                             partition_samplers=args.partition_samplers,
+                             atom_samplers=args.atom_samplers,
+                             trace_formats=args.trace_formats,
+                             num_iters=args.num_iters,
+                             max_time=args.max_time,
+                             num_warmup=args.num_warmup,
+                             num_trace_updates=args.num_trace_updates,
+                             seed=args.seed,
+                             log=sys.stdout)
+
+    with open(args.out, 'w') as fh:
+        json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+'''
+Convergence diagnostics computed across several independent chains written by DiskTrace.
+'''
+import csv
+import os
+
+import numpy as np
+
+from trace import BinaryTraceReader, iter_bz2_lines
+
+
+def load_chains(trace_dirs, sample_ids, burnin=0):
+    '''
+    Read the traces of several chains into arrays of shape chains x iterations (x mutations).
+
+    Both the bz2 tsv traces of DiskTrace and the binary traces of BinaryTrace can be read.
+
+    Chains are truncated to the length of the shortest one so they can be stacked.
+
+    Returns a dict with keys 'alpha', 'num_clusters' and 'mutation_ids', and one 'cellular_prevalence' array per
+    sample stored under (sample_id, 'cellular_prevalence').
+    '''
+    alpha = []
+    num_clusters = []
+    prevalences = dict((sample_id, []) for sample_id in sample_ids)
+
+    for trace_dir in trace_dirs:
+        if os.path.exists(os.path.join(trace_dir, 'alpha.bin')):
+            reader = BinaryTraceReader(trace_dir)
+            mutation_ids = reader.mutation_ids
+
+            alpha.append(reader.alpha[burnin:])
+            num_clusters.append([len(np.unique(row)) for row in reader.labels[burnin:]])
+
+            for sample_id in sample_ids:
+                prevalences[sample_id].append(reader.cellular_prevalence(sample_id)[burnin:])
+
+            continue
+
+        _, rows = _read_trace_file(os.path.join(trace_dir, 'alpha.tsv.bz2'), header=False)
+        alpha.append([float(row[0]) for row in rows[burnin:]])
+
+        mutation_ids, rows = _read_trace_file(os.path.join(trace_dir, 'labels.tsv.bz2'))
+        num_clusters.append([len(set(row)) for row in rows[burnin:]])
+
+        for sample_id in sample_ids:
+            file_name = os.path.join(trace_dir, '{0}.cellular_prevalence.tsv.bz2'.format(sample_id))
+            _, rows = _read_trace_file(file_name)
+            prevalences[sample_id].append(np.array(rows[burnin:], dtype=float))
+
+    chains = {
+        'mutation_ids': mutation_ids,
+        'alpha': _stack(alpha),
+        'num_clusters': _stack(num_clusters),
+    }
+
+    for sample_id in sample_ids:
+        chains[(sample_id, 'cellular_prevalence')] = _stack(prevalences[sample_id])
+
+    return chains
+
+
+def potential_scale_reduction(chains):
+    '''
+    Split R-hat of Gelman et al. for chains of shape chains x iterations (x parameters).
+
+    Each chain is split in half so that within chain drift is also detected. Values close to 1 indicate convergence.
+    '''
+    chains = _split_chains(chains)
+    m, n = chains.shape[:2]
+
+    chain_means = chains.mean(axis=1)
+    chain_vars = chains.var(axis=1, ddof=1)
+
+    b = n * chain_means.var(axis=0, ddof=1)
+    w = chain_vars.mean(axis=0)
+
+    var_plus = (n - 1) / float(n) * w + b / n
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r_hat = np.sqrt(var_plus / w)
+
+    # Parameters which never moved in any chain have converged trivially
+    return np.where(w > 0, r_hat, 1.0)
+
+
+def effective_sample_size(chains):
+    '''
+    Multi chain effective sample size for chains of shape chains x iterations (x parameters).
+
+    Autocorrelations are combined across chains as in Gelman et al. and truncated with Geyer's initial monotone
+    sequence estimator.
+    '''
+    chains = _split_chains(chains)
+    m, n = chains.shape[:2]
+
+    scalar = chains.ndim == 2
+
+    chains = chains.reshape(m, n, -1)
+
+    centred = chains - chains.mean(axis=1, keepdims=True)
+
+    # Autocovariance of each chain via FFT, padded to avoid circular wrap around
+    size = 2 ** int(np.ceil(np.log2(2 * n)))
+    f = np.fft.rfft(centred, n=size, axis=1)
+    acov = np.fft.irfft(f * np.conjugate(f), n=size, axis=1)[:, :n] / n
+
+    chain_vars = acov[:, 0] * n / (n - 1.0)
+    w = chain_vars.mean(axis=0)
+    var_plus = (n - 1.0) / n * w + chains.mean(axis=1).var(axis=0, ddof=1)
+
+    ess = np.empty(chains.shape[2])
+
+    for k in range(chains.shape[2]):
+        if var_plus[k] <= 0:
+            ess[k] = m * n
+            continue
+
+        rho = 1 - (w[k] - acov[:, :, k].mean(axis=0)) / var_plus[k]
+
+        ess[k] = m * n / _integrated_autocorrelation_time(rho)
+
+    if scalar:
+        return ess[0]
+
+    return ess
+
+
+def summarise_chains(chains, sample_ids):
+    '''
+    Compute R-hat and ESS for alpha, the number of clusters and the cellular prevalence of every mutation.
+
+    Returns a list of (parameter, r_hat, ess) tuples.
+    '''
+    summary = []
+
+    for param in ['alpha', 'num_clusters']:
+        summary.append((param, float(potential_scale_reduction(chains[param])), float(effective_sample_size(chains[param]))))
+
+    for sample_id in sample_ids:
+        values = chains[(sample_id, 'cellular_prevalence')]
+
+        r_hat = potential_scale_reduction(values)
+        ess = effective_sample_size(values)
+
+        for mutation_id, r, e in zip(chains['mutation_ids'], r_hat, ess):
+            summary.append(('{0}:{1}:cellular_prevalence'.format(sample_id, mutation_id), float(r), float(e)))
+
+    return summary
+
+
+def write_summary(file_name, summary):
+    with open(file_name, 'w') as fh:
+        writer = csv.writer(fh, delimiter='\t')
+
+        writer.writerow(['parameter', 'r_hat', 'ess'])
+
+        for row in summary:
+            writer.writerow(row)
+
+
+def _integrated_autocorrelation_time(rho):
+    # Geyer's initial positive and monotone sequence of sums of consecutive autocorrelation pairs
+    tau = -1.0
+    last_pair = None
+
+    for t in range(0, len(rho) - 1, 2):
+        pair = rho[t] + rho[t + 1]
+
+        if pair < 0:
+            break
+
+        if last_pair is not None:
+            pair = min(pair, last_pair)
+
+        tau += 2 * pair
+        last_pair = pair
+
+    return max(tau, 1.0 / np.log10(max(len(rho), 10)))
+
+
+def _read_trace_file(file_name, header=True):
+    rows = [_decode_row(row) for row in iter_bz2_lines(file_name)]
+
+    if header:
+        return rows[0], rows[1:]
+
+    return None, rows
+
+
+def _decode_row(line):
+    if not isinstance(line, str):
+        line = line.decode('utf-8')
+
+    return line.rstrip('\r\n').split('\t')
+
+
+def _split_chains(chains):
+    chains = np.asarray(chains, dtype=float)
+    n = chains.shape[1] // 2
+
+    return np.concatenate([chains[:, :n], chains[:, n:2 * n]], axis=0)
+
+
+def _stack(chains):
+    n = min(len(x) for x in chains)
+
+    return np.array([np.asarray(x[:n], dtype=float) for x in chains])
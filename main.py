@@ -5,24 +5,29 @@
   Date last modified  : 11/1/2016
   Python Version      : 3.4
 '''
-import priors
+import os
+
 import utility
 import pyclone_binomial
 
 
 
-# Load data
-data, sample_ids = utility.loadData()
+# Load data, one file per sample, keeping the mutations found in every sample
+paths = [os.path.join("./Data", filename) for filename in sorted(os.listdir("./Data")) if filename.endswith(".tsv")]
+
+joined = utility.joinSamples(utility.loadSamples(paths), missing="intersect")
+
+sample_ids = joined["sample_ids"]
 
 # Define prior < AB | BB | NoZygosity | TCN | PCN >
 prior = "TCN"
 
-# Get possible states for each mutation
-mutations = priors.getMutations(prior, data)
+error_rate = 0.001
 
-#data, sample_ids, tumour_content, trace_dir, num_iters, alpha, alpha_priors
+# Get possible states for each mutation in each sample
+mutations = pyclone_binomial.build_pyclone_binomial_data(joined, prior, error_rate)
 
-error_rate = 0.001
+#data, sample_ids, tumour_content, trace_dir, num_iters, alpha, alpha_priors
 
 tumour_content = {}
 for id in sample_ids:
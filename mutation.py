@@ -8,10 +8,13 @@
 
 
 
-class Mutation():
+class Mutation(object):
   """ Mutation
-  Helper class that keeps track of each mutation and it's states
+  Helper class that keeps track of each mutation and it's states. Uses
+  __slots__ so a mutation costs a few pointers instead of an attribute dict.
   """
+  __slots__ = ("id", "ref_counts", "var_counts", "states")
+
   def __init__(self, mutation_id, ref_counts, var_counts):
     self.id = mutation_id
     self.ref_counts = ref_counts
@@ -5,6 +5,10 @@
   Date last modified  : 11/1/2016
   Python Version      : 3.4
 '''
+from math import log
+
+import numpy as np
+
 import mutation
 
 
@@ -23,7 +27,7 @@ def getMutations(prior, data):
 
   for i in data:
     # Creates a mutation object
-    m = mutation.Mutation(i["mutation_id"], i["ref_counts"], i["var_counts"])
+    m = mutation.Mutation(i["mutation_id"], int(i["ref_counts"]), int(i["var_counts"]))
 
     # Creates states corresponding to that mutation
     states = getPrior(prior, int(i["normal_cn"]), int(i["minor_cn"]), int(i["major_cn"]))
@@ -36,6 +40,113 @@ def getMutations(prior, data):
   return mutations
 
 
+def compileStates(states, error_rate=0.001):
+  ''' compileStates
+  Converts the genotype tuples of a prior into the numeric arrays read by the
+  likelihood, so the genotype strings are only looked at once.
+
+  ------------------------------------------------------------------------------
+  Input   : states     - (g_n, g_r, g_v, prior weight) tuples from getPrior
+          : error_rate - probability of reading a variant allele from a
+                         genotype without one, and a reference allele from a
+                         genotype without one
+  Output  : cn     - k x 3 uint8 array of c(g_n), c(g_r), c(g_v)
+          : mu     - k x 3 array of the variant allele probability of g_n, g_r, g_v
+          : log_pi - length k array of normalised log prior weights
+  '''
+  total_weight = float(sum(state[3] for state in states))
+
+  cn = np.empty((len(states), 3), dtype=np.uint8)
+  mu = np.empty((len(states), 3))
+  log_pi = np.empty(len(states))
+
+  for s, (g_n, g_r, g_v, prior_weight) in enumerate(states):
+    cn[s] = (len(g_n), len(g_r), len(g_v))
+    mu[s] = [getVariantAlleleProbability(g, error_rate) for g in (g_n, g_r, g_v)]
+    log_pi[s] = log(prior_weight / total_weight)
+
+  return cn, mu, log_pi
+
+
+class StateRegistry(object):
+  """ StateRegistry
+  Memoised store of the compiled states of each copy number configuration.
+  The states of a mutation only depend on (prior, normal_cn, minor_cn,
+  major_cn), so each distinct configuration is built and compiled once and
+  interned under a small integer group id. Mutations then only need to keep
+  their group id.
+  """
+  def __init__(self, error_rate=0.001):
+    self.error_rate = error_rate
+    self.group_ids = {}
+    self.keys = []
+    self.states = []
+
+
+  def getGroup(self, prior, normal_cn, minor_cn, major_cn):
+    ''' getGroup
+    Returns the group id of a copy number configuration, compiling its states
+    the first time it is seen.
+
+    ------------------------------------------------------------------------------
+    Input   : prior name
+            : normal_cn, minor_cn, major_cn - copy numbers of the mutation
+    Output  : group id
+    '''
+    key = (prior, int(normal_cn), int(minor_cn), int(major_cn))
+
+    if key not in self.group_ids:
+      self.group_ids[key] = len(self.keys)
+      self.keys.append(key)
+      self.states.append(compileStates(getPrior(*key), self.error_rate))
+
+    return self.group_ids[key]
+
+
+  def getGroups(self, prior, normal_cn, minor_cn, major_cn):
+    ''' getGroups
+    Vectorised getGroup over arrays of copy numbers. Only the distinct
+    configurations are looked up.
+
+    ------------------------------------------------------------------------------
+    Input   : prior name
+            : normal_cn, minor_cn, major_cn - equally shaped integer arrays
+    Output  : int32 array of group ids with the same shape
+    '''
+    cn = np.stack([np.asarray(x, dtype=np.int64) for x in (normal_cn, minor_cn, major_cn)], axis=-1)
+
+    configurations, inverse = np.unique(cn.reshape(-1, 3), axis=0, return_inverse=True)
+
+    group_ids = np.array([self.getGroup(prior, *x) for x in configurations.tolist()], dtype=np.int32)
+
+    return group_ids[inverse].reshape(cn.shape[:-1])
+
+
+  def __len__(self):
+    return len(self.keys)
+
+
+def getVariantAlleleProbability(genotype, error_rate):
+  ''' getVariantAlleleProbability
+  Probability of sampling a variant (B) allele from a cell with the genotype,
+  such as 'AAB'.
+
+  ------------------------------------------------------------------------------
+  Input   : genotype string
+          : error rate
+  Output  : probability
+  '''
+  c = len(genotype)
+  b = genotype.count("B")
+
+  if b == 0:
+    return error_rate
+  elif b == c:
+    return 1 - error_rate
+
+  return b / float(c)
+
+
 def getPrior(prior, normal_cn, minor_cn, major_cn):
   ''' getPrior
   Flow control, returns one of theses priors (AB | BB | NoZygosity | TCN | PCN )
@@ -203,7 +314,7 @@ def PCNPrior(normal_cn, minor_cn, major_cn):
 
 
   states = []
-  for s in g_v:
+  for s in range(len(g_v)):
     states.append((g_n, g_r[s], g_v[s], 1))
 
   return states
\ No newline at end of file
@@ -1,19 +1,277 @@
 __author__ = 'mateusz'
 
+import json
+import os
+
 from collections import OrderedDict, namedtuple
-from trace import DiskTrace
+from multiprocessing import Pool
+
+import priors
+
+from pyclone.utils import make_directory
+
+from diagnostics import load_chains, summarise_chains, write_summary
+from similarity import write_clusters
+from summary import SummaryTrace, write_prevalence_summary
+from trace import AsyncTrace, BinaryTrace, DiskTrace, MultiTrace
 from DirichletProcess.measures import BetaBaseMeasure, MultiSampleBaseMeasure
-from DirichletProcess.densities import PyCloneBinomialDensity, MultiSampleDensity
-from DirichletProcess.samplers.atom import BaseMeasureAtomSampler, MultiSampleAtomSampler
-from DirichletProcess.samplers.partition import AuxillaryParameterPartitionSampler
+from DirichletProcess.profiling import SamplerProfiler
+from DirichletProcess.densities import MultiSampleDensity, PackedData, PyCloneBinomialData, PyCloneBinomialDataArray, \
+                                       PyCloneBinomialDensity
+from DirichletProcess.rng import RandomStream
+from DirichletProcess.samplers.atom import BaseMeasureAtomSampler, BaseMeasureProposalFunction, GridAtomSampler, \
+                                          MultiSampleAtomSampler, SliceAtomSampler
+from DirichletProcess.samplers.partition import AuxillaryParameterPartitionSampler, CollapsedGridPartitionSampler, \
+                                               MetropolisGibbsPartitionSampler, SplitMergeAuxillaryHybridSampler
+from DirichletProcess.samplers.blocked import BlockedGibbsSampler
 from DirichletProcess.samplers.dp import DirichletProcessSampler
+from DirichletProcess.samplers.parallel import ParallelPartitionSampler
+from DirichletProcess.variational import VariationalDPMixture
 
 PyCloneBinomialParameter = namedtuple('PyCloneBinomialParameter', 'tumour_content')
 
-def run_pyclone_binomial_analysis(data, sample_ids, tumour_content, trace_dir, num_iters, alpha, alpha_priors):
+def run_pyclone_binomial_analysis(data, sample_ids, tumour_content, trace_dir, num_iters, alpha, alpha_priors,
+                                  atom_sampler='metropolis', grid_size=1001, partition_sampler='auxillary',
+                                  sample_mode='serial', num_workers=None, trace_format='tsv', async_trace=False,
+                                  burnin=0, thin=1, summary=False, checkpoint_freq=None, resume=False, rng=None,
+                                  profile=False, profile_capture=None, profile_memory=False, truncation=50,
+                                  num_partition_workers=2):
+    '''
+    Kwargs:
+        atom_sampler : (str) How to update the cellular prevalences.
+                             - 'metropolis' uses Metropolis-Hastings steps with the base measure as proposal.
+                             - 'grid' samples exactly from the conditional on a grid of grid_size points.
+                             - 'slice' uses slice sampling on the logit scale, with the bracket widths adapted during
+                               the burnin. See SliceAtomSampler.
+
+        partition_sampler : (str) How to update the clustering of the mutations.
+                                  - 'auxillary' uses algorithm 8 of Neal with auxiliary cellular prevalences.
+                                  - 'collapsed' integrates the cellular prevalences out on a grid of grid_size points.
+                                  - 'metropolis_gibbs' and 'split_merge', see get_pyclone_binomial_sampler.
+                                  - 'blocked_gibbs' replaces the DP sampler with BlockedGibbsSampler, which truncates
+                                    the DP to truncation components and updates all assignments in one batch.
+                                  - 'parallel' runs algorithm 8 on num_partition_workers processes with
+                                    ParallelPartitionSampler, which is exact for any number of workers.
+
+        sample_mode : (str) How the per-sample prevalences are updated. One of 'serial', 'vectorised' (needs
+                            atom_sampler='grid'), 'threads' or 'processes'. See MultiSampleAtomSampler.
+
+        num_workers : (int) Number of threads or processes for sample_mode 'threads' or 'processes'.
+
+        trace_format : (str) 'tsv' writes bz2 compressed tsv files with DiskTrace. 'binary' writes fixed dtype arrays
+                             with BinaryTrace, which can be memory mapped with BinaryTraceReader. 'none' writes no
+                             raw trace, which only makes sense together with summary=True.
+
+        async_trace : (bool) If True the trace is written by a background thread, see AsyncTrace.
+
+        burnin : (int) Number of initial iterations which are not written to the trace.
+
+        thin : (int) Only every thin-th iteration after the burnin is written to the trace.
+
+        summary : (bool) If True posterior summaries are accumulated while sampling and written to trace_dir when the
+                         run finishes, see SummaryTrace.
+
+        checkpoint_freq : (int) If given the sampler and trace are checkpointed to trace_dir/checkpoint.pickle every
+                                checkpoint_freq iterations.
+
+        resume : (bool) If True and a checkpoint exists in trace_dir, continue that run, appending to its trace. If no
+                        checkpoint exists a new run is started, so it is safe to always pass resume=True.
+
+        rng : (RandomStream) Stream used for every random draw of the run. Defaults to the shared default stream.
+
+        profile : (bool) If True per iteration phase timings and counters are appended to trace_dir/profile.jsonl, see
+                         SamplerProfiler.
+
+        profile_capture : (tuple) (start, stop) range of iterations to run cProfile over when profile is True. The
+                                  statistics are written to trace_dir/profile.prof.
+
+        profile_memory : (bool) Also trace memory allocations during the profile_capture window. Needs Python 3.4+.
+
+        truncation : (int) Number of stick-breaking components for partition_sampler='blocked_gibbs'.
+
+        num_partition_workers : (int) Number of worker processes for partition_sampler='parallel'.
+    '''
+    _check_burnin_thin(burnin, thin)
+
+    sampler = get_pyclone_binomial_sampler(sample_ids,
+                                           tumour_content,
+                                           alpha,
+                                           alpha_priors,
+                                           atom_sampler=atom_sampler,
+                                           grid_size=grid_size,
+                                           partition_sampler=partition_sampler,
+                                           sample_mode=sample_mode,
+                                           num_workers=num_workers,
+                                           adapt_iters=burnin,
+                                           truncation=truncation,
+                                           num_partition_workers=num_partition_workers,
+                                           rng=rng)
+
+    traces = []
+
+    if trace_format == 'tsv':
+        traces.append(DiskTrace(trace_dir, sample_ids, data.keys(), {'cellular_frequencies' : 'x'}))
+
+    elif trace_format == 'binary':
+        traces.append(BinaryTrace(trace_dir, sample_ids, data.keys(), {'cellular_frequencies' : 'x'}))
+
+    elif trace_format != 'none':
+        raise ValueError('{0} is not a valid trace format. Use tsv, binary or none.'.format(trace_format))
+
+    if summary:
+        traces.append(SummaryTrace(trace_dir, sample_ids, data.keys(), {'cellular_frequencies' : 'x'}))
+
+    if not traces:
+        raise ValueError('Nothing would be recorded. Use a trace_format other than none or set summary=True.')
+
+    if len(traces) == 1:
+        trace = traces[0]
+
+    else:
+        trace = MultiTrace(traces)
+
+    if async_trace:
+        trace = AsyncTrace(trace)
+
+    checkpoint_file = os.path.join(trace_dir, 'checkpoint.pickle')
+
+    if resume and os.path.exists(checkpoint_file):
+        trace.open(sampler.load_checkpoint(checkpoint_file))
+
+    else:
+        resume = False
+
+        trace.open()
+
+    if checkpoint_freq is None:
+        checkpoint_file = None
+
+    if profile:
+        profiler = SamplerProfiler(os.path.join(trace_dir, 'profile.jsonl'),
+                                   capture_iters=profile_capture,
+                                   capture_file=os.path.join(trace_dir, 'profile.prof'),
+                                   trace_memory=profile_memory)
+
+    else:
+        profiler = None
+
+    try:
+        sampler.sample(data.values(),
+                       trace,
+                       num_iters,
+                       burnin=burnin,
+                       thin=thin,
+                       checkpoint_file=checkpoint_file,
+                       checkpoint_freq=checkpoint_freq,
+                       resume=resume,
+                       profiler=profiler)
+
+    finally:
+        sampler.close()
+
+    trace.close()
+
+
+def get_pyclone_binomial_sampler(sample_ids, tumour_content, alpha, alpha_priors, atom_sampler='metropolis',
+                                 grid_size=1001, partition_sampler='auxillary', sample_mode='serial', num_workers=None,
+                                 adapt_iters=0, truncation=50, num_partition_workers=2, rng=None):
+    '''
+    Build the DirichletProcessSampler used by run_pyclone_binomial_analysis, see there for the arguments.
+
+    partition_sampler can also be 'metropolis_gibbs' for algorithm 7 of Neal, or 'split_merge' for the hybrid of
+    sequentially allocated split-merge moves and algorithm 8.
+
+    adapt_iters is the number of iterations during which the slice atom sampler adapts its bracket widths.
+
+    If partition_sampler is 'blocked_gibbs' a BlockedGibbsSampler with truncation components is returned instead of a
+    DirichletProcessSampler.
+
+    If partition_sampler is 'parallel' the partition is updated by a ParallelPartitionSampler with num_partition_workers
+    worker processes, which should be shut down with the close() method of the returned sampler.
+    '''
+    base_measure, cluster_density = get_pyclone_binomial_model(sample_ids, tumour_content, rng=rng)
+
+    sample_base_measures = base_measure.base_measures
+
+    sample_cluster_densities = cluster_density.cluster_densities
 
     sample_atom_samplers = OrderedDict()
 
+    for sample_id in sample_ids:
+        if atom_sampler == 'metropolis':
+            sample_atom_samplers[sample_id] = BaseMeasureAtomSampler(sample_base_measures[sample_id],
+                                                                     sample_cluster_densities[sample_id],
+                                                                     rng=rng)
+
+        elif atom_sampler == 'grid':
+            sample_atom_samplers[sample_id] = GridAtomSampler(sample_base_measures[sample_id],
+                                                              sample_cluster_densities[sample_id],
+                                                              grid_size=grid_size,
+                                                              rng=rng)
+
+        elif atom_sampler == 'slice':
+            sample_atom_samplers[sample_id] = SliceAtomSampler(sample_base_measures[sample_id],
+                                                               sample_cluster_densities[sample_id],
+                                                               adapt_iters=adapt_iters,
+                                                               rng=rng)
+
+        else:
+            raise ValueError('{0} is not a valid atom sampler. Use metropolis, grid or slice.'.format(atom_sampler))
+
+    atom_sampler = MultiSampleAtomSampler(base_measure,
+                                          cluster_density,
+                                          sample_atom_samplers,
+                                          mode=sample_mode,
+                                          num_workers=num_workers,
+                                          rng=rng)
+
+    if partition_sampler == 'blocked_gibbs':
+        return BlockedGibbsSampler(atom_sampler,
+                                   base_measure,
+                                   cluster_density,
+                                   alpha=alpha,
+                                   alpha_priors=alpha_priors,
+                                   truncation=truncation,
+                                   rng=rng)
+
+    if partition_sampler == 'auxillary':
+        partition_sampler = AuxillaryParameterPartitionSampler(base_measure, cluster_density, rng=rng)
+
+    elif partition_sampler == 'collapsed':
+        partition_sampler = CollapsedGridPartitionSampler(base_measure, cluster_density, grid_size=grid_size, rng=rng)
+
+    elif partition_sampler == 'metropolis_gibbs':
+        partition_sampler = MetropolisGibbsPartitionSampler(base_measure, cluster_density, rng=rng)
+
+    elif partition_sampler == 'split_merge':
+        partition_sampler = SplitMergeAuxillaryHybridSampler(base_measure,
+                                                             cluster_density,
+                                                             BaseMeasureProposalFunction(base_measure),
+                                                             rng=rng)
+
+    elif partition_sampler == 'parallel':
+        partition_sampler = ParallelPartitionSampler(base_measure,
+                                                     cluster_density,
+                                                     num_workers=num_partition_workers,
+                                                     rng=rng)
+
+    else:
+        raise ValueError('{0} is not a valid partition sampler. Use auxillary, collapsed, metropolis_gibbs, '
+                         'split_merge, blocked_gibbs or parallel.'.format(partition_sampler))
+
+    return DirichletProcessSampler(atom_sampler, partition_sampler, alpha, alpha_priors, rng=rng)
+
+
+def get_pyclone_binomial_model(sample_ids, tumour_content, rng=None):
+    '''
+    Build the base measure and cluster density of the PyCloneBinomial DP mixture, a uniform Beta(1, 1) prior on the
+    cellular prevalence and a PyCloneBinomialDensity in each sample.
+
+    Returns:
+        base_measure : (MultiSampleBaseMeasure)
+
+        cluster_density : (MultiSampleDensity)
+    '''
     sample_base_measures = OrderedDict()
 
     sample_cluster_densities = OrderedDict()
@@ -22,27 +280,208 @@ def run_pyclone_binomial_analysis(data, sample_ids, tumour_content, trace_dir, n
     base_measure_beta = 1
 
     for sample_id in sample_ids:
-        sample_base_measures[sample_id] = BetaBaseMeasure(base_measure_alpha, base_measure_beta)
+        sample_base_measures[sample_id] = BetaBaseMeasure(base_measure_alpha, base_measure_beta, rng=rng)
 
         sample_cluster_densities[sample_id] = PyCloneBinomialDensity(PyCloneBinomialParameter(tumour_content[sample_id]))
 
-        sample_atom_samplers[sample_id] = BaseMeasureAtomSampler(sample_base_measures[sample_id],
-                                                                 sample_cluster_densities[sample_id])
+    return MultiSampleBaseMeasure(sample_base_measures), MultiSampleDensity(sample_cluster_densities)
 
-    base_measure = MultiSampleBaseMeasure(sample_base_measures)
 
-    cluster_density = MultiSampleDensity(sample_cluster_densities)
+def run_pyclone_binomial_variational_analysis(data, sample_ids, tumour_content, out_dir, alpha_priors, truncation=50,
+                                              grid_size=201, max_iters=500, tol=1e-6, num_restarts=4,
+                                              num_processes=1, rng=None):
+    '''
+    Fit a mean-field variational approximation of the PyCloneBinomial DP mixture instead of sampling it, see
+    VariationalDPMixture. This takes seconds where run_pyclone_binomial_analysis takes thousands of iterations, at the
+    cost of the approximation underestimating the posterior uncertainty.
 
-    atom_sampler = MultiSampleAtomSampler(base_measure, cluster_density, sample_atom_samplers)
+    The outputs have the same format as those of the MCMC path:
+        - out_dir/cellular_prevalence_summary.tsv and out_dir/summary.json as written by SummaryTrace, with the
+          prevalence summaries of each mutation taken from its mixture over the approximate cluster posteriors.
+        - out_dir/consensus_clusters.tsv as written by similarity.run_consensus_clustering, with the most probable
+          cluster of each mutation.
 
-    partition_sampler = AuxillaryParameterPartitionSampler(base_measure, cluster_density)
+    summary.json also has the final ELBO, the number of coordinate ascent sweeps and the ELBO of every restart.
 
-    sampler = DirichletProcessSampler(atom_sampler, partition_sampler, alpha, alpha_priors)
+    Kwargs:
+        truncation : (int) Number of stick-breaking components.
 
-    trace = DiskTrace(trace_dir, sample_ids, data.keys(), {'cellular_frequencies' : 'x'})
+        grid_size : (int) Number of grid points the cellular prevalences are discretised to.
 
-    trace.open()
+        max_iters : (int) Largest number of coordinate ascent sweeps of a restart.
 
-    sampler.sample(data.values(), trace, num_iters)
+        tol : (float) Relative change of the ELBO at which a restart stops.
 
-    trace.close()
+        num_restarts : (int) Number of restarts from random starting points. The one with the highest ELBO is kept.
+
+        num_processes : (int) Number of processes the restarts are run in.
+
+        rng : (RandomStream) Stream the restarts are seeded from. Defaults to the shared default stream.
+
+    Returns:
+        fit : (VariationalFit) The restart with the highest ELBO.
+    '''
+    base_measure, cluster_density = get_pyclone_binomial_model(sample_ids, tumour_content, rng=rng)
+
+    model = VariationalDPMixture(base_measure,
+                                 cluster_density,
+                                 alpha_priors,
+                                 truncation=truncation,
+                                 grid_size=grid_size,
+                                 max_iters=max_iters,
+                                 tol=tol,
+                                 num_restarts=num_restarts,
+                                 num_processes=num_processes,
+                                 rng=rng)
+
+    fit = model.fit(data.values())
+
+    make_directory(out_dir)
+
+    mutation_ids = list(data.keys())
+
+    quantiles = (0.025, 0.5, 0.975)
+
+    write_prevalence_summary(os.path.join(out_dir, 'cellular_prevalence_summary.tsv'),
+                             mutation_ids,
+                             fit.prevalence_summary(quantiles),
+                             quantiles)
+
+    write_clusters(os.path.join(out_dir, 'consensus_clusters.tsv'), mutation_ids, fit.labels)
+
+    summary = {
+        'num_iters': fit.num_iters,
+        'converged': fit.converged,
+        'elbo': fit.elbo,
+        'restart_elbos': model.restart_elbos,
+        'alpha': fit.alpha_summary(quantiles, rng=rng),
+        'num_clusters': {str(fit.number_of_cells): 1},
+    }
+
+    with open(os.path.join(out_dir, 'summary.json'), 'w') as fh:
+        json.dump(summary, fh, indent=2, sort_keys=True)
+
+    return fit
+
+
+def get_pyclone_binomial_data(ref_counts, var_counts, states, error_rate=0.001):
+    '''
+    Build the PyCloneBinomialData of a mutation in one sample.
+
+    Args:
+        ref_counts, var_counts : (int) Number of reads with the reference and the variant allele.
+
+        states : (list) (g_n, g_r, g_v, prior_weight) genotype tuples as returned by priors.getPrior.
+
+    Kwargs:
+        error_rate : (float) Probability of reading a variant allele from a genotype without one, and a reference
+                             allele from a genotype without one.
+    '''
+    cn, mu, log_pi = priors.compileStates(states, error_rate)
+
+    return PyCloneBinomialData(b=int(var_counts),
+                               d=int(ref_counts) + int(var_counts),
+                               cn_n=tuple(cn[:, 0].tolist()),
+                               cn_r=tuple(cn[:, 1].tolist()),
+                               cn_v=tuple(cn[:, 2].tolist()),
+                               mu_n=tuple(mu[:, 0].tolist()),
+                               mu_r=tuple(mu[:, 1].tolist()),
+                               mu_v=tuple(mu[:, 2].tolist()),
+                               log_pi=tuple(log_pi.tolist()))
+
+def build_pyclone_binomial_data(joined, prior, error_rate=0.001):
+    '''
+    Build the data argument of run_pyclone_binomial_analysis from the mutation x sample arrays of
+    utility.joinSamples.
+
+    Each distinct (normal_cn, minor_cn, major_cn) is interned once in a priors.StateRegistry, and every mutation in
+    every sample only keeps the group id of its configuration. The data of each sample is written straight into a
+    PyCloneBinomialDataArray, so no per mutation Python objects are created.
+
+    Args:
+        joined : (dict) Output of utility.joinSamples.
+
+        prior : (str) Name of the prior, see priors.getPrior.
+
+    Kwargs:
+        error_rate : (float) See get_pyclone_binomial_data.
+
+    Returns:
+        data : (PackedData) Data points of the mutations, with the mutation IDs as keys.
+    '''
+    registry = priors.StateRegistry(error_rate)
+
+    groups = registry.getGroups(prior, joined['normal_cn'], joined['minor_cn'], joined['major_cn'])
+
+    packed = OrderedDict()
+
+    for j, sample_id in enumerate(joined['sample_ids']):
+        b = joined['var_counts'][:, j]
+
+        d = joined['ref_counts'][:, j] + b
+
+        packed[sample_id] = PyCloneBinomialDataArray.from_groups(b, d, groups[:, j], registry.states)
+
+    return PackedData(packed, ids=list(joined['mutation_ids']))
+
+
+def run_pyclone_binomial_multichain_analysis(data, sample_ids, tumour_content, trace_dir, num_iters, alpha,
+                                             alpha_priors, num_chains=4, num_processes=None, seed=None, **kwargs):
+    '''
+    Run num_chains independent chains of run_pyclone_binomial_analysis in a process pool.
+
+    Chain i writes its trace to trace_dir/chain_i and draws from the i-th stream spawned from a RandomStream seeded with
+    seed. Once all chains finish, R-hat and the effective sample size of alpha, the number of clusters and every
+    cellular prevalence are computed from the traces and written to trace_dir/diagnostics.tsv. The burnin and thin
+    kwargs of run_pyclone_binomial_analysis apply to every chain, so the diagnostics only see the recorded iterations.
+
+    Kwargs:
+        num_processes : (int) Size of the process pool. Defaults to one process per chain.
+
+        seed : (int) Seed of the stream the chain streams are spawned from. If None it is seeded from the OS.
+
+        kwargs : Passed on to run_pyclone_binomial_analysis.
+
+    Returns:
+        summary : (list) (parameter, r_hat, ess) tuples.
+    '''
+    _check_burnin_thin(kwargs.get('burnin', 0), kwargs.get('thin', 1))
+
+    if num_processes is None:
+        num_processes = num_chains
+
+    chain_dirs = [os.path.join(trace_dir, 'chain_{0}'.format(i)) for i in range(num_chains)]
+
+    chain_streams = RandomStream(seed).spawn(num_chains)
+
+    chain_args = [(rng, data, sample_ids, tumour_content, chain_dir, num_iters, alpha, alpha_priors, kwargs)
+                  for rng, chain_dir in zip(chain_streams, chain_dirs)]
+
+    pool = Pool(num_processes)
+
+    try:
+        pool.map(_run_chain, chain_args)
+
+    finally:
+        pool.close()
+
+        pool.join()
+
+    summary = summarise_chains(load_chains(chain_dirs, sample_ids), sample_ids)
+
+    write_summary(os.path.join(trace_dir, 'diagnostics.tsv'), summary)
+
+    return summary
+
+def _check_burnin_thin(burnin, thin):
+    if burnin < 0:
+        raise ValueError('burnin must be at least 0, got {0}.'.format(burnin))
+
+    if thin < 1:
+        raise ValueError('thin must be at least 1, got {0}.'.format(thin))
+
+def _run_chain(args):
+    rng, data, sample_ids, tumour_content, trace_dir, num_iters, alpha, alpha_priors, kwargs = args
+
+    run_pyclone_binomial_analysis(data, sample_ids, tumour_content, trace_dir, num_iters, alpha, alpha_priors, rng=rng,
+                                  **kwargs)
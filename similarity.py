@@ -0,0 +1,369 @@
+'''
+Posterior similarity (co-clustering) matrix and consensus clustering computed from the labels trace.
+'''
+import csv
+import os
+
+import numpy as np
+
+from trace import BinaryTraceReader, iter_bz2_lines
+
+
+class LabelsTrace(object):
+    '''
+    Labels trace written by DiskTrace (labels.tsv.bz2) or BinaryTrace (labels.bin), restricted to every thin-th
+    iteration after the first burnin.
+
+    The iterations are read with iter_batches, straight from the bz2 stream or the memory mapped file, so the trace is
+    never held in memory. Each call of iter_batches is one pass over the trace, which for the tsv trace means
+    decompressing it again. The number of iterations is counted with one pass when the trace is opened.
+    '''
+    def __init__(self, trace_dir, burnin=0, thin=1):
+        self.trace_dir = trace_dir
+        self.burnin = burnin
+        self.thin = thin
+
+        self.binary = os.path.exists(os.path.join(trace_dir, 'labels.bin'))
+
+        if self.binary:
+            reader = BinaryTraceReader(trace_dir)
+
+            self.mutation_ids = reader.mutation_ids
+
+            num_rows = reader.labels.shape[0]
+
+        else:
+            lines = iter_bz2_lines(os.path.join(trace_dir, 'labels.tsv.bz2'))
+
+            self.mutation_ids = _decode_row(next(lines))
+
+            num_rows = sum(1 for _ in lines)
+
+        self.num_iters = max(0, (num_rows - burnin + thin - 1) // thin)
+
+    @property
+    def shape(self):
+        return self.num_iters, len(self.mutation_ids)
+
+    def iter_batches(self, batch_size):
+        '''
+        Yield int32 arrays of shape (iteration, mutation) holding at most batch_size consecutive iterations.
+        '''
+        if self.binary:
+            labels = BinaryTraceReader(self.trace_dir).labels[self.burnin::self.thin]
+
+            for start in range(0, labels.shape[0], batch_size):
+                yield np.asarray(labels[start:start + batch_size], dtype=np.int32)
+
+            return
+
+        lines = iter_bz2_lines(os.path.join(self.trace_dir, 'labels.tsv.bz2'))
+
+        next(lines)
+
+        rows = []
+
+        for i, line in enumerate(lines):
+            if i >= self.burnin and (i - self.burnin) % self.thin == 0:
+                rows.append(_decode_row(line))
+
+                if len(rows) == batch_size:
+                    yield np.array(rows, dtype=np.int32)
+
+                    rows = []
+
+        if rows:
+            yield np.array(rows, dtype=np.int32)
+
+
+def load_labels(trace_dir, burnin=0, thin=1):
+    '''
+    Read the labels trace written by DiskTrace (labels.tsv.bz2) or BinaryTrace (labels.bin) into memory.
+
+    Returns the mutation ids and an int32 array of shape (iteration, mutation) holding every thin-th iteration after
+    the first burnin. The array takes 4 x iterations x mutations bytes, so for large traces use LabelsTrace, which the
+    functions of this module also accept in place of the array.
+    '''
+    trace = LabelsTrace(trace_dir, burnin=burnin, thin=thin)
+
+    batches = list(trace.iter_batches(1000))
+
+    if not batches:
+        return trace.mutation_ids, np.empty((0, len(trace.mutation_ids)), dtype=np.int32)
+
+    return trace.mutation_ids, np.vstack(batches)
+
+
+def iter_similarity_tiles(labels, tile_size=2000, batch_size=200):
+    '''
+    Yield (row_start, row_stop, col_start, col_stop, tile) for the upper triangle of tiles of the posterior similarity
+    matrix. labels is an (iteration, mutation) array or a LabelsTrace.
+
+    Each tile is computed as a product of one-hot encodings of the labels. The one-hot columns of a batch of
+    batch_size iterations are laid side by side, so the co-clustering counts of the whole batch come from one matrix
+    product. All tiles of a band of tile_size rows are accumulated in one pass over the iterations, so at most
+    tile_size x n counts and batch_size iterations are held at a time, and a LabelsTrace is read once per row band.
+    '''
+    num_iters, n = labels.shape
+
+    for row_start in range(0, n, tile_size):
+        row_stop = min(row_start + tile_size, n)
+
+        col_starts = list(range(row_start, n, tile_size))
+
+        tiles = [np.zeros((row_stop - row_start, min(col_start + tile_size, n) - col_start))
+                 for col_start in col_starts]
+
+        for batch in _iter_batches(labels, batch_size):
+            columns = _one_hot_columns(batch)
+
+            width = int(columns.max()) + 1
+
+            a = _one_hot(columns[:, row_start:row_stop], width)
+
+            for col_start, tile in zip(col_starts, tiles):
+                if col_start == row_start:
+                    b = a
+                else:
+                    b = _one_hot(columns[:, col_start:col_start + tile_size], width)
+
+                tile += np.dot(a, b.T)
+
+        for col_start, tile in zip(col_starts, tiles):
+            tile /= num_iters
+
+            yield row_start, row_stop, col_start, col_start + tile.shape[1], tile
+
+
+def posterior_similarity_matrix(labels, tile_size=2000, batch_size=200):
+    '''
+    Dense n x n posterior similarity matrix. Only suitable when n x n floats fit in memory.
+    '''
+    n = labels.shape[1]
+
+    psm = np.empty((n, n))
+
+    for row_start, row_stop, col_start, col_stop, tile in iter_similarity_tiles(labels, tile_size, batch_size):
+        psm[row_start:row_stop, col_start:col_stop] = tile
+        psm[col_start:col_stop, row_start:row_stop] = tile.T
+
+    return psm
+
+
+def sparse_posterior_similarity_matrix(labels, threshold=0.5, tile_size=2000, batch_size=200):
+    '''
+    Entries of the posterior similarity matrix which are at least threshold, as coordinate arrays (rows, cols, values)
+    with rows < cols. The diagonal, which is always 1, is left out.
+    '''
+    rows = []
+    cols = []
+    values = []
+
+    for row_start, row_stop, col_start, col_stop, tile in iter_similarity_tiles(labels, tile_size, batch_size):
+        i, j = np.nonzero(tile >= threshold)
+
+        i = i + row_start
+        j = j + col_start
+
+        upper = i < j
+
+        rows.append(i[upper])
+        cols.append(j[upper])
+        values.append(tile[i[upper] - row_start, j[upper] - col_start])
+
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+
+
+def consensus_partition(labels, max_candidates=500, batch_size=200):
+    '''
+    Pick the sampled partition which maximises the posterior expected adjusted Rand index (PEAR) of Fritsch and
+    Ickstadt, using the trace as the posterior sample. labels is an (iteration, mutation) array or a LabelsTrace.
+
+    At most max_candidates evenly spaced iterations are tried. The expected number of co-clustered pairs shared with a
+    candidate is computed from contingency tables between the candidate and each sampled partition, which takes O(n)
+    time and memory per pair, so the similarity matrix is never built. The trace is read twice, once to pick the
+    candidates and once to compare them with every iteration, and only the candidates are held in memory.
+
+    Returns the consensus labels, relabelled 0, 1, ... by decreasing cluster size, and their PEAR. With fewer than two
+    mutations there are no pairs to compare, so a single cluster with a PEAR of 1 is returned.
+    '''
+    num_iters, n = labels.shape
+
+    if n < 2:
+        return np.zeros(n, dtype=int), 1.0
+
+    num_pairs = n * (n - 1) / 2.0
+
+    step = max(1, -(-num_iters // max_candidates))
+
+    # Pairs co-clustered in each iteration, whose mean is the sum over pairs i < j of the posterior similarity matrix
+    sample_pairs = []
+    candidates = []
+
+    for batch in _iter_batches(labels, batch_size):
+        for x in batch:
+            x = _compact(x)
+
+            if len(sample_pairs) % step == 0:
+                candidates.append(x)
+
+            sample_pairs.append(_num_pairs_in_clusters(x))
+
+    sample_pairs = np.array(sample_pairs)
+    psm_sum = sample_pairs.mean()
+
+    # Sum over pairs co-clustered in each candidate of the posterior similarity matrix
+    shared_pairs = np.zeros(len(candidates))
+
+    for batch in _iter_batches(labels, batch_size):
+        for x in batch:
+            x = _compact(x)
+
+            shared_pairs += [_num_shared_pairs(candidate, x) for candidate in candidates]
+
+    shared_pairs /= num_iters
+
+    best_labels = None
+    best_pear = -np.inf
+
+    for candidate, candidate_pairs, candidate_shared_pairs in zip(candidates, sample_pairs[::step], shared_pairs):
+        expected = candidate_pairs * psm_sum / num_pairs
+        denominator = 0.5 * (candidate_pairs + psm_sum) - expected
+
+        if denominator == 0:
+            pear = 1.0
+        else:
+            pear = (candidate_shared_pairs - expected) / denominator
+
+        if pear > best_pear:
+            best_pear = pear
+            best_labels = candidate
+
+    return _relabel_by_size(best_labels), best_pear
+
+
+def run_consensus_clustering(trace_dir, out_dir, burnin=0, thin=1, max_dense=5000, threshold=0.5,
+                             max_candidates=500, tile_size=2000):
+    '''
+    Compute the consensus clusters and posterior similarity matrix of a trace and write them to out_dir.
+
+    The clusters go to consensus_clusters.tsv. The similarity matrix is written to similarity_matrix.npz, dense if
+    there are at most max_dense mutations and otherwise as the sparse coordinates of the entries of at least
+    threshold.
+
+    The trace is streamed with LabelsTrace, so besides the output the memory use is about tile_size x n floats for a
+    row band of the similarity matrix and max_candidates x n labels for the consensus. The trace is read
+    3 + n / tile_size times.
+    '''
+    labels = LabelsTrace(trace_dir, burnin=burnin, thin=thin)
+
+    mutation_ids = labels.mutation_ids
+
+    if labels.num_iters == 0:
+        raise ValueError('No iterations of the trace in {0} are left with burnin={1} and thin={2}, use a smaller '
+                         'burnin.'.format(trace_dir, burnin, thin))
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    consensus, pear = consensus_partition(labels, max_candidates=max_candidates)
+
+    write_clusters(os.path.join(out_dir, 'consensus_clusters.tsv'), mutation_ids, consensus)
+
+    file_name = os.path.join(out_dir, 'similarity_matrix.npz')
+
+    if len(mutation_ids) <= max_dense:
+        np.savez_compressed(file_name,
+                            mutation_ids=np.array(mutation_ids),
+                            matrix=posterior_similarity_matrix(labels, tile_size))
+
+    else:
+        rows, cols, values = sparse_posterior_similarity_matrix(labels, threshold, tile_size)
+
+        np.savez_compressed(file_name,
+                            mutation_ids=np.array(mutation_ids),
+                            rows=rows,
+                            cols=cols,
+                            values=values.astype(np.float32),
+                            threshold=threshold)
+
+    return consensus, pear
+
+
+def write_clusters(file_name, mutation_ids, labels):
+    '''
+    Write the cluster of each mutation as a tsv with the columns mutation_id and cluster_id.
+    '''
+    with open(file_name, 'w') as fh:
+        writer = csv.writer(fh, delimiter='\t')
+
+        writer.writerow(['mutation_id', 'cluster_id'])
+
+        for mutation_id, cluster_id in zip(mutation_ids, labels):
+            writer.writerow([mutation_id, cluster_id])
+
+
+def _iter_batches(labels, batch_size):
+    if isinstance(labels, np.ndarray):
+        for start in range(0, labels.shape[0], batch_size):
+            yield labels[start:start + batch_size]
+
+    else:
+        for batch in labels.iter_batches(batch_size):
+            yield batch
+
+
+def _compact(labels):
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def _decode_row(line):
+    if not isinstance(line, str):
+        line = line.decode('utf-8')
+
+    return line.rstrip('\r\n').split('\t')
+
+
+def _num_pairs_in_clusters(labels):
+    sizes = np.bincount(labels).astype(float)
+
+    return ((sizes * sizes).sum() - labels.shape[0]) / 2.0
+
+
+def _num_shared_pairs(labels_a, labels_b):
+    # Pairs which are together in both partitions, from the contingency table of the two
+    width = int(labels_b.max()) + 1
+
+    counts = np.bincount(labels_a.astype(np.int64) * width + labels_b).astype(float)
+
+    return ((counts * counts).sum() - labels_a.shape[0]) / 2.0
+
+
+def _one_hot(columns, width):
+    num_iters, n = columns.shape
+
+    one_hot = np.zeros((n, width), dtype=np.float32)
+
+    one_hot[np.arange(n)[:, np.newaxis], columns.T] = 1
+
+    return one_hot
+
+
+def _one_hot_columns(labels):
+    # Shift the labels of each iteration so different iterations use disjoint columns
+    widths = labels.max(axis=1).astype(np.int64) + 1
+
+    offsets = np.concatenate([[0], np.cumsum(widths)[:-1]])
+
+    return labels + offsets[:, np.newaxis]
+
+
+def _relabel_by_size(labels):
+    sizes = np.bincount(labels)
+
+    order = np.argsort(-sizes, kind='mergesort')
+
+    new_labels = np.empty(order.shape[0], dtype=int)
+    new_labels[order] = np.arange(order.shape[0])
+
+    return new_labels[labels]
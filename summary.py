@@ -0,0 +1,231 @@
+'''
+Streaming posterior summaries which are updated once per recorded iteration instead of being computed from a trace.
+'''
+import csv
+import json
+import os
+
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+from pyclone.utils import make_directory
+
+
+class SummaryTrace(object):
+    '''
+    Drop in replacement for DiskTrace which keeps running posterior summaries in memory and writes them when closed.
+    It only sees the iterations the sampler records, so burnin and thinning apply to it as they do to DiskTrace.
+
+    Per sample and mutation it keeps the mean and variance of the cellular prevalence and P^2 estimates of the
+    quantiles. It also keeps a histogram of the number of clusters and the mean, variance and quantiles of alpha.
+
+    On close the prevalence summaries are written to trace_dir/cellular_prevalence_summary.tsv and the rest to
+    trace_dir/summary.json. checkpoint() returns the accumulators, and passing them to open() carries on from them.
+    '''
+    def __init__(self, trace_dir, sample_ids, mutation_ids, attribute_map, quantiles=(0.025, 0.5, 0.975)):
+        self.trace_dir = trace_dir
+        self.sample_ids = sample_ids
+        self.mutation_ids = list(mutation_ids)
+        self.attribute_map = attribute_map
+        self.quantiles = quantiles
+
+    def checkpoint(self):
+        return {
+            'prevalence_moments': self.prevalence_moments,
+            'prevalence_quantiles': self.prevalence_quantiles,
+            'alpha_moments': self.alpha_moments,
+            'alpha_quantiles': self.alpha_quantiles,
+            'num_clusters': self.num_clusters,
+        }
+
+    def open(self, resume_state=None):
+        make_directory(self.trace_dir)
+
+        if resume_state is not None:
+            self.__dict__.update(resume_state)
+
+            return
+
+        n = len(self.mutation_ids)
+
+        self.prevalence_moments = dict((x, RunningMoments(n)) for x in self.sample_ids)
+        self.prevalence_quantiles = dict((x, [P2Quantile(q, n) for q in self.quantiles]) for x in self.sample_ids)
+
+        self.alpha_moments = RunningMoments(1)
+        self.alpha_quantiles = [P2Quantile(q, 1) for q in self.quantiles]
+
+        self.num_clusters = Counter()
+
+    def update(self, state):
+        attr = self.attribute_map['cellular_frequencies']
+
+        for sample_id in self.sample_ids:
+            x = np.array([getattr(param[sample_id], attr) for param in state['params']], dtype=float)
+
+            self.prevalence_moments[sample_id].update(x)
+
+            for estimator in self.prevalence_quantiles[sample_id]:
+                estimator.update(x)
+
+        alpha = np.array([state['alpha']], dtype=float)
+
+        self.alpha_moments.update(alpha)
+
+        for estimator in self.alpha_quantiles:
+            estimator.update(alpha)
+
+        self.num_clusters[len(set(state['labels']))] += 1
+
+    def close(self):
+        quantile_names = ['q{0}'.format(q) for q in self.quantiles]
+
+        columns = OrderedDict()
+
+        for sample_id in self.sample_ids:
+            moments = self.prevalence_moments[sample_id]
+            columns[sample_id] = [moments.mean, moments.std] + [x.value for x in self.prevalence_quantiles[sample_id]]
+
+        write_prevalence_summary(os.path.join(self.trace_dir, 'cellular_prevalence_summary.tsv'),
+                                 self.mutation_ids,
+                                 columns,
+                                 self.quantiles)
+
+        summary = {
+            'num_iters': int(self.alpha_moments.count),
+            'alpha': {
+                'mean': float(self.alpha_moments.mean[0]),
+                'std': float(self.alpha_moments.std[0]),
+            },
+            'num_clusters': dict((str(k), v) for k, v in sorted(self.num_clusters.items())),
+        }
+
+        for name, estimator in zip(quantile_names, self.alpha_quantiles):
+            summary['alpha'][name] = float(estimator.value[0])
+
+        with open(os.path.join(self.trace_dir, 'summary.json'), 'w') as fh:
+            json.dump(summary, fh, indent=2, sort_keys=True)
+
+
+def write_prevalence_summary(file_name, mutation_ids, columns, quantiles):
+    '''
+    Write per sample and mutation prevalence summaries as a tsv with the columns mutation_id, sample_id, mean, std and
+    one per quantile.
+
+    columns maps each sample ID to a list of the mean, std and quantile arrays, each with one value per mutation.
+    '''
+    quantile_names = ['q{0}'.format(q) for q in quantiles]
+
+    with open(file_name, 'w') as fh:
+        writer = csv.writer(fh, delimiter='\t')
+
+        writer.writerow(['mutation_id', 'sample_id', 'mean', 'std'] + quantile_names)
+
+        for sample_id, sample_columns in columns.items():
+            for i, mutation_id in enumerate(mutation_ids):
+                writer.writerow([mutation_id, sample_id] + ['{0:.6g}'.format(x[i]) for x in sample_columns])
+
+
+class RunningMoments(object):
+    '''
+    Welford's online mean and variance of a vector of n values.
+    '''
+    def __init__(self, n):
+        self.count = 0
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+
+    @property
+    def std(self):
+        if self.count < 2:
+            return np.zeros(self.mean.shape)
+
+        return np.sqrt(self.m2 / (self.count - 1))
+
+    def update(self, x):
+        self.count += 1
+
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+
+class P2Quantile(object):
+    '''
+    P^2 estimate of the p quantile of a stream of vectors of n values (Jain and Chlamtac 1985), done for all n values
+    at once. Uses five markers per value, so the memory does not grow with the number of updates.
+    '''
+    def __init__(self, p, n):
+        self.p = p
+        self.count = 0
+
+        self.heights = np.zeros((5, n))
+        self.positions = np.tile(np.arange(1, 6, dtype=float)[:, np.newaxis], (1, n))
+
+        self.desired = np.array([1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5], dtype=float)
+        self.increments = np.array([0, p / 2.0, p, (1 + p) / 2.0, 1], dtype=float)
+
+    @property
+    def value(self):
+        if self.count == 0:
+            return np.full(self.heights.shape[1], np.nan)
+
+        if self.count < 5:
+            # Too few values for the markers, use the sample quantile
+            heights = np.sort(self.heights[:self.count], axis=0)
+
+            return heights[int(round(self.p * (self.count - 1)))]
+
+        return self.heights[2]
+
+    def update(self, x):
+        if self.count < 5:
+            self.heights[self.count] = x
+            self.count += 1
+
+            if self.count == 5:
+                self.heights.sort(axis=0)
+
+            return
+
+        self.count += 1
+
+        q = self.heights
+        n = self.positions
+
+        q[0] = np.minimum(q[0], x)
+        q[4] = np.maximum(q[4], x)
+
+        # Cell k of each value is such that q[k] <= x < q[k + 1], markers above it move up one position
+        k = (x >= q[1]).astype(int) + (x >= q[2]) + (x >= q[3])
+
+        for i in range(1, 5):
+            n[i] += (k < i)
+
+        self.desired += self.increments
+
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+
+            move = ((d >= 1) & (n[i + 1] - n[i] > 1)) | ((d <= -1) & (n[i - 1] - n[i] < -1))
+
+            if not move.any():
+                continue
+
+            s = np.sign(d)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                parabolic = q[i] + s / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + s) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - s) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+
+                j = (i + s).astype(int)
+                q_j = np.choose(j - i + 1, [q[i - 1], q[i], q[i + 1]])
+                n_j = np.choose(j - i + 1, [n[i - 1], n[i], n[i + 1]])
+                linear = q[i] + s * (q_j - q[i]) / (n_j - n[i])
+
+            new_height = np.where((q[i - 1] < parabolic) & (parabolic < q[i + 1]), parabolic, linear)
+
+            q[i] = np.where(move, new_height, q[i])
+            n[i] = np.where(move, n[i] + s, n[i])
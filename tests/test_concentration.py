@@ -0,0 +1,47 @@
+from __future__ import division
+
+import unittest
+
+from math import lgamma, log
+
+import numpy as np
+
+from DirichletProcess.rng import RandomStream
+from DirichletProcess.samplers.concentration import GammaPriorConcentrationSampler
+
+
+def exact_posterior_mean(a, b, k, n, max_alpha=100.0, num_points=200000):
+    '''
+    Mean of p(alpha | k, n) proportional to alpha^(a + k - 1) exp(-b alpha) Gamma(alpha) / Gamma(alpha + n), the
+    posterior of Escobar and West (1995), by quadrature on a grid.
+    '''
+    alpha = np.linspace(max_alpha / num_points, max_alpha, num_points)
+
+    log_p = np.array([(a + k - 1) * log(x) - b * x + lgamma(x) - lgamma(x + n) for x in alpha])
+
+    p = np.exp(log_p - log_p.max())
+
+    return np.sum(alpha * p) / np.sum(p)
+
+
+class GammaPriorConcentrationSamplerTest(unittest.TestCase):
+    def test_mean_matches_exact_posterior(self):
+        a, b, k, n = 1.0, 0.001, 10, 133
+
+        sampler = GammaPriorConcentrationSampler(a, b, rng=RandomStream(0))
+
+        alpha = 1.0
+
+        draws = []
+
+        for i in range(20000):
+            alpha = sampler.sample(alpha, k, n)
+
+            if i >= 1000:
+                draws.append(alpha)
+
+        self.assertAlmostEqual(np.mean(draws), exact_posterior_mean(a, b, k, n), delta=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
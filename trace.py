@@ -5,11 +5,36 @@ Created on 2013-04-23
 '''
 import bz2
 import csv
+import json
 import os
+import struct
+import sys
+import threading
+
+import numpy as np
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+if sys.version_info[0] >= 3:
+    def _reraise(exc_info):
+        raise exc_info[1].with_traceback(exc_info[2])
+
+else:
+    # The three argument raise keeps the original traceback but is a syntax error in Python 3
+    exec('def _reraise(exc_info):\n    raise exc_info[0], exc_info[1], exc_info[2]\n')
 
 from pyclone.utils import make_directory
 
 class DiskTrace(object):
+    '''
+    Write the trace as bz2 compressed tsv files, one row per recorded iteration.
+    
+    checkpoint() ends the bz2 stream of every file and returns their sizes. Passing that to open() truncates the files
+    back to the checkpoint and appends to them, so a resumed run continues the same files.
+    '''
     def __init__(self, trace_dir, sample_ids, mutation_ids, attribute_map, precision=False):
         self.trace_dir = trace_dir
         
@@ -32,22 +57,54 @@ class DiskTrace(object):
         if self.update_precision:
             self.precision_writer.close()
     
-    def open(self):
+    def checkpoint(self):
+        '''
+        Make everything written so far durable and return the state needed to reopen the trace at this point.
+        '''
+        return dict((writer.file_name, writer.sync()) for writer in self._writers)
+    
+    def open(self, resume_state=None):
+        '''
+        Kwargs:
+            resume_state : (dict) Value returned by checkpoint(). If given the files are truncated to the checkpoint 
+                                  and appended to instead of being overwritten.
+        '''
         make_directory(self.trace_dir)
         
-        self.alpha_writer = ConcentrationParameterWriter(self.trace_dir)
+        if resume_state is None:
+            resume_state = {}
         
-        self.labels_writer = LabelsWriter(self.trace_dir, self.mutation_ids)
+        file_name = os.path.join(self.trace_dir, 'alpha.tsv.bz2')
+        
+        self.alpha_writer = ConcentrationParameterWriter(self.trace_dir, resume_state.get(file_name))
+        
+        file_name = os.path.join(self.trace_dir, 'labels.tsv.bz2')
+        
+        self.labels_writer = LabelsWriter(self.trace_dir, self.mutation_ids, resume_state.get(file_name))
         
         self.cellular_frequency_writers = {}
         
         for sample_id in self.sample_ids:
+            file_name = os.path.join(self.trace_dir, '{0}.cellular_prevalence.tsv.bz2'.format(sample_id))
+            
             self.cellular_frequency_writers[sample_id] = CellularFrequenciesWriter(self.trace_dir, 
                                                                                    sample_id, 
-                                                                                   self.mutation_ids)
+                                                                                   self.mutation_ids,
+                                                                                   resume_state.get(file_name))
+        
+        if self.update_precision:
+            file_name = os.path.join(self.trace_dir, 'precision.tsv.bz2')
+            
+            self.precision_writer = PrecisionWriter(self.trace_dir, resume_state.get(file_name))
+    
+    @property
+    def _writers(self):
+        writers = [self.alpha_writer, self.labels_writer] + list(self.cellular_frequency_writers.values())
         
         if self.update_precision:
-            self.precision_writer = PrecisionWriter(self.trace_dir)
+            writers.append(self.precision_writer)
+        
+        return writers
     
     def update(self, state):
         self.alpha_writer.write_row([state['alpha'], ])
@@ -68,10 +125,10 @@ class DiskTrace(object):
             self.precision_writer.write_row([state['global_params'].x])        
 
 class ConcentrationParameterWriter(object):
-    def __init__(self, trace_dir):
+    def __init__(self, trace_dir, resume_size=None):
         self.file_name = os.path.join(trace_dir, 'alpha.tsv.bz2')
     
-        self.file_handle = bz2.BZ2File(self.file_name, 'w')
+        self.file_handle = BZ2StreamFile(self.file_name, resume_size)
         
         self.writer = csv.writer(self.file_handle, delimiter='\t')
         
@@ -80,50 +137,61 @@ class ConcentrationParameterWriter(object):
     def close(self):
         self.file_handle.close()
     
+    def sync(self):
+        return self.file_handle.sync()
+    
     def write_row(self, row):
         self.writer.writerow(row)
 
 class CellularFrequenciesWriter(object):
-    def __init__(self, trace_dir, sample_id, mutation_ids):
+    def __init__(self, trace_dir, sample_id, mutation_ids, resume_size=None):
         self.file_name = os.path.join(trace_dir, '{0}.cellular_prevalence.tsv.bz2'.format(sample_id))
     
-        self.file_handle = bz2.BZ2File(self.file_name, 'w')
+        self.file_handle = BZ2StreamFile(self.file_name, resume_size)
         
         self.writer = csv.writer(self.file_handle, delimiter='\t')
         
-        self.writer.writerow(mutation_ids)
+        if resume_size is None:
+            self.writer.writerow(mutation_ids)
         
         self.param_id = (sample_id, 'cellular_frequencies')
     
     def close(self):
         self.file_handle.close()
     
+    def sync(self):
+        return self.file_handle.sync()
+    
     def write_row(self, row):
         self.writer.writerow(row)
 
 class LabelsWriter(object):
-    def __init__(self, trace_dir, mutation_ids):
+    def __init__(self, trace_dir, mutation_ids, resume_size=None):
         self.file_name = os.path.join(trace_dir, 'labels.tsv.bz2')
     
-        self.file_handle = bz2.BZ2File(self.file_name, 'w')
+        self.file_handle = BZ2StreamFile(self.file_name, resume_size)
         
         self.writer = csv.writer(self.file_handle, delimiter='\t')
         
-        self.writer.writerow(mutation_ids)
+        if resume_size is None:
+            self.writer.writerow(mutation_ids)
         
         self.param_id = 'labels'
     
     def close(self):
         self.file_handle.close()
     
+    def sync(self):
+        return self.file_handle.sync()
+    
     def write_row(self, row):
         self.writer.writerow(row)
 
 class PrecisionWriter(object):
-    def __init__(self, trace_dir):
+    def __init__(self, trace_dir, resume_size=None):
         self.file_name = os.path.join(trace_dir, 'precision.tsv.bz2')
     
-        self.file_handle = bz2.BZ2File(self.file_name, 'w')
+        self.file_handle = BZ2StreamFile(self.file_name, resume_size)
         
         self.writer = csv.writer(self.file_handle, delimiter='\t')
         
@@ -132,5 +200,418 @@ class PrecisionWriter(object):
     def close(self):
         self.file_handle.close()
     
+    def sync(self):
+        return self.file_handle.sync()
+    
     def write_row(self, row):
         self.writer.writerow(row)
+
+class BZ2StreamFile(object):
+    '''
+    Write only bz2 file which can be ended at a stream boundary with sync() and later reopened for appending at that
+    point. Each sync() starts a new bz2 stream, so the file can hold several concatenated streams. Use iter_bz2_lines to
+    read it back, since bz2.BZ2File in Python 2 only reads the first stream.
+    '''
+    def __init__(self, file_name, resume_size=None):
+        if resume_size is None:
+            self.file_handle = open(file_name, 'wb')
+        
+        else:
+            self.file_handle = open(file_name, 'r+b')
+            
+            self.file_handle.truncate(resume_size)
+            
+            self.file_handle.seek(resume_size)
+        
+        self.compressor = bz2.BZ2Compressor()
+    
+    def close(self):
+        self.file_handle.write(self.compressor.flush())
+        
+        self.file_handle.close()
+    
+    def sync(self):
+        '''
+        End the current stream, flush it to disk and return the size of the file.
+        '''
+        self.file_handle.write(self.compressor.flush())
+        
+        self.compressor = bz2.BZ2Compressor()
+        
+        self.file_handle.flush()
+        
+        os.fsync(self.file_handle.fileno())
+        
+        return self.file_handle.tell()
+    
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        
+        self.file_handle.write(self.compressor.compress(data))
+
+def iter_bz2_lines(file_name, chunk_size=2 ** 20):
+    '''
+    Yield the lines of a bz2 file which may consist of several concatenated streams.
+    '''
+    decompressor = bz2.BZ2Decompressor()
+    
+    pending = b''
+    
+    with open(file_name, 'rb') as fh:
+        for data in iter(lambda: fh.read(chunk_size), b''):
+            while data:
+                try:
+                    text = decompressor.decompress(data)
+                
+                except EOFError:
+                    # The previous stream ended exactly at the end of the last chunk
+                    decompressor = bz2.BZ2Decompressor()
+                    
+                    continue
+                
+                data = decompressor.unused_data
+                
+                if data:
+                    decompressor = bz2.BZ2Decompressor()
+                
+                pending += text
+                
+                lines = pending.split(b'\n')
+                
+                pending = lines.pop()
+                
+                for line in lines:
+                    yield line + b'\n'
+    
+    if pending:
+        yield pending
+
+class MultiTrace(object):
+    '''
+    Pass the state of the sampler on to several traces, for example a DiskTrace and a SummaryTrace.
+    '''
+    def __init__(self, traces):
+        self.traces = traces
+    
+    def checkpoint(self):
+        return [trace.checkpoint() for trace in self.traces]
+    
+    def close(self):
+        for trace in self.traces:
+            trace.close()
+    
+    def open(self, resume_state=None):
+        if resume_state is None:
+            resume_state = [None] * len(self.traces)
+        
+        for trace, trace_state in zip(self.traces, resume_state):
+            trace.open(trace_state)
+    
+    def update(self, state):
+        for trace in self.traces:
+            trace.update(state)
+
+class AsyncTrace(object):
+    '''
+    Wrap a trace (DiskTrace or BinaryTrace) so that update() hands the state to a background writer thread instead of
+    writing it on the sampler thread. Compression and disk writes then overlap with the next iteration of the sampler.
+    
+    The states are passed through a queue of at most max_queue_size iterations. When the writer falls behind update()
+    blocks until there is room. close() waits for all queued states to be written before closing the wrapped trace.
+    Errors raised by the writer are re-raised on the sampler thread at the next update() or close().
+    
+    The sampler must not modify a state, or the objects in it, after passing it to update(). DirichletProcessSampler
+    builds a new state each iteration and replaces rather than mutates cell values, so this holds.
+    '''
+    def __init__(self, trace, max_queue_size=10):
+        self.trace = trace
+        
+        self.max_queue_size = max_queue_size
+        
+        self._error = None
+    
+    def checkpoint(self):
+        '''
+        Wait for the queued states to be written, then checkpoint the wrapped trace.
+        '''
+        self.queue.join()
+        
+        self._raise_error()
+        
+        return self.trace.checkpoint()
+    
+    def close(self):
+        self.queue.put(None)
+        
+        self.thread.join()
+        
+        self.trace.close()
+        
+        self._raise_error()
+    
+    def open(self, resume_state=None):
+        self.trace.open(resume_state)
+        
+        self.queue = Queue(self.max_queue_size)
+        
+        self.thread = threading.Thread(target=self._write)
+        
+        self.thread.daemon = True
+        
+        self.thread.start()
+    
+    def update(self, state):
+        self._raise_error()
+        
+        self.queue.put(state)
+    
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            
+            self._error = None
+            
+            _reraise(error)
+    
+    def _write(self):
+        while True:
+            state = self.queue.get()
+            
+            if state is None:
+                self.queue.task_done()
+                
+                break
+            
+            if self._error is None:
+                try:
+                    self.trace.update(state)
+                
+                except Exception:
+                    self._error = sys.exc_info()
+            
+            self.queue.task_done()
+
+#=======================================================================================================================
+# Binary trace
+#=======================================================================================================================
+BINARY_TRACE_MAGIC = b'PYCLONE1'
+
+class BinaryTrace(object):
+    '''
+    Alternative to DiskTrace which writes each parameter as a fixed dtype binary array with one row per iteration.
+    Cellular prevalences are stored as float32, labels as int32 and alpha and precision as float64. Rows are buffered
+    and written in chunks of chunk_size iterations. The mutation ids are written once to mutation_ids.tsv. Use
+    BinaryTraceReader to load the arrays back.
+    '''
+    def __init__(self, trace_dir, sample_ids, mutation_ids, attribute_map, precision=False, chunk_size=100):
+        self.trace_dir = trace_dir
+        
+        self.sample_ids = sample_ids
+        
+        self.mutation_ids = mutation_ids
+        
+        self.attribute_map = attribute_map
+        
+        self.update_precision = precision
+        
+        self.chunk_size = chunk_size
+    
+    def close(self):
+        self.alpha_writer.close()
+        
+        self.labels_writer.close()
+        
+        for writer in self.cellular_frequency_writers.values():
+            writer.close()
+        
+        if self.update_precision:
+            self.precision_writer.close()
+    
+    def checkpoint(self):
+        '''
+        Write out the buffered rows and return the state needed to reopen the trace at this point.
+        '''
+        return dict((writer.file_name, writer.sync()) for writer in self._writers)
+    
+    def open(self, resume_state=None):
+        '''
+        Kwargs:
+            resume_state : (dict) Value returned by checkpoint(). If given the files are truncated to the checkpoint 
+                                  and appended to instead of being overwritten.
+        '''
+        make_directory(self.trace_dir)
+        
+        if resume_state is None:
+            resume_state = {}
+        
+        with open(os.path.join(self.trace_dir, 'mutation_ids.tsv'), 'w') as fh:
+            for mutation_id in self.mutation_ids:
+                fh.write('{0}\n'.format(mutation_id))
+        
+        num_mutations = len(self.mutation_ids)
+        
+        def writer(file_name, dtype, num_columns):
+            file_name = os.path.join(self.trace_dir, file_name)
+            
+            return BinaryArrayWriter(file_name, dtype, num_columns, self.chunk_size, resume_state.get(file_name))
+        
+        self.alpha_writer = writer('alpha.bin', 'float64', 1)
+        
+        self.labels_writer = writer('labels.bin', 'int32', num_mutations)
+        
+        self.cellular_frequency_writers = {}
+        
+        for sample_id in self.sample_ids:
+            self.cellular_frequency_writers[sample_id] = writer('{0}.cellular_prevalence.bin'.format(sample_id),
+                                                                'float32',
+                                                                num_mutations)
+        
+        if self.update_precision:
+            self.precision_writer = writer('precision.bin', 'float64', 1)
+    
+    @property
+    def _writers(self):
+        writers = [self.alpha_writer, self.labels_writer] + list(self.cellular_frequency_writers.values())
+        
+        if self.update_precision:
+            writers.append(self.precision_writer)
+        
+        return writers
+    
+    def update(self, state):
+        self.alpha_writer.write_row([state['alpha'], ])
+        
+        self.labels_writer.write_row(state['labels'])
+        
+        attr = self.attribute_map['cellular_frequencies']
+        
+        for sample_id in self.sample_ids:
+            row = [getattr(param[sample_id], attr) for param in state['params']]
+            
+            self.cellular_frequency_writers[sample_id].write_row(row)
+        
+        if self.update_precision:
+            self.precision_writer.write_row([state['global_params'].x])
+
+class BinaryArrayWriter(object):
+    '''
+    Append rows of a fixed width and dtype to a binary file. The file starts with BINARY_TRACE_MAGIC, the length of a
+    JSON header as a little endian uint32 and the header itself, followed by the raw rows in C order.
+    
+    If resume_size is given the file is truncated to that size, as returned by sync(), and appended to.
+    '''
+    def __init__(self, file_name, dtype, num_columns, chunk_size=100, resume_size=None):
+        if num_columns < 1:
+            raise ValueError('num_columns must be at least 1, got {0}.'.format(num_columns))
+        
+        self.file_name = file_name
+        
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        
+        self.num_columns = num_columns
+        
+        if resume_size is None:
+            self.file_handle = open(file_name, 'wb')
+            
+            header = json.dumps({'dtype' : self.dtype.str, 'num_columns' : num_columns}).encode('utf-8')
+            
+            self.file_handle.write(BINARY_TRACE_MAGIC + struct.pack('<I', len(header)) + header)
+        
+        else:
+            self.file_handle = open(file_name, 'r+b')
+            
+            self.file_handle.truncate(resume_size)
+            
+            self.file_handle.seek(resume_size)
+        
+        self.buffer = np.empty((chunk_size, num_columns), dtype=self.dtype)
+        
+        self.num_buffered_rows = 0
+    
+    def close(self):
+        self.flush()
+        
+        self.file_handle.close()
+    
+    def flush(self):
+        self.file_handle.write(self.buffer[:self.num_buffered_rows].tobytes())
+        
+        self.file_handle.flush()
+        
+        self.num_buffered_rows = 0
+    
+    def sync(self):
+        '''
+        Write the buffered rows to disk and return the size of the file.
+        '''
+        self.flush()
+        
+        os.fsync(self.file_handle.fileno())
+        
+        return self.file_handle.tell()
+    
+    def write_row(self, row):
+        self.buffer[self.num_buffered_rows] = row
+        
+        self.num_buffered_rows += 1
+        
+        if self.num_buffered_rows == self.buffer.shape[0]:
+            self.flush()
+
+class BinaryTraceReader(object):
+    '''
+    Memory mapped access to a trace written by BinaryTrace. Each parameter is returned as an array of shape
+    (iteration, mutation), or (iteration,) for alpha and precision, without reading the file into memory.
+    '''
+    def __init__(self, trace_dir):
+        self.trace_dir = trace_dir
+        
+        with open(os.path.join(trace_dir, 'mutation_ids.tsv')) as fh:
+            self.mutation_ids = [line.rstrip('\n') for line in fh]
+    
+    @property
+    def alpha(self):
+        return load_binary_array(os.path.join(self.trace_dir, 'alpha.bin'))[:, 0]
+    
+    @property
+    def labels(self):
+        return load_binary_array(os.path.join(self.trace_dir, 'labels.bin'))
+    
+    @property
+    def precision(self):
+        return load_binary_array(os.path.join(self.trace_dir, 'precision.bin'))[:, 0]
+    
+    def cellular_prevalence(self, sample_id):
+        return load_binary_array(os.path.join(self.trace_dir, '{0}.cellular_prevalence.bin'.format(sample_id)))
+
+def load_binary_array(file_name):
+    '''
+    Memory map a file written by BinaryArrayWriter as a read only array of shape (rows, columns). A partially written
+    last row, for example after a crash, is ignored.
+    '''
+    with open(file_name, 'rb') as fh:
+        magic = fh.read(len(BINARY_TRACE_MAGIC))
+        
+        if magic != BINARY_TRACE_MAGIC:
+            raise Exception('{0} is not a binary trace file'.format(file_name))
+        
+        header_size = struct.unpack('<I', fh.read(4))[0]
+        
+        header = json.loads(fh.read(header_size).decode('utf-8'))
+    
+    dtype = np.dtype(str(header['dtype']))
+    
+    num_columns = header['num_columns']
+    
+    if num_columns < 1:
+        raise ValueError('{0} has num_columns {1}, it must be at least 1'.format(file_name, num_columns))
+    
+    offset = len(BINARY_TRACE_MAGIC) + 4 + header_size
+    
+    num_rows = (os.path.getsize(file_name) - offset) // (dtype.itemsize * num_columns)
+    
+    if num_rows == 0:
+        return np.empty((0, num_columns), dtype=dtype)
+    
+    return np.memmap(file_name, dtype=dtype, mode='r', offset=offset, shape=(num_rows, num_columns))
@@ -5,9 +5,15 @@
   Date last modified  : 5/1/2016
   Python Version      : 3.4
 '''
-import csv 
+import array
+import hashlib
+import json
 import os
 
+from collections import OrderedDict
+
+import numpy as np
+
 
 
 def getSamplingVariantAlleleProbability():
@@ -33,7 +39,7 @@ def getSamplingVariantAlleleProbability():
   return "getSamplingVariantAlleleProbability"
 
 
-def loadData():
+def loadData(paths=None, cache=True, cache_dir=None):
   """ Load data
   mutation_id   : unique identifier for a mutation. In general 
                   specifying the gene for the mutation is a bad idea 
@@ -61,21 +67,318 @@ def loadData():
   minor_cn      : the minor parental copy number predicted from the tumour sample.
 
   major_cn      : the major parental copy number predicted from the tumour sample.
+
+  The files are read with loadSamples, so the values of the count and copy
+  number columns are ints. Use loadSamples directly to get the columns as arrays.
   
   ------------------------------------------------------------
-  Input   : None
+  Input   : paths     - list of tsv files, one per sample. Defaults to every 
+                        .tsv file in ./Data
+          : cache     - see loadSample
+          : cache_dir - see loadSample
   Output  : Array with each line as a dict
+          : Array of sample ids
   """
+  if paths is None:
+    paths = [os.path.join("./Data", filename) for filename in sorted(os.listdir("./Data")) if filename.endswith(".tsv")]
+
   data = []
-  sample_ids = []
-
-  # Opens the data directory and reads each individual file
-  for filename in os.listdir("./Data"):
-      with open("./Data/"+filename,'r') as tsv:
-        sample_id = filename.split('.')[0]
-        sample_ids.append(sample_id)
-        reader = csv.DictReader(tsv, dialect="excel-tab")
-        for line in reader:
-            data.append(line)
-
-  return data, sample_ids
+
+  samples = loadSamples(paths, cache=cache, cache_dir=cache_dir)
+
+  for columns in samples.values():
+    names = list(columns.keys())
+    values = [columns[name].tolist() for name in names]
+
+    for row in zip(*values):
+      data.append(dict(zip(names, row)))
+
+  return data, list(samples.keys())
+
+
+def loadSamples(paths, cache=True, cache_dir=None):
+  """ loadSamples
+  Load one tsv file per sample with loadSample. The sample id is the 
+  file name up to the first '.'.
+
+  ------------------------------------------------------------
+  Input   : paths     - list of tsv files
+          : cache     - see loadSample
+          : cache_dir - see loadSample
+  Output  : OrderedDict of sample id to the columns of its file
+  """
+  samples = OrderedDict()
+
+  for path in paths:
+    sample_id = os.path.basename(path).split('.')[0]
+
+    if sample_id in samples:
+      raise ValueError("Sample id {0} of {1} is used by more than one file.".format(sample_id, path))
+
+    samples[sample_id] = loadSample(path, cache=cache, cache_dir=cache_dir)
+
+  return samples
+
+
+def loadSample(path, cache=True, cache_dir=None):
+  """ loadSample
+  Parse a PyClone tsv file into one numpy array per column. The count and 
+  copy number columns (INT_COLUMNS) are parsed as ints, every other column is 
+  kept as strings. The file is read one line at a time, so only the parsed 
+  columns are held in memory.
+
+  The parsed columns are cached in a binary sidecar file next to the input, 
+  or in cache_dir. The cache records the size, modification time and SHA-1 
+  hash of the input. It is used without reading the input if the size and 
+  modification time match, and after checking the hash if only the 
+  modification time changed. If the cache cannot be written the file is 
+  parsed on every call.
+
+  ------------------------------------------------------------
+  Input   : path      - tsv file with a header line
+          : cache     - use and write the sidecar cache
+          : cache_dir - directory for the cache, defaults to the directory 
+                        of path
+  Output  : OrderedDict of column name to numpy array
+  """
+  if not cache:
+    return _parseSample(path)
+
+  cache_path = _getCachePath(path, cache_dir)
+
+  stat = os.stat(path)
+
+  cached = _readCache(cache_path)
+
+  if cached is not None:
+    key, columns = cached
+
+    if key["size"] == stat.st_size and key["mtime"] == stat.st_mtime:
+      return columns
+
+    if key["size"] == stat.st_size and key["sha1"] == _hashFile(path):
+      _writeCache(cache_path, _getCacheKey(path, stat), columns)
+
+      return columns
+
+  columns = _parseSample(path)
+
+  _writeCache(cache_path, _getCacheKey(path, stat), columns)
+
+  return columns
+
+
+def joinSamples(samples, missing="intersect"):
+  """ joinSamples
+  Join the columns of several samples, as returned by loadSamples, on 
+  mutation_id in one hash-join pass. Every per sample column is scattered 
+  into a (mutation x sample) array, so the multi-sample model can be built 
+  without looking mutations up by id again.
+
+  Mutations which are missing from some samples are handled according to 
+  missing:
+    intersect - drop them.
+    fill      - keep them with zero ref and var counts in the samples they 
+                are missing from, and the copy numbers of the first sample 
+                which has the mutation.
+    error     - raise a ValueError.
+
+  ------------------------------------------------------------
+  Input   : samples - OrderedDict of sample id to columns
+          : missing - intersect | fill | error
+  Output  : dict with the mutation_ids and sample_ids, an int array for each 
+            of INT_COLUMNS and the boolean array present, all of shape 
+            (mutation x sample) except the ids
+  """
+  if missing not in ("intersect", "fill", "error"):
+    raise ValueError(missing, "is not a valid way to handle missing mutations. Use intersect, fill or error.")
+
+  sample_ids = list(samples.keys())
+
+  index = {}
+  mutation_ids = []
+  rows = []
+
+  for sample_id in sample_ids:
+    sample_rows = np.empty(len(samples[sample_id]["mutation_id"]), dtype=int)
+
+    for i, mutation_id in enumerate(samples[sample_id]["mutation_id"].tolist()):
+      row = index.get(mutation_id)
+
+      if row is None:
+        row = index[mutation_id] = len(mutation_ids)
+        mutation_ids.append(mutation_id)
+
+      sample_rows[i] = row
+
+    if len(np.unique(sample_rows)) != len(sample_rows):
+      raise ValueError("Sample", sample_id, "has duplicate mutation ids.")
+
+    rows.append(sample_rows)
+
+  num_mutations = len(mutation_ids)
+
+  present = np.zeros((num_mutations, len(sample_ids)), dtype=bool)
+
+  joined = dict((name, np.zeros((num_mutations, len(sample_ids)), dtype=int)) for name in INT_COLUMNS)
+
+  for j, (sample_id, sample_rows) in enumerate(zip(sample_ids, rows)):
+    present[sample_rows, j] = True
+
+    for name in INT_COLUMNS:
+      joined[name][sample_rows, j] = samples[sample_id][name]
+
+  complete = present.all(axis=1)
+
+  if missing == "error" and not complete.all():
+    raise ValueError("{0} mutations are missing from some samples, e.g. {1}.".format(
+                     (~complete).sum(), mutation_ids[np.flatnonzero(~complete)[0]]))
+
+  if missing == "intersect":
+    keep = np.flatnonzero(complete)
+
+    mutation_ids = [mutation_ids[i] for i in keep]
+    present = present[keep]
+
+    for name in INT_COLUMNS:
+      joined[name] = joined[name][keep]
+
+  elif missing == "fill":
+    # Column of the first sample with each mutation
+    first = present.argmax(axis=1)
+
+    for name in ["normal_cn", "minor_cn", "major_cn"]:
+      cn = joined[name]
+      source = cn[np.arange(num_mutations), first]
+
+      joined[name] = np.where(present, cn, source[:, np.newaxis])
+
+  joined["mutation_ids"] = mutation_ids
+  joined["sample_ids"] = sample_ids
+  joined["present"] = present
+
+  return joined
+
+
+REQUIRED_COLUMNS = ["mutation_id", "ref_counts", "var_counts", "normal_cn", "minor_cn", "major_cn"]
+
+INT_COLUMNS = ["ref_counts", "var_counts", "normal_cn", "minor_cn", "major_cn"]
+
+CACHE_VERSION = 1
+
+
+def _parseSample(path):
+  with open(path, "r") as tsv:
+    names = tsv.readline().rstrip("\r\n").split("\t")
+
+    missing = [name for name in REQUIRED_COLUMNS if name not in names]
+
+    if missing:
+      raise ValueError("{0} is missing the columns {1}.".format(path, ", ".join(missing)))
+
+    values = [array.array("l") if name in INT_COLUMNS else [] for name in names]
+
+    for line_number, line in enumerate(tsv, 2):
+      line = line.rstrip("\r\n")
+
+      if not line:
+        continue
+
+      fields = line.split("\t")
+
+      if len(fields) != len(names):
+        raise ValueError("Line {0} of {1} has {2} fields, expected {3}.".format(line_number, path, len(fields),
+                                                                                len(names)))
+
+      for column, field in zip(values, fields):
+        if isinstance(column, array.array):
+          column.append(int(field))
+        else:
+          column.append(field)
+
+  columns = OrderedDict()
+
+  for name, column in zip(names, values):
+    if isinstance(column, array.array):
+      columns[name] = np.frombuffer(column, dtype=column.typecode).copy()
+    else:
+      columns[name] = np.array(column, dtype=str)
+
+  return columns
+
+
+def _getCachePath(path, cache_dir):
+  if cache_dir is None:
+    return path + ".cache.npz"
+
+  if not os.path.isdir(cache_dir):
+    try:
+      os.makedirs(cache_dir)
+    except OSError:
+      # Another job may have created it first
+      if not os.path.isdir(cache_dir):
+        raise
+
+  # Include a hash of the full path so files with the same name in different directories do not collide
+  path_hash = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+
+  return os.path.join(cache_dir, "{0}.{1}.cache.npz".format(os.path.basename(path), path_hash))
+
+
+def _getCacheKey(path, stat):
+  return {"version": CACHE_VERSION, "size": stat.st_size, "mtime": stat.st_mtime, "sha1": _hashFile(path)}
+
+
+def _hashFile(path, chunk_size=2 ** 20):
+  sha1 = hashlib.sha1()
+
+  with open(path, "rb") as fh:
+    while True:
+      chunk = fh.read(chunk_size)
+
+      if not chunk:
+        break
+
+      sha1.update(chunk)
+
+  return sha1.hexdigest()
+
+
+def _readCache(cache_path):
+  if not os.path.exists(cache_path):
+    return None
+
+  try:
+    with np.load(cache_path) as npz:
+      key = json.loads(npz["key"].tobytes().decode("utf-8"))
+
+      if key.get("version") != CACHE_VERSION:
+        return None
+
+      columns = OrderedDict((name, npz["column_{0}".format(i)]) for i, name in enumerate(key["columns"]))
+
+  except (IOError, OSError, ValueError, KeyError):
+    return None
+
+  return key, columns
+
+
+def _writeCache(cache_path, key, columns):
+  key = dict(key, columns=list(columns.keys()))
+
+  arrays = dict(("column_{0}".format(i), column) for i, column in enumerate(columns.values()))
+
+  arrays["key"] = np.frombuffer(json.dumps(key).encode("utf-8"), dtype=np.uint8)
+
+  # Write under a temporary name and rename so concurrent jobs never read a partial cache
+  temp_path = "{0}.{1}.tmp".format(cache_path, os.getpid())
+
+  try:
+    with open(temp_path, "wb") as fh:
+      np.savez(fh, **arrays)
+
+    os.rename(temp_path, cache_path)
+
+  except (IOError, OSError):
+    if os.path.exists(temp_path):
+      os.remove(temp_path)